@@ -12,7 +12,6 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from security import require_internal_api_key
-import gspread
 from googleapiclient.discovery import build
 import config
 import google_handler
@@ -20,6 +19,10 @@ import reconciliation_handler
 from tasks import download_report_generator
 import bq_handler
 import raw_data_handler # IMPORT FILE NGUYÊN TỬ MỚI
+import result_store
+import reconcile_memo
+import daily_reconcile
+import batch_reconcile
 
 PROXY_MODE = os.getenv("PROXY_DOWNLOAD_VIA_VPS", "0") == "1"
 VPS_BASE_URL = os.getenv("VPS_BASE_URL", "").rstrip("/")
@@ -28,6 +31,7 @@ PROXY_TIMEOUT = int(os.getenv("PROXY_TIMEOUT_SECONDS", "1200"))
 
 # ========== LỚP 2: JOB MANAGER (VPS) ==========
 import threading, queue, time
+import itertools, shutil, tempfile
 from collections import deque
 
 class StreamJob:
@@ -120,17 +124,7 @@ def check_report_exists():
             
             import bq_handler
             try:
-                client = bq_handler.get_bq_client()
-                query = f"""
-                    SELECT 1 
-                    FROM `{client.project}.pvoil_data.HD01_Master_Data` 
-                    WHERE Thang_Bao_Cao = {int(report_month)} AND Nam_Bao_Cao = {int(report_year)} 
-                    LIMIT 1
-                """
-                job = client.query(query)
-                results = list(job.result())
-                
-                if len(results) > 0:
+                if bq_handler.month_has_data(report_month, report_year):
                     if station_code != 'ALL':
                         return jsonify({"exists": True, "message": f"Dữ liệu BKHĐ tháng {report_month}/{report_year} đã tồn tại trên BigQuery. Dữ liệu cửa hàng bạn chọn sẽ được cập nhật/ghi đè nối tiếp."})
                     return jsonify({"exists": True, "message": f"Dữ liệu BKHĐ của tháng {report_month}/{report_year} đã có sẵn trên BigQuery. Việc tải lại sẽ cập nhật thêm các hóa đơn mới."})
@@ -169,7 +163,9 @@ def aggregate_hd01():
         import bq_handler
         from data_processors.processor_hd01 import generate_excel_from_bq
 
+        t0 = time.perf_counter()
         agg_prod, agg_status = bq_handler.get_aggregated_data(month, year)
+        print(f"[aggregate_hd01] Truy vấn tổng hợp {month}/{year}: {time.perf_counter() - t0:.2f}s")
         
         if agg_prod.empty:
             return f"Không tìm thấy dữ liệu hóa đơn của tháng {month}/{year} trên BigQuery.", 404
@@ -190,21 +186,87 @@ def export_raw_hd01():
         year = request.args.get('year', '').strip()
         station_code = request.args.get('store_code', 'ALL').strip()
         
+        export_format = request.args.get('format', 'xlsx').strip().lower()
+        
         if not month or not year: return "Thiếu tham số tháng/năm", 400
+
+        # Bộ lọc tuỳ chọn, đẩy thẳng xuống SQL: ?columns=So_HD,Tong_Tien&date_from=2025-08-01&date_to=2025-08-15
+        # &product=Xăng RON95 Mức 3&product=...&mst=0600759399&status=Hoàn thành&status=...
+        filters = {
+            'columns': [c for c in request.args.get('columns', '').split(',') if c.strip()],
+            'date_from': request.args.get('date_from', '').strip(),
+            'date_to': request.args.get('date_to', '').strip(),
+            'products': [p for p in request.args.getlist('product') if p.strip()],
+            'mst': request.args.get('mst', '').strip(),
+            'statuses': [st for st in request.args.getlist('status') if st.strip()],
+        }
         
-        df_raw = bq_handler.get_raw_hd01_data(month, year, station_code)
-        if df_raw.empty: return f"Không tìm thấy dữ liệu cho tháng {month}/{year}", 404
-            
-        excel_bytes = raw_data_handler.export_to_excel_raw(df_raw)
+        # Đọc theo luồng từng lô Arrow: lấy lô đầu tiên có dữ liệu để biết tháng có dữ liệu hay không
+        stats = {}
+        try:
+            batches = bq_handler.iter_raw_hd01_batches(month, year, station_code, stats=stats, **filters)
+            first_batch = next((b for b in batches if b.num_rows), None)
+        except ValueError as ve:
+            return f"Tham số lọc không hợp lệ: {ve}", 400
+        if first_batch is None: return f"Không tìm thấy dữ liệu cho tháng {month}/{year}", 404
+        batches = itertools.chain([first_batch], batches)
         
         store_label = station_code if station_code != 'ALL' else "TatCaCHXD"
-        filename = f"DataTho_HD01_{store_label}_{int(month):02d}_{year}.xlsx"
-            
-        return send_file(excel_bytes, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        filename = f"DataTho_HD01_{store_label}_{int(month):02d}_{year}"
+        scan_headers = {"X-Bytes-Processed": str(stats.get('bytes_processed', 0)), "X-Cache": "HIT" if stats.get('cache_hit') else "MISS"}
+
+        if export_format == 'csv':
+            # CSV: gửi từng lô ngay khi đọc được từ BigQuery
+            return Response(stream_with_context(raw_data_handler.iter_csv_raw(batches)), mimetype='text/csv',
+                            headers={"Content-Disposition": f'attachment; filename="{filename}.csv"', "X-Accel-Buffering": "no", **scan_headers})
+
+        # XLSX: workbook write_only ghi dần ra file tạm trên đĩa rồi gửi file đó đi
+        output = tempfile.TemporaryFile()
+        raw_data_handler.export_batches_to_excel_raw(batches, output)
+        output.seek(0)
+        response = send_file(output, as_attachment=True, download_name=f"{filename}.xlsx", mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response.headers.update(scan_headers)
+        return response
     except Exception as e:
         print(f"Lỗi Export Raw: {e}")
         return f"Lỗi máy chủ: {str(e)}", 500
 
+@app.route('/hd01_coverage', methods=['GET'])
+def hd01_coverage():
+    """Độ phủ dữ liệu HD01 theo CHXD × Tháng trong 1 năm (đọc từ sổ nạp, không quét bảng hóa đơn)."""
+    try:
+        year = request.args.get('year', '').strip()
+        if not year: return jsonify({"status": "error", "message": "Thiếu tham số năm"}), 400
+
+        coverage = bq_handler.get_coverage(year)
+        all_stores = config.load_app_config().get("STORE_INFO", {})
+        months = []
+        for month, stores in sorted(coverage.items()):
+            loaded = {code: info for code, info in stores.items() if info.get('So_Dong', 0) > 0}
+            months.append({
+                "month": month,
+                "loaded": loaded,
+                "empty": sorted(code for code in stores if code not in loaded),
+                "missing": sorted(code for code in all_stores if code not in stores),
+            })
+        return jsonify({"status": "success", "year": int(year), "stores": all_stores, "months": months})
+    except Exception as e:
+        print(f"Lỗi đọc sổ nạp HD01: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/cache_metrics', methods=['GET'])
+def cache_metrics():
+    """Số liệu hit/miss của bộ nhớ đệm truy vấn HD01 (tổng hợp tháng, dữ liệu thô)."""
+    import query_cache
+    return jsonify(query_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def query_metrics():
+    """Chi phí truy vấn BigQuery theo từng nơi gọi (byte quét, slot-ms, trúng cache, thời gian) + số liệu bộ nhớ đệm."""
+    import bq_query
+    import query_cache
+    return jsonify({'bigquery': bq_query.metrics_snapshot(), 'cache': query_cache.stats(), 'results': result_store.stats(), 'reconcile_memo': reconcile_memo.stats()})
+
 # ==========================
 # ROUTE TRUYỀN DỮ LIỆU
 # ==========================
@@ -308,6 +370,53 @@ def download_report_stream():
 # ====================
 # ĐỐI SOÁT
 # ====================
+UPLOAD_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # File đối soát lớn hơn ngưỡng này được ghi ra file tạm trên đĩa, không giữ cả file trong RAM
+
+def _stream_max_rows():
+    """Số dòng kết quả tối đa gửi thẳng trong luồng /reconcile; phần còn lại lấy theo trang qua /reconcile_result/<id>/page."""
+    return int(os.getenv("RECONCILE_STREAM_MAX_ROWS", "50000"))
+
+def _spool_upload(file_storage):
+    """Chép file tải lên ra file tạm (RAM → đĩa khi lớn) và băm SHA-256 cho reconcile_memo. Trả về (file, hash)."""
+    upload = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    shutil.copyfileobj(file_storage.stream, upload, 1024 * 1024)
+    return upload, reconcile_memo.file_digest(upload)
+
+def _result_messages(reconcile_type, result_id, results=None):
+    """
+    Các bản ghi NDJSON của 1 kết quả: các trang 'result_page' (dòng lệch trước) rồi 1 bản ghi tổng kết 'result'.
+    results None → đọc từ result_store. Quá RECONCILE_STREAM_MAX_ROWS dòng thì dừng, bản ghi tổng kết trả next_cursor
+    để lấy tiếp qua /reconcile_result/<id>/page.
+    """
+    page_size, max_rows = result_store.page_rows(), _stream_max_rows()
+    if results is not None:
+        ordered = [results[i] for i in result_store.mismatch_order(results)]
+        total, mismatches = len(ordered), sum(1 for r in ordered if not r.get('is_match'))
+        def read_page(cursor):
+            rows = ordered[cursor:cursor + page_size]
+            return rows, (cursor + len(rows) if cursor + len(rows) < total else None)
+    else:
+        meta = result_store.load_meta(result_id)
+        if meta is None:
+            raise RuntimeError("Kết quả đối soát đã lưu không còn, vui lòng đối soát lại.")
+        total, mismatches = meta['rows'], meta.get('mismatches')
+        def read_page(cursor):
+            rows, next_cursor, _ = result_store.load_page(result_id, cursor, page_size)
+            if rows is None:
+                raise RuntimeError("Không đọc được kết quả đối soát đã lưu.")
+            return rows, next_cursor
+
+    cursor = 0 if total else None
+    while cursor is not None and (cursor < max_rows or not result_id):
+        rows, next_cursor = read_page(cursor)
+        yield {"type": "result_page", "cursor": cursor, "rows": rows}
+        cursor = next_cursor
+    summary = {'total': total, 'mismatches': mismatches, 'matches': None if mismatches is None else total - mismatches}
+    yield {"type": "result", "status": "success", "reconcile_type": reconcile_type, "result_id": result_id,
+           "cached": results is None, "summary": summary, "next_cursor": cursor}
+
+CACHED_RESULT_MESSAGE = "...... File và dữ liệu đối chiếu không đổi so với lần đối soát trước, dùng lại kết quả đã lưu........"
+
 @app.route('/reconcile', methods=['POST'])
 def reconcile():
     try:
@@ -316,9 +425,7 @@ def reconcile():
         if 'accounting_file' not in request.files:
             return jsonify({"status": "error", "message": "Vui lòng tải lên file từ phần mềm kế toán."}), 400
 
-        sse_file = request.files['accounting_file']
-        file_bytes = sse_file.read()
-        file_name = sse_file.filename
+        upload, file_hash = _spool_upload(request.files['accounting_file'])
 
         reconcile_date_str = request.form.get('reconcile_date')
 
@@ -328,111 +435,82 @@ def reconcile():
             def progress_callback(msg):
                 q.put({"type": "log", "message": msg})
 
+            def send_result(result_id, results=None):
+                for item in _result_messages(reconcile_type, result_id, results):
+                    q.put(item)
+
+            def send_cached(result_id):
+                """Dữ liệu 2 phía không đổi so với lần đối soát trước → trả lại kết quả đã lưu. False nếu kết quả không còn."""
+                if result_store.load_meta(result_id) is None:
+                    return False
+                progress_callback(CACHED_RESULT_MESSAGE)
+                send_result(result_id)
+                return True
+
             def worker():
                 try:
-                    file_stream = io.BytesIO(file_bytes)
-                    file_stream.name = file_name
+                    file_stream = upload
 
                     if reconcile_type == 'HoaDon':
                         import reconciliation_handler
+                        def read_tax():
+                            tax_df, month, year = reconciliation_handler.read_tax_excel_file(file_stream, progress_callback=progress_callback)
+                            return tax_df, {'target_month': int(month), 'target_year': int(year)}
                         try:
-                            tax_df, target_month, target_year = reconciliation_handler.read_tax_excel_file(file_stream, progress_callback=progress_callback)
+                            tax_df, period = reconcile_memo.cached_frame('input_HoaDon', reconcile_memo.make_key(file_hash), read_tax)
                         except ValueError as ve:
                             q.put({"type": "result", "status": "error", "message": str(ve)})
                             return
+                        target_month, target_year = period['target_month'], period['target_year']
 
                         progress_callback(f"...... Đã nhận diện Bảng kê Thuế: Tháng {target_month} / Năm {target_year}. Đang kiểm tra dữ liệu PVOIL.........")
                         
                         import bq_handler
-                        client = bq_handler.get_bq_client()
-                        query = f"SELECT 1 FROM `{client.project}.pvoil_data.HD01_Master_Data` WHERE Thang_Bao_Cao = {int(target_month)} AND Nam_Bao_Cao = {int(target_year)} LIMIT 1"
-                        job = client.query(query)
-
-                        if len(list(job.result())) == 0:
+                        if not bq_handler.month_has_data(target_month, target_year):
                             q.put({'type': 'result', 'status': 'report_not_found', 'message': f'Dữ liệu hóa đơn tháng {target_month}/{target_year} chưa có trên hệ thống BigQuery.', 'target_month': target_month, 'target_year': target_year})
                             return
 
+                        memo_key = reconcile_memo.result_key(reconcile_type, file_hash, bq_handler.hd01_data_version(target_month, target_year),
+                                                             backend=bq_handler.hd01_backend(), target_month=target_month, target_year=target_year)
+                        cached_id = reconcile_memo.lookup_result(memo_key)
+                        if cached_id and send_cached(cached_id):
+                            return
+
                         results = reconciliation_handler.reconcile_invoice_data_bq(target_month, target_year, tax_df, progress_callback=progress_callback)
 
                         progress_callback("...... Đang vẽ bảng kết quả........")
-                        q.put({'type': 'result', 'status': 'success', 'reconcile_type': reconcile_type, 'data': results})
+                        result_id = result_store.save(results, reconcile_type, target_month=target_month, target_year=target_year)
+                        reconcile_memo.remember_result(memo_key, result_id)
+                        send_result(result_id, results)
 
                     else:
-                        progress_callback("... Đang xác thực với Google Drive.....")
-                        creds = google_handler.get_google_credentials()
-                        gspread_client = gspread.authorize(creds)
-                        drive_service = build('drive', 'v3', credentials=creds)
-
                         if not reconcile_date_str:
                             q.put({"type": "result", "status": "error", "message": "Vui lòng chọn ngày đối soát."})
                             return
-
-                        reconcile_date = datetime.strptime(reconcile_date_str, '%Y-%m-%d')
-                        date_str_dmy = reconcile_date.strftime('%d.%m.%Y')
-
-                        progress_callback(f"... Đang tìm báo cáo ngày {date_str_dmy}.....")
-                        year_folder_id = google_handler.get_or_create_gdrive_folder(drive_service, f"Năm {reconcile_date.year}", config.GOOGLE_DRIVE_ROOT_FOLDER_ID)
-                        month_folder_id = google_handler.get_or_create_gdrive_folder(drive_service, f"Tháng {reconcile_date.month}", year_folder_id)
-
-                        if reconcile_type == 'CongNo':
-                            try: pos_spreadsheet = gspread_client.open(f"CongNo.{date_str_dmy}", folder_id=month_folder_id)
-                            except gspread.exceptions.SpreadsheetNotFound: 
-                                q.put({"type": "result", "status": "report_not_found", "message": f"Không tìm thấy báo cáo POS (CongNo) ngày {date_str_dmy}."})
-                                return
-                            
-                            progress_callback("... Đang tải dữ liệu POS từ Google Sheet.....")
-                            pos_sheet = pos_spreadsheet.worksheet('TongHopCongNo')
-                            pos_data = pos_sheet.get_all_values()
-                            pos_df = pd.DataFrame(pos_data[1:], columns=pos_data[0]) if len(pos_data) > 1 else pd.DataFrame()
-                        else:
-                            try: pos_spreadsheet = gspread_client.open(f"BCBH.{date_str_dmy}", folder_id=month_folder_id)
-                            except gspread.exceptions.SpreadsheetNotFound: 
-                                q.put({"type": "result", "status": "report_not_found", "message": f"Không tìm thấy báo cáo POS (BCBH) ngày {date_str_dmy}."})
-                                return
-                            
-                            progress_callback("... Đang tải dữ liệu POS từ Google Sheet.....")
-                            pos_sheet = pos_spreadsheet.worksheet('TongHopBCBH')
-                            pos_data = pos_sheet.get_all_values()
-                            pos_df = pd.DataFrame(pos_data[1:], columns=pos_data[0]) if len(pos_data) > 1 else pd.DataFrame()
-
-                        import reconciliation_handler
-                        progress_callback("... Đang đọc file Kế toán (XML/Excel).....")
-                        
-                        if reconcile_type == 'SanLuong':
-                            sse_df = reconciliation_handler.read_sse_product_xml(file_stream)
-                            if sse_df is None:
-                                q.put({"type": "result", "status": "error", "message": "Định dạng file kế toán (sản lượng) không hợp lệ."})
-                                return
-                            progress_callback("... Bắt đầu so khớp dữ liệu Sản lượng.....")
-                            reconciliation_results = reconciliation_handler.reconcile_product_data(pos_df, sse_df)
-                            
-                        elif reconcile_type == 'TienMat':
-                            sse_df = reconciliation_handler.read_sse_cash_xml(file_stream, reconcile_date)
-                            if sse_df is None:
-                                q.put({"type": "result", "status": "error", "message": "Định dạng file kế toán (tiền mặt) không hợp lệ."})
-                                return
-                            progress_callback("... Bắt đầu so khớp dữ liệu Tiền mặt.....")
-                            reconciliation_results = reconciliation_handler.reconcile_cash_data(pos_df, sse_df)
-                            
-                        elif reconcile_type == 'CongNo':
-                            sse_df = reconciliation_handler.read_sse_debt_xml(file_stream)
-                            if sse_df is None:
-                                q.put({"type": "result", "status": "error", "message": "Định dạng file kế toán (công nợ) không hợp lệ."})
-                                return
-                            progress_callback("... Bắt đầu so khớp dữ liệu Công nợ.....")
-                            reconciliation_results = reconciliation_handler.reconcile_debt_data(pos_df, sse_df)
-                        else:
+                        if reconcile_type not in daily_reconcile.DAILY_TYPES:
                             q.put({"type": "result", "status": "error", "message": "Loại đối soát không hợp lệ."})
                             return
 
-                        progress_callback("...... Đang vẽ bảng kết quả........")
-                        q.put({"type": "result", "status": "success", "data": reconciliation_results, "reconcile_type": reconcile_type})
+                        reconcile_date = datetime.strptime(reconcile_date_str, '%Y-%m-%d')
+                        progress_callback("... Đang xác thực với Google Drive.....")
+                        session = daily_reconcile.PosSession()
+                        outcome = daily_reconcile.reconcile_day(session, reconcile_date, {reconcile_type: (file_stream, file_hash)}, progress_callback)[reconcile_type]
+                        if outcome['status'] != 'success':
+                            q.put({"type": "result", "status": outcome['status'], "message": outcome['message']})
+                            return
+                        if outcome['cached']:
+                            progress_callback(CACHED_RESULT_MESSAGE)
+                        else:
+                            progress_callback("...... Đang vẽ bảng kết quả........")
+                        send_result(outcome['result_id'], outcome['results'])
 
                 except Exception as e:
                     print(f"Lỗi khi đối soát trong luồng nền: {e}")
                     import traceback
                     traceback.print_exc()
                     q.put({"type": "result", "status": "error", "message": f"Đã xảy ra lỗi không mong muốn: {str(e)}"})
+                finally:
+                    upload.close()
 
             # Khởi động luồng chạy song song
             t = threading.Thread(target=worker)
@@ -451,6 +529,163 @@ def reconcile():
         print(f"Lỗi khởi tạo luồng đối soát (Main thread): {e}")
         return jsonify({"status": "error", "message": f"Lỗi khởi tạo luồng đối soát: {str(e)}"}), 500
 
+DAILY_UPLOAD_FIELDS = {'SanLuong': 'sanluong_file', 'TienMat': 'tienmat_file', 'CongNo': 'congno_file'}
+
+@app.route('/reconcile_daily', methods=['POST'])
+def reconcile_daily():
+    """
+    Đối soát cuối ngày 1 lần cho Sản lượng, Tiền mặt, Công nợ (gửi 1-3 file: sanluong_file, tienmat_file, congno_file + reconcile_date).
+    Xác thực Google + tìm Sheet POS 1 lần, tải BCBH/CongNo song song với đọc các file SSE.
+    Luồng NDJSON: log → các trang 'result_page' (có reconcile_type) của từng loại → 1 bản ghi 'result' gộp:
+      {"type": "result", "status", "reconcile_date", "sections": {loại: {status, result_id, cached, summary, next_cursor | message}}}
+    """
+    try:
+        reconcile_date_str = request.form.get('reconcile_date')
+        if not reconcile_date_str:
+            return jsonify({"status": "error", "message": "Vui lòng chọn ngày đối soát."}), 400
+        try:
+            reconcile_date = datetime.strptime(reconcile_date_str, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({"status": "error", "message": "Ngày đối soát phải có dạng YYYY-MM-DD."}), 400
+
+        uploads = {t: _spool_upload(request.files[field]) for t, field in DAILY_UPLOAD_FIELDS.items()
+                   if field in request.files and request.files[field].filename}
+        if not uploads:
+            return jsonify({"status": "error", "message": "Vui lòng tải lên ít nhất 1 file kế toán (sản lượng, tiền mặt hoặc công nợ)."}), 400
+
+        def generate():
+            q = queue.Queue()
+
+            def progress_callback(msg):
+                q.put({"type": "log", "message": msg})
+
+            def worker():
+                try:
+                    progress_callback("... Đang xác thực với Google Drive.....")
+                    session = daily_reconcile.PosSession()
+                    outcomes = daily_reconcile.reconcile_day(session, reconcile_date, uploads, progress_callback)
+                    sections = {}
+                    for reconcile_type in daily_reconcile.DAILY_TYPES:
+                        outcome = outcomes.get(reconcile_type)
+                        if outcome is None:
+                            continue
+                        if outcome['status'] != 'success':
+                            sections[reconcile_type] = {'status': outcome['status'], 'message': outcome['message']}
+                            continue
+                        for item in _result_messages(reconcile_type, outcome['result_id'], outcome['results']):
+                            if item['type'] == 'result_page':
+                                q.put({**item, 'reconcile_type': reconcile_type})
+                            else:
+                                sections[reconcile_type] = {k: v for k, v in item.items() if k not in ('type', 'reconcile_type')}
+                    status = 'success' if any(sec['status'] == 'success' for sec in sections.values()) else 'error'
+                    q.put({"type": "result", "status": status, "reconcile_date": reconcile_date_str, "sections": sections})
+                except Exception as e:
+                    print(f"Lỗi khi đối soát cuối ngày trong luồng nền: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    q.put({"type": "result", "status": "error", "message": f"Đã xảy ra lỗi không mong muốn: {str(e)}"})
+                finally:
+                    for upload, _ in uploads.values():
+                        upload.close()
+
+            threading.Thread(target=worker).start()
+            while True:
+                item = q.get()
+                yield json.dumps(item) + "\n"
+                if item.get("type") == "result":
+                    break
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    except Exception as e:
+        print(f"Lỗi khởi tạo luồng đối soát cuối ngày (Main thread): {e}")
+        return jsonify({"status": "error", "message": f"Lỗi khởi tạo luồng đối soát: {str(e)}"}), 500
+
+BATCH_UPLOAD_FIELDS = {'SanLuong': 'sanluong_files', 'TienMat': 'tienmat_files'}
+
+@app.route('/reconcile_batch', methods=['POST'])
+def reconcile_batch():
+    """
+    Đối soát Sản lượng + Tiền mặt cả tháng (year, month + nhiều file sanluong_files / tienmat_files, mỗi ngày 1 file hoặc file nhiều ngày).
+    Luồng NDJSON: log theo từng ngày → 1 bản ghi 'result' {status, result_id, year, month, days: [...]};
+    file Excel tổng hợp tải qua /download_excel/<result_id>, các dòng kết quả xem theo trang qua /reconcile_result/<result_id>/page.
+    """
+    try:
+        try:
+            year, month = int(request.form.get('year', '')), int(request.form.get('month', ''))
+        except ValueError:
+            return jsonify({"status": "error", "message": "Vui lòng chọn tháng và năm đối soát."}), 400
+        if not 1 <= month <= 12:
+            return jsonify({"status": "error", "message": "Tháng đối soát phải nằm trong 1..12."}), 400
+
+        files = {}
+        for t, field in BATCH_UPLOAD_FIELDS.items():
+            for f in request.files.getlist(field):
+                if f and f.filename:
+                    upload, file_hash = _spool_upload(f)
+                    files.setdefault(t, []).append((upload, file_hash, f.filename))
+        if not files:
+            return jsonify({"status": "error", "message": "Vui lòng tải lên các file kế toán sản lượng và/hoặc tiền mặt của tháng."}), 400
+
+        def generate():
+            q = queue.Queue()
+
+            def progress_callback(msg):
+                q.put({"type": "log", "message": msg})
+
+            def worker():
+                try:
+                    progress_callback("... Đang xác thực với Google Drive.....")
+                    records, days = batch_reconcile.run_batch(daily_reconcile.PosSession(), year, month, files, progress_callback)
+                    if not days:
+                        q.put({"type": "result", "status": "error", "message": f"Không có ngày nào của tháng {month}/{year} trong các file kế toán."})
+                        return
+                    progress_callback("...... Đang lưu kết quả tổng hợp........")
+                    result_id = batch_reconcile.save_batch(records, days, year, month)
+                    status = 'success' if any(d['status'] == 'success' for d in days) else 'error'
+                    q.put({"type": "result", "status": status, "result_id": result_id, "year": year, "month": month,
+                           "total": len(records), "mismatches": sum(d['mismatches'] for d in days), "days": days})
+                except Exception as e:
+                    print(f"Lỗi khi đối soát batch trong luồng nền: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    q.put({"type": "result", "status": "error", "message": f"Đã xảy ra lỗi không mong muốn: {str(e)}"})
+                finally:
+                    for type_files in files.values():
+                        for upload, _, _ in type_files:
+                            upload.close()
+
+            threading.Thread(target=worker).start()
+            while True:
+                item = q.get()
+                yield json.dumps(item) + "\n"
+                if item.get("type") == "result":
+                    break
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    except Exception as e:
+        print(f"Lỗi khởi tạo luồng đối soát batch (Main thread): {e}")
+        return jsonify({"status": "error", "message": f"Lỗi khởi tạo luồng đối soát: {str(e)}"}), 500
+
+def _write_results_workbook(df, reconcile_type, target):
+    """Ghi bảng kết quả đối soát ra Excel (target: đường dẫn hoặc BytesIO), đổi tên cột theo loại đối soát."""
+    column_names = result_store.RESULT_COLUMN_NAMES.get(reconcile_type, result_store.RESULT_COLUMN_NAMES['SanLuong'])
+    df = df.rename(columns={k: v for k, v in column_names.items() if k in df.columns})
+    if 'Khớp' in df.columns: df['Khớp'] = df['Khớp'].apply(lambda x: 'Khớp' if bool(x) else 'Lệch')
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='KetQuaDoiSoat')
+
+def _build_result_workbook(df, meta, target):
+    """Dựng Excel cho 1 kết quả đã lưu: kết quả batch nhiều ngày có file tổng hợp riêng (batch_reconcile)."""
+    if meta['reconcile_type'] == batch_reconcile.BATCH_RESULT_TYPE:
+        batch_reconcile.write_batch_workbook(df, meta.get('days', []), target)
+    else:
+        _write_results_workbook(df, meta['reconcile_type'], target)
+
+def _results_filename(reconcile_type, when=None):
+    return f"KetQuaDoiSoat_{reconcile_type}_{(when or datetime.now()).strftime('%d-%m-%Y')}.xlsx"
+
 @app.route('/download_excel', methods=['POST'])
 def download_excel():
     try:
@@ -460,32 +695,54 @@ def download_excel():
 
         if not results_data: return "No data received", 400
 
-        df = pd.DataFrame(results_data)
-
-        if reconcile_type == 'TienMat':
-            column_names = {'chxd_name': 'Cửa hàng', 'product_name': 'Đối tượng', 'pos_value': 'Tiền mặt POS (VND)', 'sse_value': 'Tiền mặt Kế toán (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú'}
-        elif reconcile_type == 'CongNo':
-            column_names = {'chxd_name': 'Cửa hàng', 'customer_code': 'Mã khách', 'customer_name': 'Tên khách hàng', 'pos_value': 'Phát sinh nợ POS (VND)', 'sse_value': 'Phát sinh nợ Kế toán (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú'}
-        elif reconcile_type == 'HoaDon':
-            column_names = {'chxd_name': 'Cửa hàng / Phân loại', 'invoice_id': 'Chứng minh thư HĐ', 'pos_value': 'Tổng tiền PVOIL (VND)', 'sse_value': 'Tổng tiền Bảng kê Thuế (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú'}
-        else:  # SanLuong
-            column_names = {'chxd_name': 'Cửa hàng', 'product_name': 'Mặt hàng', 'pos_value': 'Sản lượng POS', 'sse_value': 'Sản lượng Kế toán', 'is_match': 'Khớp', 'status': 'Ghi chú'}
-
-        df.rename(columns={k: v for k, v in column_names.items() if k in df.columns}, inplace=True)
-        if 'Khớp' in df.columns: df['Khớp'] = df['Khớp'].apply(lambda x: 'Khớp' if bool(x) else 'Lệch')
-
         output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='KetQuaDoiSoat')
+        _write_results_workbook(pd.DataFrame(results_data), reconcile_type, output)
         output.seek(0)
+        return send_file(output, as_attachment=True, download_name=_results_filename(reconcile_type), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    except Exception as e:
+        print(f"Lỗi khi tạo file Excel: {e}")
+        return "Error creating Excel file", 500
 
-        reconcile_date_str = datetime.now().strftime('%d-%m-%Y')
-        filename = f"KetQuaDoiSoat_{reconcile_type}_{reconcile_date_str}.xlsx"
-
-        return send_file(output, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+@app.route('/download_excel/<result_id>', methods=['GET'])
+def download_excel_by_id(result_id):
+    """Tải Excel của 1 kết quả đã lưu phía máy chủ (file Excel được dựng 1 lần rồi dùng lại)."""
+    try:
+        path = result_store.workbook_path(result_id, _build_result_workbook)
+        if path is None:
+            return jsonify({"status": "error", "message": "Kết quả đối soát không tồn tại hoặc đã hết hạn, vui lòng đối soát lại."}), 404
+        meta = result_store.load_meta(result_id) or {}
+        if meta.get('reconcile_type') == batch_reconcile.BATCH_RESULT_TYPE:
+            download_name = f"KetQuaDoiSoat_Thang_{int(meta['month']):02d}_{meta['year']}.xlsx"
+        else:
+            created_at = datetime.fromisoformat(meta['created_at']) if meta.get('created_at') else None
+            download_name = _results_filename(meta.get('reconcile_type', 'SanLuong'), created_at)
+        return send_file(path, as_attachment=True, download_name=download_name,
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     except Exception as e:
         print(f"Lỗi khi tạo file Excel: {e}")
         return "Error creating Excel file", 500
 
+@app.route('/reconcile_result/<result_id>', methods=['GET'])
+def reconcile_result(result_id):
+    """Xem lại 1 kết quả đối soát đã lưu (cùng dạng message 'result' của /reconcile)."""
+    records, meta = result_store.load_records(result_id)
+    if records is None:
+        return jsonify({"status": "error", "message": "Kết quả đối soát không tồn tại hoặc đã hết hạn, vui lòng đối soát lại."}), 404
+    return jsonify({"status": "success", "reconcile_type": meta['reconcile_type'], "result_id": result_id, "data": records})
+
+@app.route('/reconcile_result/<result_id>/page', methods=['GET'])
+def reconcile_result_page(result_id):
+    """1 trang kết quả đã lưu theo thứ tự hiển thị (dòng lệch trước): ?cursor=<vị trí>&limit=<số dòng, tối đa 10000>."""
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = min(int(request.args.get('limit', result_store.page_rows())), 10000)
+    except ValueError:
+        return jsonify({"status": "error", "message": "cursor/limit phải là số nguyên."}), 400
+    rows, next_cursor, meta = result_store.load_page(result_id, cursor, limit)
+    if rows is None:
+        return jsonify({"status": "error", "message": "Kết quả đối soát không tồn tại hoặc đã hết hạn, vui lòng đối soát lại."}), 404
+    return jsonify({"status": "success", "reconcile_type": meta['reconcile_type'], "result_id": result_id, "cursor": cursor,
+                    "rows": rows, "next_cursor": next_cursor, "total": meta['rows'], "mismatches": meta.get('mismatches')})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+batch_reconcile.py
+Đối soát Sản lượng + Tiền mặt cho nhiều ngày (kiểm tra cuối tháng) trong 1 lần chạy, ra 1 file Excel tổng hợp.
+
+- Nhận các file SSE của tháng: mỗi ngày 1 file, hoặc 1 file xuất nhiều ngày (cột 'Ngày dd/mm ...' / 'Bán - dd/mm');
+  mỗi file chỉ đọc 1 lượt rồi tách theo ngày (read_sse_*_xml_by_day), các file được đọc song song.
+- Dùng chung 1 phiên Google (daily_reconcile.PosSession): tìm mọi Sheet BCBH.<ngày> của tháng bằng 1 truy vấn Drive,
+  mỗi ngày đọc TongHopBCBH đúng 1 lần (1 lệnh values.get, dùng cho cả Sản lượng lẫn Tiền mặt).
+- Các ngày được đối soát song song trong nhóm luồng; ngày có file + Sheet POS không đổi dùng lại kết quả đã ghi nhớ (reconcile_memo).
+
+Cách dùng:
+  python batch_reconcile.py --year 2025 --month 8 --sanluong SL_T8.xml --tienmat TM_T8.xml
+  python batch_reconcile.py --year 2025 --month 8 --sanluong sl_*.xml --output DoiSoat_T8.xlsx --workers 8
+
+Biến môi trường: RECONCILE_BATCH_WORKERS=4 (mặc định, số ngày đối soát song song)
+"""
+import argparse
+import glob
+import os
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+import daily_reconcile
+import reconcile_memo
+import reconciliation_handler
+import result_store
+
+BATCH_TYPES = ('SanLuong', 'TienMat')
+BATCH_RESULT_TYPE = 'Batch'  # reconcile_type của kết quả gộp trong result_store
+DAY_READERS = {
+    'SanLuong': reconciliation_handler.read_sse_product_xml_by_day,
+    'TienMat': reconciliation_handler.read_sse_cash_xml_by_day,
+}
+
+
+def batch_workers():
+    return max(1, int(os.getenv("RECONCILE_BATCH_WORKERS", "4")))
+
+def split_by_day(reconcile_type, file_stream, file_hash, year, month):
+    """
+    Đọc 1 file SSE và tách theo ngày → ({ngày: (sse_df, khoá nguồn)}, [cảnh báo]).
+    Khoá nguồn = hash file + ngày, dùng cho khoá ghi nhớ kết quả của từng ngày. Ngày ngoài tháng / không có thật bị bỏ qua.
+    """
+    frames = DAY_READERS[reconcile_type](file_stream)
+    if frames is None:
+        return None, [f"Định dạng file kế toán ({daily_reconcile.TYPE_LABELS[reconcile_type]}) không hợp lệ."]
+    days, warnings = {}, []
+    for date_dm, sse_df in frames.items():
+        day_num, month_num = (int(x) for x in date_dm.split('/'))
+        if month_num != int(month):
+            warnings.append(f"Bỏ qua ngày {date_dm} (ngoài tháng {month}/{year}).")
+            continue
+        try:
+            day = datetime(int(year), month_num, day_num)
+        except ValueError:
+            warnings.append(f"Bỏ qua ngày {date_dm} không hợp lệ (tháng {month}/{year}).")
+            continue
+        days[day] = (sse_df, f"{file_hash}:{date_dm}")
+    return days, warnings
+
+def run_batch(session, year, month, files, progress_callback=None, workers=None):
+    """
+    files: {loại: [(file nhị phân seek được, sha256, tên file)]} với loại thuộc BATCH_TYPES.
+    Trả về (records, days): records = mọi dòng kết quả kèm 'reconcile_date', 'reconcile_type' (theo ngày, loại);
+    days = [{'reconcile_date', 'reconcile_type', 'status', 'total', 'mismatches', 'cached', 'message'}] theo ngày, loại.
+    """
+    progress = progress_callback or (lambda msg: None)
+    workers = workers or batch_workers()
+
+    # 1) Đọc + tách theo ngày mọi file (song song); file sau đè ngày trùng của file trước
+    inputs = {t: {} for t in BATCH_TYPES}
+    jobs = [(t, stream, file_hash, name) for t in BATCH_TYPES for stream, file_hash, name in files.get(t, [])]
+    progress(f"... Đang đọc {len(jobs)} file Kế toán và tách theo ngày.....")
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        parsed = [pool.submit(split_by_day, t, stream, file_hash, year, month) for t, stream, file_hash, _ in jobs]
+        for (t, _, _, name), future in zip(jobs, parsed):
+            days, warnings = future.result()
+            for w in warnings:
+                progress(f"...... {name}: {w}")
+            for day, value in (days or {}).items():
+                if day in inputs[t]:
+                    progress(f"...... {name}: ngày {day:%d/%m} đã có ở file khác, dùng dữ liệu của file này.")
+                inputs[t][day] = value
+    all_days = sorted(set().union(*inputs.values()))
+    if not all_days:
+        return [], []
+    progress(f"... Có dữ liệu Kế toán của {len(all_days)} ngày. Đang tìm các báo cáo POS (BCBH) của tháng {month}/{year}.....")
+
+    # 2) Tìm Sheet BCBH của mọi ngày bằng 1 truy vấn Drive
+    folder_id = session.month_folder(all_days[0])
+    prefix, sheet_name = daily_reconcile.POS_SOURCES['SanLuong']
+    pos_files = session.find_sheets([f"{prefix}.{day:%d.%m.%Y}" for day in all_days], folder_id)
+
+    # 3) Đối soát từng ngày trong nhóm luồng: mỗi ngày đọc TongHopBCBH 1 lần cho mọi loại
+    def reconcile_one_day(day):
+        date_str, date_dmy = day.strftime('%Y-%m-%d'), day.strftime('%d.%m.%Y')
+        pos_file = pos_files.get(f"{prefix}.{date_dmy}")
+        outcomes, pos_values = [], None
+        for t in BATCH_TYPES:
+            if day not in inputs[t]:
+                continue
+            sse_df, source_key = inputs[t][day]
+            outcome = {'reconcile_date': date_str, 'reconcile_type': t, 'total': 0, 'mismatches': 0, 'cached': False, 'message': ''}
+            if pos_file is None:
+                outcomes.append(({**outcome, 'status': 'report_not_found', 'message': f"Không tìm thấy báo cáo POS ({prefix}) ngày {date_dmy}."}, []))
+                continue
+            try:
+                pos_version = {'id': pos_file['id'], 'modifiedTime': pos_file.get('modifiedTime')}
+                memo_key = reconcile_memo.result_key(t, source_key, pos_version if pos_version['modifiedTime'] else None, reconcile_date=date_str)
+                cached_id = reconcile_memo.lookup_result(memo_key)
+                results = result_store.load_records(cached_id)[0] if cached_id else None
+                if results is None:
+                    if pos_values is None:
+                        pos_values = session.sheet_values(pos_file, sheet_name)
+                    results = daily_reconcile.reconcile_frames(t, daily_reconcile.pos_frame(pos_values), sse_df)
+                    reconcile_memo.remember_result(memo_key, result_store.save(results, t, reconcile_date=date_str))
+                else:
+                    outcome['cached'] = True
+                mismatches = sum(1 for r in results if not r.get('is_match'))
+                outcomes.append(({**outcome, 'status': 'success', 'total': len(results), 'mismatches': mismatches}, results))
+            except Exception as e:
+                print(f"Lỗi khi đối soát {t} ngày {date_dmy}: {e}")
+                traceback.print_exc()
+                outcomes.append(({**outcome, 'status': 'error', 'message': f"Đã xảy ra lỗi không mong muốn: {str(e)}"}, []))
+        done = ", ".join(f"{o['reconcile_type']}: {o['mismatches']}/{o['total']} dòng lệch" if o['status'] == 'success' else f"{o['reconcile_type']}: {o['message']}"
+                         for o, _ in outcomes)
+        progress(f"...... Ngày {day:%d/%m/%Y} - {done}")
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        per_day = list(pool.map(reconcile_one_day, all_days))
+
+    records, days = [], []
+    for outcomes in per_day:
+        for outcome, results in outcomes:
+            days.append(outcome)
+            records.extend({'reconcile_date': outcome['reconcile_date'], 'reconcile_type': outcome['reconcile_type'], **r} for r in results)
+    return records, days
+
+def write_batch_workbook(df, days, target):
+    """
+    File Excel tổng hợp của 1 lần chạy batch (target: đường dẫn hoặc BytesIO):
+      TongHop  → mỗi (ngày, loại) 1 dòng: trạng thái, số dòng, số dòng lệch, ghi chú
+      SanLuong / TienMat → mọi dòng kết quả của các ngày, cột 'Ngày' đứng đầu
+    """
+    summary = pd.DataFrame(days, columns=['reconcile_date', 'reconcile_type', 'status', 'total', 'mismatches', 'cached', 'message'])
+    summary = summary.drop(columns='cached').rename(columns={'reconcile_date': 'Ngày', 'reconcile_type': 'Loại đối soát', 'status': 'Trạng thái',
+                                                             'total': 'Số dòng', 'mismatches': 'Số dòng lệch', 'message': 'Ghi chú'})
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        summary.to_excel(writer, index=False, sheet_name='TongHop')
+        for t in BATCH_TYPES:
+            part = df[df['reconcile_type'] == t] if 'reconcile_type' in df.columns else df.iloc[0:0]
+            if part.empty:
+                continue
+            column_names = result_store.RESULT_COLUMN_NAMES[t]
+            part = part.drop(columns='reconcile_type').dropna(axis=1, how='all').rename(columns={'reconcile_date': 'Ngày', **column_names})
+            if 'Khớp' in part.columns: part['Khớp'] = part['Khớp'].apply(lambda x: 'Khớp' if bool(x) else 'Lệch')
+            part.to_excel(writer, index=False, sheet_name=t)
+
+def save_batch(records, days, year, month):
+    """Lưu kết quả gộp vào result_store (tải Excel qua /download_excel/<id>, xem theo trang qua /reconcile_result/<id>/page)."""
+    return result_store.save(records, BATCH_RESULT_TYPE, year=int(year), month=int(month), days=days)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Đối soát Sản lượng + Tiền mặt nhiều ngày, ra 1 file Excel tổng hợp.")
+    p.add_argument("--year", type=int, required=True, help="Năm (vd: 2025)")
+    p.add_argument("--month", type=int, required=True, help="Tháng (1-12)")
+    p.add_argument("--sanluong", nargs="*", default=[], help="Các file XML sản lượng SSE (mỗi ngày 1 file hoặc 1 file nhiều ngày, nhận glob)")
+    p.add_argument("--tienmat", nargs="*", default=[], help="Các file XML tiền mặt SSE (nhận glob)")
+    p.add_argument("--output", help="File Excel kết quả (mặc định KetQuaDoiSoat_Thang_<MM>_<YYYY>.xlsx)")
+    p.add_argument("--workers", type=int, default=None, help="Số ngày đối soát song song (mặc định RECONCILE_BATCH_WORKERS=4)")
+    args = p.parse_args()
+    if not (1 <= args.month <= 12):
+        p.error("--month phải nằm trong 1..12")
+    return args
+
+def main():
+    args = parse_args()
+    paths = {t: sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+             for t, patterns in (('SanLuong', args.sanluong), ('TienMat', args.tienmat))}
+    if not any(paths.values()):
+        print("Lỗi: cần ít nhất 1 file --sanluong hoặc --tienmat")
+        sys.exit(2)
+
+    handles = []
+    try:
+        files = {}
+        for t, type_paths in paths.items():
+            for path in type_paths:
+                f = open(path, 'rb')
+                handles.append(f)
+                files.setdefault(t, []).append((f, reconcile_memo.file_digest(f), os.path.basename(path)))
+        print(f"===> Đối soát batch tháng {args.month}/{args.year}: {sum(len(v) for v in files.values())} file")
+        records, days = run_batch(daily_reconcile.PosSession(), args.year, args.month, files, progress_callback=print, workers=args.workers)
+    finally:
+        for f in handles:
+            f.close()
+
+    if not days:
+        print("Không có ngày nào thuộc tháng đã chọn trong các file kế toán.")
+        sys.exit(1)
+    output = args.output or f"KetQuaDoiSoat_Thang_{args.month:02d}_{args.year}.xlsx"
+    write_batch_workbook(pd.DataFrame(records), days, output)
+    failed = [d for d in days if d['status'] != 'success']
+    print(f"\n===> Hoàn tất: {len(days)} lượt đối soát ({len(failed)} lỗi/thiếu báo cáo POS), "
+          f"{sum(d['mismatches'] for d in days)} dòng lệch. File kết quả: {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,901 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks.py
+Đo nhanh hiệu năng các đường xử lý dữ liệu chính trên dữ liệu giả lập (không cần mạng,
+trừ khi bật --live).
+
+Cách dùng:
+  1) So sánh đường nạp BigQuery cũ (DataFrame → load_table_from_dataframe) với đường mới
+     (pyarrow.Table → Parquet nén → load với schema tường minh):
+     python benchmarks.py bq-upload --rows 200000
+     python benchmarks.py bq-upload --rows 200000 --live   # nạp thật vào bảng nháp trên BigQuery
+
+  2) So sánh 2 engine đối soát HoaDon (SQL FULL OUTER JOIN vs hash-join pandas), kiểm tra kết quả giống hệt:
+     python benchmarks.py reconcile-invoice --rows 200000                 # kho HD01 cục bộ giả lập (DuckDB)
+     python benchmarks.py reconcile-invoice --live --tax-file bangke.xlsx  # BigQuery thật, tháng lấy theo bảng kê
+
+  3) Đọc Bảng kê Thuế: 2 lượt pd.read_excel trên bytes trong RAM (cũ) vs 1 lượt openpyxl read_only trên file tạm (mới),
+     mỗi cách chạy trong 1 tiến trình riêng để đo RSS đỉnh:
+     (đo thêm 1 bản sao có thẻ <dimension> ghi sai "A1" - nhiều phần mềm xuất file như vậy)
+     python benchmarks.py tax-excel --rows 150000
+     python benchmarks.py tax-excel --file bangke_that.xlsx
+
+  4) Đọc file SpreadsheetML (XML) của SSE: giải mã cả file + ElementTree (cũ) vs lxml.iterparse theo luồng (mới):
+     python benchmarks.py sse-xml --rows 300000
+     python benchmarks.py sse-xml --file so_cong_no_ca_nam.xml
+
+  5) Đối soát Sản lượng / Tiền mặt theo CHXD: vòng lặp iterrows + lọc pos_df từng dòng (cũ) vs ghép bảng (mới),
+     trên bảng ánh xạ giả lập nhiều chi nhánh:
+     python benchmarks.py reconcile-store --stores 3000
+
+  6) Đối soát Công nợ cả tỉnh: lọc + groupby cho từng cửa hàng (cũ) vs 1 lượt ghép theo mã và theo tên (mới):
+     python benchmarks.py reconcile-debt --stores 150 --customers 300
+     python benchmarks.py reconcile-debt --stores 40 --customers 3000 --threshold 0.85   # kèm ghép gần đúng tên KH
+
+  7) Đối soát Sản lượng + Tiền mặt cả tháng: từng ngày × loại qua /reconcile tuần tự (cũ) vs batch_reconcile (mới),
+     lệnh gọi Google giả lập có độ trễ:
+     python benchmarks.py reconcile-batch --stores 300 --days 30 --latency 0.2 --workers 4
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+
+def _fmt_bytes(n):
+    return f"{n / 1024 / 1024:,.2f} MB"
+
+
+def _timeit(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+# =====================================================================
+# DỮ LIỆU GIẢ LẬP
+# =====================================================================
+def make_hd01_frame(rows: int, seed: int = 1) -> pd.DataFrame:
+    """Sinh DataFrame giống đầu ra processor_hd01.process_hd01 (số dạng chuỗi có dấu phẩy như file gốc)."""
+    rnd = random.Random(seed)
+    products = ['Xăng RON95 Mức 3', 'Xăng E5 RON92 Mức 2', 'Dầu Điêzen 0,001S Mức 5', 'Dầu Điêzen 0,05S Mức 2', 'Dầu mỡ nhờn']
+    statuses = ['Hoàn thành', 'Thay thế', 'Bị thay thế', 'Điều chỉnh tăng']
+    qty = [rnd.uniform(1, 500) for _ in range(rows)]
+    price = [rnd.choice([19850, 20540, 18900, 21000]) for _ in range(rows)]
+    return pd.DataFrame({
+        'Tên CHXD': 'CHXD Giả lập',
+        'Ký hiệu': [f"1C25T{rnd.choice('AB')}A" for _ in range(rows)],
+        'Số HĐ': [str(i + 1) for i in range(rows)],
+        'Ngày hóa đơn': [f"2025-08-{rnd.randint(1, 28):02d}" for _ in range(rows)],
+        'Trạng thái HĐ': [rnd.choice(statuses) for _ in range(rows)],
+        'Loại HĐ': [rnd.choice(['Hóa đơn bán lẻ', 'Hóa đơn chuyển thẳng']) for _ in range(rows)],
+        'Mã tra cứu': [f"TC{rnd.getrandbits(40):x}" for _ in range(rows)],
+        'Số GD': [str(rnd.getrandbits(30)) for _ in range(rows)],
+        'Mã khách hàng': [f"KH{rnd.randint(1, 3000):05d}" for _ in range(rows)],
+        'Tên khách hàng': [f"Khách hàng {rnd.randint(1, 3000)}" for _ in range(rows)],
+        'Mã số thuế': [str(rnd.randint(10**9, 10**10 - 1)) for _ in range(rows)],
+        'Hàng hóa': [rnd.choice(products) for _ in range(rows)],
+        'ĐVT': 'Lít',
+        'Số lượng': [f"{q:,.3f}" for q in qty],
+        'Đơn giá': [f"{p:,}" for p in price],
+        'Thành tiền (chưa thuế)': [f"{q * p / 1.1:,.0f}" for q, p in zip(qty, price)],
+        'Tiền thuế': [f"{q * p / 11:,.0f}" for q, p in zip(qty, price)],
+        'Tổng tiền thanh toán': [f"{q * p:,.0f}" for q, p in zip(qty, price)],
+    })
+
+
+# =====================================================================
+# BQ-UPLOAD: ĐƯỜNG NẠP CŨ vs ARROW/PARQUET
+# =====================================================================
+def _legacy_prepare(df, store_code, report_month, report_year):
+    """Bản sao đường chuẩn bị dữ liệu cũ của bq_handler.upload_dataframe (trước khi có đường Arrow)."""
+    import bq_handler
+    df['Nam_Bao_Cao'] = int(report_year)
+    df['Thang_Bao_Cao'] = int(report_month)
+    df['Mã_CHXD'] = store_code
+    df_bq = df.rename(columns=bq_handler.COLUMN_MAPPING)
+    for col in ['So_Luong', 'Don_Gia', 'Tien_Chua_Thue', 'Tien_Thue', 'Tong_Tien']:
+        if col in df_bq.columns:
+            df_bq[col] = pd.to_numeric(df_bq[col].astype(str).str.replace(',', '').str.replace(' ', ''), errors='coerce').fillna(0)
+    valid_cols = list(bq_handler.COLUMN_MAPPING.values())
+    return df_bq[[c for c in valid_cols if c in df_bq.columns]].copy()
+
+
+def _legacy_serialize(df_bq):
+    """Tuần tự hoá giống load_table_from_dataframe: suy luận kiểu từ pandas rồi ghi Parquet (SNAPPY)."""
+    import bq_handler
+    buf = io.BytesIO()
+    try:
+        from google.cloud.bigquery import _pandas_helpers
+        _pandas_helpers.dataframe_to_parquet(df_bq, bq_handler.HD01_SCHEMA, buf, parquet_compression="SNAPPY")
+    except Exception:
+        df_bq.to_parquet(buf, compression="snappy", index=False)
+    return buf.getbuffer().nbytes
+
+
+def _arrow_serialize(arrow_table):
+    import bq_handler
+    import pyarrow.parquet as pq
+    buf = io.BytesIO()
+    pq.write_table(arrow_table, buf, compression=bq_handler.PARQUET_COMPRESSION)
+    return buf.tell()
+
+
+def bench_bq_upload(args):
+    import bq_handler
+    df = make_hd01_frame(args.rows)
+    print(f"Dữ liệu giả lập: {len(df):,} dòng HD01")
+
+    df_bq, t_prep_old = _timeit(_legacy_prepare, df.copy(), 'ND.CHXD99', 8, 2025)
+    size_old, t_ser_old = _timeit(_legacy_serialize, df_bq)
+    table, t_prep_new = _timeit(bq_handler._to_arrow_table, df, 'ND.CHXD99', 8, 2025)
+    size_new, t_ser_new = _timeit(_arrow_serialize, table)
+
+    print(f"{'Đường nạp':<28}{'Chuẩn bị':>12}{'Tuần tự hoá':>14}{'Byte đẩy lên':>16}")
+    print(f"{'Cũ (pandas → dataframe)':<28}{t_prep_old:>11.3f}s{t_ser_old:>13.3f}s{_fmt_bytes(size_old):>16}")
+    print(f"{'Mới (Arrow → Parquet ' + bq_handler.PARQUET_COMPRESSION + ')':<28}{t_prep_new:>11.3f}s{t_ser_new:>13.3f}s{_fmt_bytes(size_new):>16}")
+
+    if args.live:
+        from google.cloud import bigquery
+        client = bq_handler.get_bq_client()
+        scratch_id = bq_handler._table_id(client, "HD01_Bench_Upload")
+        client.create_table(bigquery.Table(scratch_id, schema=bq_handler.HD01_SCHEMA), exists_ok=True)
+        try:
+            cfg = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE", schema=bq_handler.HD01_SCHEMA)
+            _, t_load_old = _timeit(lambda: client.load_table_from_dataframe(df_bq, scratch_id, job_config=cfg).result())
+            _, t_load_new = _timeit(bq_handler._load_arrow_table, client, table, scratch_id, "WRITE_TRUNCATE")
+            print(f"Thời gian load job BigQuery: cũ {t_load_old:.2f}s | mới {t_load_new:.2f}s")
+        finally:
+            client.delete_table(scratch_id, not_found_ok=True)
+
+
+# =====================================================================
+# RECONCILE-INVOICE: ENGINE SQL vs HASH-JOIN PANDAS
+# =====================================================================
+def make_tax_frame(hd01_df: pd.DataFrame, seed: int = 2) -> pd.DataFrame:
+    """Bảng kê Thuế giả lập (đã chuẩn hoá như read_tax_excel_file) từ HD01: phần lớn khớp, 1 ít lệch tiền/MST/tên, thiếu và thừa."""
+    rnd = random.Random(seed)
+    tax = pd.DataFrame({
+        'KyHieu': hd01_df['Ký hiệu'], 'SoHD': hd01_df['Số HĐ'],
+        'KhachHang': hd01_df['Tên khách hàng'], 'MST': hd01_df['Mã số thuế'],
+        'TienChuaThue': pd.to_numeric(hd01_df['Thành tiền (chưa thuế)'].str.replace(',', ''), errors='coerce'),
+        'TienThue': pd.to_numeric(hd01_df['Tiền thuế'].str.replace(',', ''), errors='coerce'),
+        'TongTien': pd.to_numeric(hd01_df['Tổng tiền thanh toán'].str.replace(',', ''), errors='coerce'),
+    }).sample(frac=0.98, random_state=seed).reset_index(drop=True)
+    for i in rnd.sample(range(len(tax)), len(tax) // 50):
+        col = rnd.choice(['TongTien', 'MST', 'KhachHang'])
+        tax.at[i, col] = tax.at[i, col] + 5 if col == 'TongTien' else f"{tax.at[i, col]} X"
+    extra = tax.head(len(tax) // 100).assign(SoHD=lambda d: 'X' + d['SoHD'])
+    tax = pd.concat([tax, extra], ignore_index=True)
+    tax['HD_ID'] = tax['KyHieu'].str.strip() + "_" + tax['SoHD'].str.strip().str.lstrip('0')
+    return tax
+
+
+def _same_results(a, b):
+    key = lambda r: (r['is_match'], str(r['chxd_name']), r['invoice_id'], r['status'])
+    return sorted(a, key=key) == sorted(b, key=key)
+
+
+def bench_reconcile_invoice(args):
+    import reconciliation_handler
+    if args.live:
+        if not args.tax_file:
+            raise SystemExit("--live cần --tax-file <bảng kê Thuế .xlsx>")
+        with open(args.tax_file, 'rb') as f:
+            tax, month, year = reconciliation_handler.read_tax_excel_file(io.BytesIO(f.read()))
+    else:
+        os.environ.update(HD01_BACKEND="local", HD01_CACHE="0", HD01_LOCAL_DIR=tempfile.mkdtemp(prefix="hd01_bench_"),
+                          HD01_MANIFEST_CACHE=os.path.join(tempfile.mkdtemp(prefix="hd01_bench_"), "manifest.json"))
+        import bq_handler
+        month, year = 8, 2025
+        hd01 = make_hd01_frame(args.rows)
+        bq_handler.replace_month_data({'ND.CHXD99': hd01}, month, year)
+        tax = make_tax_frame(hd01)
+    print(f"Bảng kê Thuế: {len(tax):,} dòng | tháng {month}/{year} | backend HD01: {os.getenv('HD01_BACKEND', 'bigquery')}")
+
+    sql_results, t_sql = _timeit(reconciliation_handler.reconcile_invoice_data_bq, month, year, tax, engine="sql")
+    pd_results, t_pd = _timeit(reconciliation_handler.reconcile_invoice_data_bq, month, year, tax, engine="pandas")
+    print(f"{'Engine':<34}{'Thời gian':>12}{'Dòng kết quả':>14}")
+    print(f"{'SQL (FULL OUTER JOIN)':<34}{t_sql:>11.3f}s{len(sql_results):>14,}")
+    print(f"{'pandas (hash-join theo HD_ID)':<34}{t_pd:>11.3f}s{len(pd_results):>14,}")
+    print("Kết quả 2 engine giống hệt nhau." if _same_results(sql_results, pd_results) else "CẢNH BÁO: kết quả 2 engine KHÁC nhau!")
+
+
+# =====================================================================
+# TAX-EXCEL: ĐỌC BẢNG KÊ THUẾ 2 LƯỢT (pandas) vs 1 LƯỢT (openpyxl read_only)
+# =====================================================================
+def make_tax_excel(path: str, rows: int, seed: int = 3):
+    """Sinh file Bảng kê Thuế giả lập: vài dòng tiêu đề, dòng STT, cột người bán + người mua như file tải từ cổng thuế."""
+    from openpyxl import Workbook
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['BẢNG KÊ HÓA ĐƠN, CHỨNG TỪ HÀNG HÓA, DỊCH VỤ BÁN RA'])
+    ws.append(['Kỳ tính thuế: Tháng 08 năm 2025'])
+    ws.append([])
+    ws.append(['STT', 'Ký hiệu mẫu số', 'Ký hiệu hóa đơn', 'Số hóa đơn', 'Ngày lập', 'MST người bán', 'Tên người bán',
+               'MST người mua', 'Tên người mua', 'Tổng tiền chưa thuế', 'Tổng tiền thuế', 'Chiết khấu', 'Tổng tiền thanh toán',
+               'Đơn vị tiền tệ', 'Tỷ giá', 'Trạng thái hóa đơn', 'Kết quả kiểm tra hóa đơn'])
+    for i in range(rows):
+        amount = rnd.randint(50, 5000) * 1000
+        ws.append([i + 1, 1, f"C25T{rnd.choice('AB')}A", i + 1, f"{rnd.randint(1, 28):02d}/08/2025", '0100100079', 'Tổng công ty Dầu Việt Nam',
+                   str(rnd.randint(10**9, 10**10 - 1)), f"Khách hàng {rnd.randint(1, 3000)}", amount, amount // 10, 0, amount + amount // 10,
+                   'VND', 1, 'Hóa đơn mới', 'Đã cấp mã hóa đơn'])
+    wb.save(path)
+
+
+def make_stale_dimension_copy(path: str, target: str):
+    """Bản sao file .xlsx với thẻ <dimension> của các sheet bị ghi sai thành "A1" (như nhiều phần mềm xuất file)."""
+    import re
+    import zipfile
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            data = src.read(item.filename)
+            if item.filename.startswith('xl/worksheets/') and item.filename.endswith('.xml'):
+                data, replaced = re.subn(rb'<dimension ref="[^"]*"\s*/>', b'<dimension ref="A1"/>', data, count=1)
+                if not replaced:  # openpyxl write_only không ghi thẻ này → chèn vào đúng chỗ theo schema (trước sheetViews/sheetData)
+                    data = re.sub(rb'(<sheetViews|<sheetFormatPr|<cols|<sheetData)', rb'<dimension ref="A1"/>\1', data, count=1)
+            dst.writestr(item, data)
+
+
+def _legacy_read_tax_excel(file_stream):
+    """Bản sao đường đọc cũ của read_tax_excel_file: 30 dòng xem trước + đọc lại cả sheet với usecols, dtype=str."""
+    import reconciliation_handler as rh
+    df_preview = pd.read_excel(file_stream, header=None, nrows=30)
+    header_idx = next(i for i in range(len(df_preview))
+                      if rh._is_tax_header([rh._vn_normalize(str(x)) for x in df_preview.iloc[i].values if pd.notna(x)]))
+    col_indices = rh._resolve_tax_columns([rh._vn_normalize(str(x)) for x in df_preview.iloc[header_idx].values])
+    sorted_indices = sorted(col_indices.values())
+    file_stream.seek(0)
+    tax_df = pd.read_excel(file_stream, header=header_idx, usecols=sorted_indices, dtype=str)
+    tax_df.columns = [next(k for k, v in col_indices.items() if v == idx) for idx in sorted_indices]
+    return rh._finalize_tax_frame(tax_df)
+
+
+def _tax_excel_worker(path, method):
+    """Chạy trong tiến trình con: đọc file theo 1 cách, in JSON {thời gian, RSS đỉnh, số dòng, checksum kết quả}."""
+    import hashlib
+    import resource
+    import reconciliation_handler
+    t0 = time.perf_counter()
+    if method == "legacy":
+        with open(path, 'rb') as f:
+            file_bytes = f.read()  # /reconcile cũ giữ nguyên file upload trong RAM
+        tax_df, _, _ = _legacy_read_tax_excel(io.BytesIO(file_bytes))
+    else:
+        with open(path, 'rb') as f:
+            tax_df, _, _ = reconciliation_handler.read_tax_excel_file(f)
+    elapsed = time.perf_counter() - t0
+    digest = hashlib.sha1(pd.util.hash_pandas_object(tax_df.reset_index(drop=True), index=False).values.tobytes()).hexdigest()
+    print(json.dumps({'seconds': elapsed, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'rows': len(tax_df), 'digest': digest}))
+
+
+def bench_tax_excel(args):
+    if args.worker:
+        return _tax_excel_worker(args.file, args.worker)
+    path = args.file
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(prefix="tax_bench_"), "bangke.xlsx")
+        make_tax_excel(path, args.rows)
+    stale_path = os.path.join(tempfile.mkdtemp(prefix="tax_bench_"), "bangke_dimension_A1.xlsx")
+    make_stale_dimension_copy(path, stale_path)
+
+    for file_label, file_path in (("File", path), ("Cùng file, thẻ <dimension> ghi sai 'A1'", stale_path)):
+        print(f"{file_label}: {file_path} ({_fmt_bytes(os.path.getsize(file_path))})")
+        results = {}
+        for method in ("legacy", "stream"):
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "tax-excel", "--file", file_path, "--worker", method],
+                                  capture_output=True, text=True)
+            lines = proc.stdout.strip().splitlines()
+            results[method] = json.loads(lines[-1]) if proc.returncode == 0 and lines else None
+        print(f"{'Cách đọc':<36}{'Thời gian':>12}{'RSS đỉnh':>14}{'Số dòng':>10}")
+        for method, label in (("legacy", "Cũ: 2 lượt pd.read_excel (RAM)"), ("stream", "Mới: 1 lượt openpyxl read_only")):
+            r = results[method]
+            if r is None:
+                print(f"{label:<36}{'LỖI - không đọc được file':>36}")
+                continue
+            print(f"{label:<36}{r['seconds']:>11.2f}s{_fmt_bytes(r['max_rss_kb'] * 1024):>14}{r['rows']:>10,}")
+        same = all(results.values()) and results["legacy"]["digest"] == results["stream"]["digest"]
+        print("Kết quả 2 cách đọc giống hệt nhau.\n" if same else "CẢNH BÁO: kết quả 2 cách đọc KHÁC nhau!\n")
+
+
+# =====================================================================
+# SSE-XML: ĐỌC SPREADSHEETML CẢ FILE (ElementTree) vs THEO LUỒNG (lxml.iterparse)
+# =====================================================================
+def make_sse_debt_xml(path: str, rows: int, seed: int = 4):
+    """Sinh file 'Sổ đối chiếu công nợ' SpreadsheetML giả lập: nhóm theo CHXD, mỗi CHXD 200 khách hàng."""
+    from xml.sax.saxutils import escape
+    rnd = random.Random(seed)
+
+    def row(values):
+        cells = ''.join('<Cell/>' if v is None else f'<Cell><Data ss:Type="String">{escape(str(v))}</Data></Cell>' for v in values)
+        return f'<Row>{cells}</Row>\n'
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<?mso-application progid="Excel.Sheet"?>\n'
+                '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" xmlns:o="urn:schemas-microsoft-com:office:office" '
+                'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet" xmlns:html="http://www.w3.org/TR/REC-html40">\n'
+                '<Worksheet ss:Name="Sheet1"><Table>\n')
+        f.write(row(['SỔ ĐỐI CHIẾU CÔNG NỢ']))
+        f.write(row(['STT', 'Mã khách', 'Tên khách', 'Dư nợ đầu kỳ', 'Phát sinh nợ', 'Phát sinh có', 'Dư nợ cuối kỳ']))
+        f.write(row(['', '', '', '1', '2', '3', '4']))
+        for i in range(rows):
+            if i % 200 == 0:
+                f.write(row(['', f"KDNL{i // 200:03d}", f"CHXD Số {i // 200} (Cửa hàng xăng dầu)", None, None, None, None]))
+            f.write(row([str(i % 200 + 1), f"KH{rnd.randint(1, 99999):05d}", f"Khách hàng {rnd.randint(1, 99999)}",
+                         '0', str(rnd.randint(0, 10**8)), '0', '0']))
+        f.write('</Table></Worksheet></Workbook>\n')
+
+
+def _legacy_spreadsheetml_rows(xml_bytes):
+    """Bản sao cách đọc cũ của read_sse_*_xml: giải mã cả file, bỏ namespace bằng str.replace, dựng cây ElementTree."""
+    import xml.etree.ElementTree as ET
+    try:
+        xml_content = xml_bytes.decode('utf-8')
+    except UnicodeDecodeError:
+        xml_content = xml_bytes.decode('windows-1252')
+    xml_content = xml_content.replace('xmlns="urn:schemas-microsoft-com:office:spreadsheet"', '')
+    root = ET.fromstring(xml_content)
+    return [[cell.findtext("Data") for cell in row.findall("Cell")] for row in root.findall(".//Table/Row")]
+
+
+def _sse_xml_worker(path, method):
+    """
+    Chạy trong tiến trình con: đọc hết các dòng theo 1 cách, in JSON {thời gian, RSS đỉnh, số dòng, checksum}.
+    Thời gian chỉ tính phần đọc file (đã trừ thời gian băm checksum các dòng).
+    """
+    import hashlib
+    import resource
+    import reconciliation_handler
+    t0 = time.perf_counter()
+    digest, count = hashlib.sha1(), 0
+    if method == "legacy":
+        with open(path, 'rb') as f:
+            rows = _legacy_spreadsheetml_rows(f.read())
+    else:
+        f = open(path, 'rb')
+        rows = reconciliation_handler.iter_spreadsheetml_rows(f)
+    digest_seconds = 0.0
+    for r in rows:
+        t1 = time.perf_counter()
+        digest.update(repr(r).encode('utf-8'))
+        count += 1
+        digest_seconds += time.perf_counter() - t1
+    elapsed = time.perf_counter() - t0 - digest_seconds
+    print(json.dumps({'seconds': elapsed, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'rows': count, 'digest': digest.hexdigest()}))
+
+
+def bench_sse_xml(args):
+    if args.worker:
+        return _sse_xml_worker(args.file, args.worker)
+    path = args.file
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(prefix="sse_bench_"), "so_cong_no.xml")
+        make_sse_debt_xml(path, args.rows)
+    print(f"File: {path} ({_fmt_bytes(os.path.getsize(path))})")
+
+    results = {}
+    for method in ("legacy", "stream"):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "sse-xml", "--file", path, "--worker", method],
+                             capture_output=True, text=True, check=True).stdout
+        results[method] = json.loads(out.strip().splitlines()[-1])
+    print(f"{'Cách đọc':<36}{'Thời gian':>12}{'RSS đỉnh':>14}{'Số dòng':>10}")
+    for method, label in (("legacy", "Cũ: decode + ElementTree cả file"), ("stream", "Mới: lxml.iterparse theo luồng")):
+        r = results[method]
+        print(f"{label:<36}{r['seconds']:>11.2f}s{_fmt_bytes(r['max_rss_kb'] * 1024):>14}{r['rows']:>10,}")
+    same = results["legacy"]["digest"] == results["stream"]["digest"]
+    print("Các dòng đọc được giống hệt nhau." if same else "Các dòng đọc được KHÁC nhau (file có ss:Index/MergeAcross mà cách cũ bỏ qua?).")
+
+
+# =====================================================================
+# RECONCILE-STORE: ĐỐI SOÁT SẢN LƯỢNG / TIỀN MẶT THEO CHXD (VÒNG LẶP CŨ vs GHÉP BẢNG)
+# =====================================================================
+def make_store_config(stores: int, seed: int = 5):
+    """Bảng ánh xạ CHXD giả lập cho nhiều chi nhánh + file SSE/POS sản lượng và tiền mặt tương ứng."""
+    import config
+    rnd = random.Random(seed)
+    products = config.TARGET_PRODUCTS_BH03
+    store_info = {f"CN{i % 12:02d}.CHXD{i:05d}": f"CHXD Chi nhánh {i % 12} - Số {i}" for i in range(stores)}
+    codes = list(store_info)
+    product_map = {f"KDNL{i:05d}": code for i, code in enumerate(codes)}
+    cash_map = {f"DV{i:05d}": code for i, code in enumerate(codes)}
+
+    def value():
+        return rnd.choice([0.0, 0.0, float(rnd.randint(1, 5000))])
+
+    sse_product, sse_cash = [], []
+    for i in range(stores):
+        for _ in range(2 if rnd.random() < 0.02 else (0 if rnd.random() < 0.05 else 1)):
+            sse_product.append({'sse_ma_khach': f"KDNL{i:05d}", **{p: value() for p in products if p != products[1]}})
+            sse_cash.append({'sse_ma_dv': f"DV{i:05d}", 'sse_tien_mat': value()})
+    for i in range(stores // 20):
+        sse_product.append({'sse_ma_khach': f"KH{i:05d}", **{p: value() for p in products if p != products[1]}})
+        sse_cash.append({'sse_ma_dv': f"KH{i:05d}", 'sse_tien_mat': value()})
+    rnd.shuffle(sse_product)
+
+    pos_rows = []
+    for name in store_info.values():
+        for _ in range(0 if rnd.random() < 0.05 else 1):
+            pos_rows.append({'Tên CHXD': name, **{p: f"{value():,.0f}".replace(',', '.') for p in products}, 'Tiền mặt': f"{value():,.0f}".replace(',', '.')})
+    pos_rows.append({'Tên CHXD': 'CHXD ngoài danh mục', **{p: '1' for p in products}, 'Tiền mặt': '1'})
+    return store_info, product_map, cash_map, pd.DataFrame(sse_product), pd.DataFrame(sse_cash), pd.DataFrame(pos_rows)
+
+
+def _legacy_reconcile_product_data(pos_df, sse_df):
+    """Bản sao cách đối soát sản lượng cũ (iterrows + lọc pos_df từng dòng) để so sánh."""
+    import config
+    from reconciliation_handler import clean_and_convert_to_numeric
+    for product in config.TARGET_PRODUCTS_BH03:
+        if product in pos_df.columns:
+            pos_df[product] = clean_and_convert_to_numeric(pos_df[product])
+    results = []
+    all_pos_chxd_names = set(config.STORE_INFO.values())
+    processed = set()
+    sse2pos = {sse: config.STORE_INFO.get(pos) for sse, pos in config.STORE_MAPPING_SSE_TO_POS.items() if config.STORE_INFO.get(pos)}
+    for _, r in sse_df.iterrows():
+        pos_name = sse2pos.get(r['sse_ma_khach'])
+        if not pos_name:
+            continue
+        processed.add(pos_name)
+        prows = pos_df[pos_df['Tên CHXD'] == pos_name]
+        if prows.empty:
+            for p in config.TARGET_PRODUCTS_BH03:
+                if r.get(p, 0) != 0:
+                    results.append({"chxd_name": f"{pos_name} (Không có trên POS)", "product_name": p, "pos_value": "N/A", "sse_value": float(r.get(p,0)), "is_match": False})
+            continue
+        for p in config.TARGET_PRODUCTS_BH03:
+            pv = prows.iloc[0].get(p, 0); sv = r.get(p, 0)
+            ok = int(pv) == int(sv)
+            if not ok or pv != 0 or sv != 0:
+                results.append({"chxd_name": pos_name, "product_name": p, "pos_value": float(pv), "sse_value": float(sv), "is_match": ok})
+    for ch in (all_pos_chxd_names - processed):
+        prows = pos_df[pos_df['Tên CHXD'] == ch]
+        if not prows.empty:
+            for p in config.TARGET_PRODUCTS_BH03:
+                pv = prows.iloc[0].get(p, 0)
+                if pv != 0:
+                    results.append({"chxd_name": f"{ch} (Không có trên file KT)", "product_name": p, "pos_value": float(pv), "sse_value": "N/A", "is_match": False})
+    return results
+
+
+def _legacy_reconcile_cash_data(pos_df, sse_df):
+    """Bản sao cách đối soát tiền mặt cũ để so sánh."""
+    import config
+    from reconciliation_handler import clean_and_convert_to_numeric
+    if 'Tiền mặt' in pos_df.columns:
+        pos_df['Tiền mặt'] = clean_and_convert_to_numeric(pos_df['Tiền mặt'])
+    else:
+        pos_df['Tiền mặt'] = 0
+    results = []
+    all_pos_names = set(config.STORE_INFO.values()); processed = set()
+    sse2pos = {sse: config.STORE_INFO.get(pos) for sse,pos in config.STORE_MAPPING_CASH_SSE_TO_POS.items() if config.STORE_INFO.get(pos)}
+    for _, r in sse_df.iterrows():
+        pos_name = sse2pos.get(r['sse_ma_dv'])
+        if not pos_name: continue
+        processed.add(pos_name)
+        prow = pos_df[pos_df['Tên CHXD'] == pos_name]
+        sse_cash = r.get('sse_tien_mat', 0); pos_cash = 0
+        if prow.empty:
+            if sse_cash != 0:
+                results.append({"chxd_name": f"{pos_name} (Không có trên POS)","product_name":"Tiền mặt","pos_value":"N/A","sse_value":float(sse_cash),"is_match":False})
+            continue
+        pos_cash = prow.iloc[0].get('Tiền mặt', 0)
+        ok = int(pos_cash) == int(sse_cash)
+        if not ok or pos_cash != 0 or sse_cash != 0:
+            results.append({"chxd_name": pos_name,"product_name":"Tiền mặt","pos_value":float(pos_cash),"sse_value":float(sse_cash),"is_match":ok})
+    for ch in (all_pos_names - processed):
+        prow = pos_df[pos_df['Tên CHXD'] == ch]
+        if not prow.empty:
+            pos_cash = prow.iloc[0].get('Tiền mặt', 0)
+            if pos_cash != 0:
+                results.append({"chxd_name": f"{ch} (Không có trên file KT)","product_name":"Tiền mặt","pos_value":float(pos_cash),"sse_value":"N/A","is_match":False})
+    return results
+
+
+def _same_store_results(old, new):
+    """Phần theo dòng SSE phải trùng từng bản ghi, đúng thứ tự; phần 'Không có trên file KT' cách cũ duyệt theo set (thứ tự ngẫu nhiên) nên so như tập hợp."""
+    split = lambda rs: ([r for r in rs if not r['chxd_name'].endswith("(Không có trên file KT)")],
+                        sorted(repr(r) for r in rs if r['chxd_name'].endswith("(Không có trên file KT)")))
+    return split(old) == split(new)
+
+
+def bench_reconcile_store(args):
+    import config
+    import reconciliation_handler
+    store_info, product_map, cash_map, sse_product, sse_cash, pos_df = make_store_config(args.stores)
+    config.STORE_INFO, config.STORE_MAPPING_SSE_TO_POS, config.STORE_MAPPING_CASH_SSE_TO_POS = store_info, product_map, cash_map
+    print(f"CHXD: {len(store_info):,} | dòng SSE sản lượng: {len(sse_product):,} | dòng SSE tiền mặt: {len(sse_cash):,} | dòng POS: {len(pos_df):,}")
+
+    print(f"{'Loại đối soát':<16}{'Cũ (iterrows)':>16}{'Mới (ghép bảng)':>18}{'Bản ghi':>10}  Kết quả")
+    for label, legacy, current, sse_df in (
+            ("Sản lượng", _legacy_reconcile_product_data, reconciliation_handler.reconcile_product_data, sse_product),
+            ("Tiền mặt", _legacy_reconcile_cash_data, reconciliation_handler.reconcile_cash_data, sse_cash)):
+        old, t_old = _timeit(legacy, pos_df.copy(), sse_df)
+        new, t_new = _timeit(current, pos_df.copy(), sse_df)
+        verdict = "giống hệt" if _same_store_results(old, new) else "KHÁC NHAU!"
+        print(f"{label:<16}{t_old:>15.3f}s{t_new:>17.3f}s{len(new):>10,}  {verdict}")
+
+
+# =====================================================================
+# RECONCILE-DEBT: ĐỐI SOÁT CÔNG NỢ TỪNG CỬA HÀNG (CŨ) vs 1 LƯỢT GHÉP CHO CẢ TỈNH (MỚI)
+# =====================================================================
+def make_debt_frames(stores: int, customers: int, seed: int = 6):
+    """Sheet TongHopCongNo (POS) + DataFrame đã đọc từ XML công nợ SSE giả lập cho cả tỉnh."""
+    from reconciliation_handler import _canon_store_display, _canon_store_key
+    rnd = random.Random(seed)
+    words = ["Vận tải Minh Phát", "Xây dựng Hoàng Long", "Thương mại Đại Nam", "Nông sản Thành Công"]
+    pos_rows, sse_rows = [], []
+    for s in range(stores):
+        store = f"CHXD Số {s}" + (" (Cửa hàng)" if s % 3 == 0 else "")
+        on_pos, on_sse = rnd.random() > 0.02, rnd.random() > 0.02
+        if on_pos:
+            pos_rows.append([store, '', ''])
+        for c in range(customers):
+            code = rnd.choice([f"KH{s:03d}{c:04d}", f"KH{s:03d}{c:04d}", '', 'Không tìm thấy mã khách'])
+            name = rnd.choice([f"Khách hàng {c}", f"Khach Hang {c}", "Khách hàng chung", f"Công ty TNHH {rnd.choice(words)} {c}"])
+            value = rnd.choice([0, 0, rnd.randint(1, 10**6)])
+            if on_pos and rnd.random() > 0.03:
+                pos_rows.append([name, code, f"{value:,}".replace(',', '.')])
+            if on_sse and rnd.random() > 0.03:
+                sse_code = '' if code == 'Không tìm thấy mã khách' else code.replace('KH0', 'KHO') if rnd.random() < 0.1 else code
+                sse_value = value if rnd.random() > 0.05 else value + 1000
+                sse_name = name.upper() if rnd.random() < 0.05 else name
+                if rnd.random() < 0.05:  # gõ khác/thiếu 1 chút: 'Cty' thay 'Công ty', mất 1 ký tự
+                    sse_name = sse_name.replace("Công ty", "Cty") if "Công ty" in sse_name else sse_name[:3] + sse_name[4:]
+                sse_rows.append([_canon_store_display(store), _canon_store_key(store), sse_code, sse_name, float(sse_value)])
+    pos_df = pd.DataFrame(pos_rows, columns=['Tên Khách hàng', 'Mã khách hàng', 'Phát sinh nợ'])
+    sse_df = pd.DataFrame(sse_rows, columns=['store_display', 'store_key', 'sse_ma_khach', 'sse_ten_khach', 'sse_phat_sinh_no'])
+    return pos_df, sse_df
+
+
+def _legacy_pos_expand_store_from_tonghop(pos_df: pd.DataFrame) -> pd.DataFrame:
+    from reconciliation_handler import _norm_key
+    cols_needed = ['Tên Khách hàng', 'Mã khách hàng', 'Phát sinh nợ']
+    for c in cols_needed:
+        if c not in pos_df.columns:
+            raise KeyError(f"Thiếu cột bắt buộc trong POS: '{c}'")
+    records = []
+    current_store = None
+    for _, row in pos_df.iterrows():
+        ten_kh = str(row['Tên Khách hàng']).strip()
+        if _norm_key(ten_kh).startswith('chxd'):
+            current_store = ten_kh
+            continue
+        if not current_store:
+            continue
+        records.append({
+            'Cửa hàng': current_store,
+            'Tên Khách hàng': ten_kh,
+            'Mã khách hàng': ('' if pd.isna(row['Mã khách hàng']) else str(row['Mã khách hàng']).strip()),
+            'Phát sinh nợ': row['Phát sinh nợ']
+        })
+    df = pd.DataFrame(records) if records else pd.DataFrame(columns=['Cửa hàng','Tên Khách hàng','Mã khách hàng','Phát sinh nợ'])
+    return df
+
+def _legacy_reconcile_debt_data(pos_df: pd.DataFrame, sse_df: pd.DataFrame):
+    """Bản sao cách đối soát công nợ cũ (lọc lại POS/SSE và groupby cho từng cửa hàng) để so sánh."""
+    from reconciliation_handler import _canon_store_display, _canon_store_key, _norm_code, _norm_key, clean_and_convert_to_numeric
+    pos = _legacy_pos_expand_store_from_tonghop(pos_df)
+
+    pos['Cửa hàng'] = pos['Cửa hàng'].astype(str).map(_canon_store_display)
+    pos['store_key'] = pos['Cửa hàng'].map(_canon_store_key)
+    pos['Mã khách hàng'] = pos['Mã khách hàng'].fillna('').astype(str).str.strip()
+    pos['Phát sinh nợ'] = clean_and_convert_to_numeric(pos['Phát sinh nợ'])
+    pos = pos[~pos['Tên Khách hàng'].astype(str).str.strip().str.lower().isin(
+        ['khách hàng chung','khach hang chung','công nợ chung','cong no chung']
+    )].copy()
+
+    sse = sse_df.copy()
+    sse['store_display'] = sse['store_display'].astype(str)
+    sse['store_key'] = sse['store_key'].astype(str)
+    sse['sse_ma_khach'] = sse['sse_ma_khach'].fillna('').astype(str).str.strip()
+    sse['sse_ten_khach'] = sse['sse_ten_khach'].fillna('').astype(str).str.strip()
+    sse['sse_phat_sinh_no'] = pd.to_numeric(sse['sse_phat_sinh_no'], errors='coerce').fillna(0).round(0)
+
+    results = []
+
+    all_keys = sorted(set(pos['store_key']).union(set(sse['store_key'])))
+
+    for skey in all_keys:
+        pos_store = pos[pos['store_key'] == skey]
+        sse_store = sse[sse['store_key'] == skey]
+
+        if pos_store.empty and sse_store.empty:
+            continue
+
+        display_name = pos_store['Cửa hàng'].iloc[0] if not pos_store.empty else sse_store['store_display'].iloc[0]
+
+        # 1) Ghép theo MÃ KH
+        pos_by_code = (pos_store[pos_store['Mã khách hàng'] != '']
+                       .groupby(['Mã khách hàng','Tên Khách hàng'], as_index=False)['Phát sinh nợ'].sum())
+        sse_by_code = (sse_store[sse_store['sse_ma_khach'] != '']
+                       .groupby(['sse_ma_khach','sse_ten_khach'], as_index=False)['sse_phat_sinh_no'].sum())
+
+        pos_code_map = {_norm_code(r['Mã khách hàng']):(r['Tên Khách hàng'], float(r['Phát sinh nợ'])) for _,r in pos_by_code.iterrows()}
+        sse_code_map = {_norm_code(r['sse_ma_khach']):(r['sse_ten_khach'], float(r['sse_phat_sinh_no'])) for _,r in sse_by_code.iterrows()}
+
+        codes = set(pos_code_map.keys()).union(set(sse_code_map.keys()))
+        matched_pos_names = set(); matched_sse_names = set()
+
+        for c in sorted(codes):
+            pn, pv = pos_code_map.get(c, (None, 0.0))
+            sn, sv = sse_code_map.get(c, (None, 0.0))
+            cname = pn or sn or ''
+            ok = int(round(pv)) == int(round(sv))
+            status = ''
+            if c not in pos_code_map:
+                status = 'Có trên file KT, thiếu trên POS'
+            elif c not in sse_code_map:
+                status = 'Có trên POS, thiếu trên file KT'
+            if (not ok) or (pv != 0) or (sv != 0):
+                results.append({
+                    'chxd_name': display_name,
+                    'customer_code': c,
+                    'customer_name': cname,
+                    'pos_value': float(round(pv)),
+                    'sse_value': float(round(sv)),
+                    'is_match': ok,
+                    'status': status
+                })
+            if pn: matched_pos_names.add(_norm_key(pn))
+            if sn: matched_sse_names.add(_norm_key(sn))
+
+        # 2) Ghép theo TÊN
+        pos_no_code = pos_store[(pos_store['Mã khách hàng'] == '') | (pos_store['Mã khách hàng'].str.lower() == 'không tìm thấy mã khách')] \
+                                .groupby('Tên Khách hàng', as_index=False)['Phát sinh nợ'].sum()
+        sse_no_code = sse_store[sse_store['sse_ma_khach'] == ''] \
+                                .groupby('sse_ten_khach', as_index=False)['sse_phat_sinh_no'].sum()
+
+        pos_name_map = {_norm_key(r['Tên Khách hàng']):(r['Tên Khách hàng'], float(r['Phát sinh nợ'])) for _,r in pos_no_code.iterrows()}
+        sse_name_map = {_norm_key(r['sse_ten_khach']):(r['sse_ten_khach'], float(r['sse_phat_sinh_no'])) for _,r in sse_no_code.iterrows()}
+
+        names = set(pos_name_map.keys()).union(set(sse_name_map.keys()))
+        for nk in sorted(names):
+            if nk in matched_pos_names or nk in matched_sse_names:
+                continue
+            pn, pv = pos_name_map.get(nk, ('', 0.0))
+            sn, sv = sse_name_map.get(nk, ('', 0.0))
+            disp = pn or sn
+            ok = int(round(pv)) == int(round(sv))
+            status = ''
+            if nk not in pos_name_map:
+                status = 'Có trên file KT, thiếu trên POS (không mã)'
+            elif nk not in sse_name_map:
+                status = 'Có trên POS, thiếu trên file KT (không mã)'
+            if (not ok) or (pv != 0) or (sv != 0):
+                results.append({
+                    'chxd_name': display_name,
+                    'customer_code': '',
+                    'customer_name': disp,
+                    'pos_value': float(round(pv)),
+                    'sse_value': float(round(sv)),
+                    'is_match': ok,
+                    'status': status
+                })
+
+    return results
+
+
+def bench_reconcile_debt(args):
+    import contextlib
+    import reconciliation_handler
+    pos_df, sse_df = make_debt_frames(args.stores, args.customers)
+    print(f"Cửa hàng: {args.stores:,} | dòng POS: {len(pos_df):,} | dòng SSE: {len(sse_df):,}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        os.environ["DEBT_FUZZY_THRESHOLD"] = "0"
+        exact, t_exact = _timeit(reconciliation_handler.reconcile_debt_data, pos_df.copy(), sse_df)
+        os.environ["DEBT_FUZZY_THRESHOLD"] = str(args.threshold)
+        fuzzy, t_fuzzy = _timeit(reconciliation_handler.reconcile_debt_data, pos_df.copy(), sse_df)
+        old, t_old = _timeit(_legacy_reconcile_debt_data, pos_df.copy(), sse_df)
+    print(f"{'Cách đối soát':<44}{'Thời gian':>12}{'Bản ghi':>10}")
+    print(f"{'Cũ: lọc + groupby từng cửa hàng':<44}{t_old:>11.3f}s{len(old):>10,}")
+    print(f"{'Mới: 1 lượt ghép theo mã và theo tên':<44}{t_exact:>11.3f}s{len(exact):>10,}")
+    print(f"{f'Mới + ghép gần đúng tên (ngưỡng {args.threshold})':<44}{t_fuzzy:>11.3f}s{len(fuzzy):>10,}")
+    same = [{k: v for k, v in r.items() if k != 'match_confidence'} for r in exact] == old
+    print("Ghép chính xác: kết quả giống hệt cách cũ (cả thứ tự)." if same else "CẢNH BÁO: kết quả KHÁC cách cũ!")
+    scores = [r['match_confidence'] for r in fuzzy if r['match_confidence'] is not None and r['match_confidence'] < 1]
+    one_sided = lambda rs: sum(1 for r in rs if r['status'].startswith('Có trên'))
+    print(f"Ghép gần đúng: {len(scores):,} cặp (độ tin cậy thấp nhất {min(scores, default=0):.0%}), "
+          f"dòng lệch 1 phía: {one_sided(exact):,} → {one_sided(fuzzy):,}")
+
+
+# =====================================================================
+# RECONCILE-BATCH: ĐỐI SOÁT TỪNG NGÀY TUẦN TỰ (CŨ) vs BATCH CẢ THÁNG (MỚI)
+# =====================================================================
+def _write_spreadsheetml(path, rows):
+    from xml.sax.saxutils import escape
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" '
+                'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet"><Worksheet ss:Name="Sheet1"><Table>\n')
+        for values in rows:
+            cells = ''.join('<Cell/>' if v is None else f'<Cell><Data ss:Type="String">{escape(str(v))}</Data></Cell>' for v in values)
+            f.write(f'<Row>{cells}</Row>\n')
+        f.write('</Table></Worksheet></Workbook>\n')
+
+
+def make_month_files(folder: str, stores: int, year: int, month: int, days: int, seed: int = 7):
+    """
+    File SSE cả tháng giả lập: sản lượng mỗi ngày 1 file (cách cũ) + 1 file nhiều ngày (cùng số liệu),
+    tiền mặt 1 file nhiều cột 'Bán - dd/mm'; kèm giá trị Sheet TongHopBCBH của từng ngày.
+    """
+    import config
+    rnd = random.Random(seed)
+    store_info, product_map, cash_map, _, _, _ = make_store_config(stores)
+    products = {'Dầu Điêzen 0,001S Mức 5': 'Dầu DO 0,001S-V', 'Dầu Điêzen 0,05S Mức 2': 'DO', 'Xăng RON95 Mức 3': 'Xăng A95', 'Xăng E5 RON92 Mức 2': 'Xăng E5'}
+    dates = [f"{d:02d}/{month:02d}" for d in range(1, days + 1)]
+    value = lambda: rnd.choice([0, 0, rnd.randint(1, 5000)])
+    product_values = {dm: {code: {p: value() for p in products} for code in product_map} for dm in dates}
+    cash_values = {dm: {code: value() for code in cash_map} for dm in dates}
+
+    def product_rows(day_list):
+        header = ['STT', 'Mã khách', 'Tên khách'] + [f"Ngày {dm} {suffix}" for dm in day_list for suffix in products.values()]
+        rows = [['BÁO CÁO SẢN LƯỢNG'], header, [''] * len(header)]
+        for i, code in enumerate(product_map):
+            rows.append([str(i + 1), code, f"Khách {code}"] + [str(product_values[dm][code][p]) for dm in day_list for p in products])
+        return rows
+
+    per_day_paths = []
+    for dm in dates:
+        path = os.path.join(folder, f"sanluong_{dm.replace('/', '')}.xml")
+        _write_spreadsheetml(path, product_rows([dm]))
+        per_day_paths.append(path)
+    month_product_path = os.path.join(folder, "sanluong_thang.xml")
+    _write_spreadsheetml(month_product_path, product_rows(dates))
+    cash_path = os.path.join(folder, "tienmat_thang.xml")
+    cash_header = ['STT', 'Mã ĐV', 'Tên ĐV'] + [f"Bán - {dm}" for dm in dates]
+    _write_spreadsheetml(cash_path, [['BÁO CÁO TIỀN MẶT'], cash_header, [''] * len(cash_header)] +
+                         [[str(i + 1), code, f"ĐV {code}"] + [str(cash_values[dm][code]) for dm in dates] for i, code in enumerate(cash_map)])
+
+    pos_columns = ['Tên CHXD'] + list(config.TARGET_PRODUCTS_BH03) + ['Tiền mặt']
+    pos_values = {}
+    for dm in dates:
+        rows = [pos_columns]
+        for pcode, ccode in zip(product_map, cash_map):
+            name = store_info[product_map[pcode]]
+            drift = lambda v: v if rnd.random() < 0.9 else v + 1
+            rows.append([name] + [str(drift(product_values[dm][pcode].get(p, 0))) for p in config.TARGET_PRODUCTS_BH03] + [str(drift(cash_values[dm][ccode]))])
+        pos_values[datetime(year, month, int(dm[:2]))] = rows
+    return (store_info, product_map, cash_map), per_day_paths, month_product_path, cash_path, pos_values
+
+
+class _FakePosSession:
+    """Thay daily_reconcile.PosSession: mỗi lệnh gọi Google tốn 'latency' giây, đếm số lệnh đã gọi."""
+
+    def __init__(self, pos_values, latency):
+        import threading
+        self.pos_values, self.latency, self.calls = pos_values, latency, 0
+        self._lock = threading.Lock()
+        self._call()  # xác thực
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def month_folder(self, day):
+        self._call(); self._call()  # thư mục Năm + Tháng
+        return "month-folder"
+
+    def find_sheets(self, names, folder_id):
+        self._call()
+        by_name = {f"BCBH.{day:%d.%m.%Y}": day for day in self.pos_values}
+        return {n: {'id': n, 'name': n, 'modifiedTime': None} for n in names if n in by_name}
+
+    def sheet_values(self, pos_file, sheet_name):
+        self._call()
+        return self.pos_values[datetime.strptime(pos_file['id'][len("BCBH."):], '%d.%m.%Y')]
+
+
+def bench_reconcile_batch(args):
+    import contextlib
+    import config
+    import batch_reconcile
+    import daily_reconcile
+    import reconciliation_handler
+    tmp = tempfile.mkdtemp()
+    os.environ["RECONCILE_MEMO"] = "0"
+    os.environ["RECONCILE_RESULT_DIR"] = os.path.join(tmp, "results")
+    (store_info, product_map, cash_map), per_day_paths, month_product_path, cash_path, pos_values = \
+        make_month_files(tmp, args.stores, 2025, 8, args.days)
+    config.STORE_INFO, config.STORE_MAPPING_SSE_TO_POS, config.STORE_MAPPING_CASH_SSE_TO_POS = store_info, product_map, cash_map
+    print(f"CHXD: {len(store_info):,} | số ngày: {args.days} | độ trễ mỗi lệnh Google giả lập: {args.latency}s | luồng batch: {args.workers}")
+
+    def legacy():
+        """Cách cũ: mỗi ngày × loại 1 lần /reconcile - xác thực, tìm thư mục, mở Sheet, đọc lại file, đối soát tuần tự."""
+        results, calls = {}, 0
+        for day, path in zip(sorted(pos_values), per_day_paths):
+            for t in batch_reconcile.BATCH_TYPES:
+                session = _FakePosSession(pos_values, args.latency)
+                session.month_folder(day)
+                session._call(); session._call()  # gspread.open: tìm file trên Drive + đọc metadata bảng tính
+                values = session.sheet_values({'id': f"BCBH.{day:%d.%m.%Y}"}, 'TongHopBCBH')
+                calls += session.calls
+                with open(path if t == 'SanLuong' else cash_path, 'rb') as f:
+                    sse_df = (reconciliation_handler.read_sse_product_xml(f) if t == 'SanLuong'
+                              else reconciliation_handler.read_sse_cash_xml(f, day))
+                results[(day.strftime('%Y-%m-%d'), t)] = daily_reconcile.reconcile_frames(t, daily_reconcile.pos_frame(values), sse_df)
+        return results, calls
+
+    def batch():
+        session = _FakePosSession(pos_values, args.latency)
+        with open(month_product_path, 'rb') as fp, open(cash_path, 'rb') as fc:
+            files = {'SanLuong': [(fp, "sl", "sanluong_thang.xml")], 'TienMat': [(fc, "tm", "tienmat_thang.xml")]}
+            records, days = batch_reconcile.run_batch(session, 2025, 8, files, workers=args.workers)
+        grouped = {}
+        for r in records:
+            grouped.setdefault((r['reconcile_date'], r['reconcile_type']), []).append(
+                {k: v for k, v in r.items() if k not in ('reconcile_date', 'reconcile_type')})
+        return grouped, days, session.calls
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        (old, old_calls), t_old = _timeit(legacy)
+        (new, days, new_calls), t_new = _timeit(batch)
+    print(f"{'Cách chạy':<48}{'Thời gian':>12}{'Lệnh Google':>14}")
+    print(f"{'Cũ: từng ngày × loại qua /reconcile, tuần tự':<48}{t_old:>11.2f}s{old_calls:>14,}")
+    print(f"{'Mới: batch cả tháng, đọc file 1 lượt, nhóm luồng':<48}{t_new:>11.2f}s{new_calls:>14,}")
+    out = os.path.join(tmp, "KetQuaDoiSoat_Thang_08_2025.xlsx")
+    _, t_xlsx = _timeit(batch_reconcile.write_batch_workbook, pd.DataFrame(
+        [{'reconcile_date': d, 'reconcile_type': t, **r} for (d, t), rs in new.items() for r in rs]), days, out)
+    same = {k: v for k, v in old.items() if v} == {k: v for k, v in new.items() if v}
+    print(f"Kết quả từng ngày: {'giống hệt cách cũ' if same else 'KHÁC cách cũ!'} ({len(days)} lượt, "
+          f"{sum(d['mismatches'] for d in days):,} dòng lệch). File tổng hợp: {_fmt_bytes(os.path.getsize(out))}, ghi trong {t_xlsx:.2f}s")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Đo hiệu năng các đường xử lý dữ liệu PVOIL.")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    p_up = sub.add_parser("bq-upload", help="So sánh đường nạp BigQuery cũ và đường Arrow/Parquet.")
+    p_up.add_argument("--rows", type=int, default=100000, help="Số dòng HD01 giả lập (mặc định 100000)")
+    p_up.add_argument("--live", action="store_true", help="Nạp thật vào bảng nháp trên BigQuery để đo thời gian load job")
+    p_up.set_defaults(func=bench_bq_upload)
+
+    p_inv = sub.add_parser("reconcile-invoice", help="So sánh engine đối soát HoaDon SQL và pandas.")
+    p_inv.add_argument("--rows", type=int, default=100000, help="Số dòng HD01 giả lập (mặc định 100000)")
+    p_inv.add_argument("--live", action="store_true", help="Dùng dữ liệu HD01 thật trên BigQuery (cần --tax-file)")
+    p_inv.add_argument("--tax-file", help="File Excel bảng kê Thuế (dùng với --live)")
+    p_inv.set_defaults(func=bench_reconcile_invoice)
+
+    p_tax = sub.add_parser("tax-excel", help="So sánh cách đọc Bảng kê Thuế cũ (2 lượt) và mới (1 lượt, read_only).")
+    p_tax.add_argument("--rows", type=int, default=100000, help="Số dòng bảng kê giả lập (mặc định 100000)")
+    p_tax.add_argument("--file", help="Dùng file bảng kê có sẵn thay cho dữ liệu giả lập")
+    p_tax.add_argument("--worker", choices=["legacy", "stream"], help=argparse.SUPPRESS)
+    p_tax.set_defaults(func=bench_tax_excel)
+
+    p_xml = sub.add_parser("sse-xml", help="So sánh cách đọc file SpreadsheetML của SSE cũ (cả file) và mới (theo luồng).")
+    p_xml.add_argument("--rows", type=int, default=200000, help="Số dòng khách hàng giả lập (mặc định 200000)")
+    p_xml.add_argument("--file", help="Dùng file XML có sẵn thay cho dữ liệu giả lập")
+    p_xml.add_argument("--worker", choices=["legacy", "stream"], help=argparse.SUPPRESS)
+    p_xml.set_defaults(func=bench_sse_xml)
+
+    p_store = sub.add_parser("reconcile-store", help="So sánh đối soát Sản lượng/Tiền mặt cũ (iterrows) và mới (ghép bảng).")
+    p_store.add_argument("--stores", type=int, default=3000, help="Số CHXD giả lập trên bảng ánh xạ (mặc định 3000)")
+    p_store.set_defaults(func=bench_reconcile_store)
+
+    p_debt = sub.add_parser("reconcile-debt", help="So sánh đối soát Công nợ cũ (từng cửa hàng) và mới (1 lượt ghép).")
+    p_debt.add_argument("--stores", type=int, default=150, help="Số cửa hàng giả lập (mặc định 150)")
+    p_debt.add_argument("--customers", type=int, default=300, help="Số khách hàng mỗi cửa hàng (mặc định 300)")
+    p_debt.add_argument("--threshold", type=float, default=0.85, help="Ngưỡng ghép gần đúng tên (mặc định 0.85)")
+    p_debt.set_defaults(func=bench_reconcile_debt)
+
+    p_batch = sub.add_parser("reconcile-batch", help="So sánh đối soát từng ngày tuần tự (cũ) và batch cả tháng (mới).")
+    p_batch.add_argument("--stores", type=int, default=300, help="Số CHXD giả lập (mặc định 300)")
+    p_batch.add_argument("--days", type=int, default=30, help="Số ngày trong tháng (mặc định 30)")
+    p_batch.add_argument("--latency", type=float, default=0.2, help="Độ trễ giả lập mỗi lệnh gọi Google, giây (mặc định 0.2)")
+    p_batch.add_argument("--workers", type=int, default=4, help="Số ngày đối soát song song (mặc định 4)")
+    p_batch.set_defaults(func=bench_reconcile_batch)
+
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
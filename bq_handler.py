@@ -1,9 +1,28 @@
 # -*- coding: utf-8 -*-
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import io
 import google_handler
+import bq_query
+import query_cache
+import ingest_manifest
 import json
 import os
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+DATASET_ID = "pvoil_data"
+MASTER_TABLE = "HD01_Master_Data"
+CURRENT_TABLE = "HD01_Current"  # Bản hiện hành đã khử trùng lặp, cập nhật ngay lúc nạp
+ROLLUP_TABLE = "HD01_Monthly_Rollup"  # Tổng hợp sẵn CHXD × Nhóm hàng × Trạng thái theo tháng, cập nhật ngay lúc nạp
+MANIFEST_TABLE = "HD01_Ingest_Manifest"  # Sổ nạp: mỗi lát (Năm, Tháng, CHXD) 1 dòng - kiểm tra tồn tại/độ phủ không cần quét hóa đơn
+TAX_STAGING_TABLE = "Tax_Staging"  # Bảng kê Thuế của các lần đối soát HoaDon, mỗi lần 1 Session_Id; partition theo ngày tự hết hạn
+TAX_STAGING_EXPIRATION_DAYS = 2  # tính từ đầu ngày (UTC) của partition → đủ rộng cho request chạy qua nửa đêm
+STAGING_TTL_MINUTES = 60
+PARQUET_COMPRESSION = "zstd"
 
 # =====================================================================
 # BẢNG ÁNH XẠ (MAPPING) TÊN CỘT
@@ -32,6 +51,124 @@ COLUMN_MAPPING = {
     'Tổng tiền thanh toán': 'Tong_Tien'
 }
 
+# =====================================================================
+# LƯỢC ĐỒ (SCHEMA) BẢNG HD01 - DÙNG CHUNG CHO TẠO BẢNG VÀ NẠP PARQUET
+# =====================================================================
+HD01_SCHEMA = [
+    bigquery.SchemaField("Nam_Bao_Cao", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Thang_Bao_Cao", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Ma_CHXD", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Ten_CHXD", "STRING"),
+    bigquery.SchemaField("Ky_Hieu", "STRING"),
+    bigquery.SchemaField("So_HD", "STRING"),
+    bigquery.SchemaField("Ngay_Hoa_Don", "STRING"),
+    bigquery.SchemaField("Trang_Thai_HD", "STRING"),
+    bigquery.SchemaField("Loai_HD", "STRING"),
+    bigquery.SchemaField("Ma_Tra_Cuu", "STRING"),
+    bigquery.SchemaField("So_GD", "STRING"),
+    bigquery.SchemaField("Ma_Khach_Hang", "STRING"),
+    bigquery.SchemaField("Ten_Khach_Hang", "STRING"),
+    bigquery.SchemaField("Ma_So_Thue", "STRING"),
+    bigquery.SchemaField("Hang_Hoa", "STRING"),
+    bigquery.SchemaField("DVT", "STRING"),
+    bigquery.SchemaField("So_Luong", "FLOAT"),
+    bigquery.SchemaField("Don_Gia", "FLOAT"),
+    bigquery.SchemaField("Tien_Chua_Thue", "FLOAT"),
+    bigquery.SchemaField("Tien_Thue", "FLOAT"),
+    bigquery.SchemaField("Tong_Tien", "FLOAT"),
+    # Kỳ báo cáo = ngày 1 của (Năm, Tháng): cột phân vùng theo tháng, mỗi tháng của mỗi năm là 1 partition riêng
+    bigquery.SchemaField("Ky_Bao_Cao", "DATE", mode="REQUIRED"),
+]
+
+MANIFEST_SCHEMA = [
+    bigquery.SchemaField("Nam_Bao_Cao", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Thang_Bao_Cao", "INTEGER", mode="REQUIRED"),
+    bigquery.SchemaField("Ky_Bao_Cao", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("Ma_CHXD", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("Ten_CHXD", "STRING"),
+    bigquery.SchemaField("So_Dong", "INTEGER"),
+    bigquery.SchemaField("Checksum", "STRING"),
+    bigquery.SchemaField("Loaded_At", "TIMESTAMP"),
+]
+
+TAX_STAGING_SCHEMA = [
+    bigquery.SchemaField("Ngay_Nap", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("Session_Id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("KyHieu", "STRING"),
+    bigquery.SchemaField("SoHD", "STRING"),
+    bigquery.SchemaField("KhachHang", "STRING"),
+    bigquery.SchemaField("MST", "STRING"),
+    bigquery.SchemaField("TienChuaThue", "FLOAT"),
+    bigquery.SchemaField("TienThue", "FLOAT"),
+    bigquery.SchemaField("TongTien", "FLOAT"),
+    bigquery.SchemaField("HD_ID", "STRING"),
+]
+
+# Phân vùng theo Ky_Bao_Cao (MONTH) + gom cụm theo CHXD, Hàng hóa - dùng chung cho bảng chính, HD01_Current và các lệnh CTAS
+PARTITION_FIELD = "Ky_Bao_Cao"
+CLUSTER_FIELDS = ["Ma_CHXD", "Hang_Hoa"]
+PARTITION_DDL = f"PARTITION BY DATE_TRUNC({PARTITION_FIELD}, MONTH) CLUSTER BY {', '.join(CLUSTER_FIELDS)}"
+
+def period_filter(report_month, report_year):
+    """Điều kiện lọc 1 kỳ báo cáo trên cột phân vùng - BigQuery chỉ quét đúng 1 partition tháng/năm đó."""
+    return f"{PARTITION_FIELD} = DATE({int(report_year)}, {int(report_month)}, 1)"
+
+# Bản có tham số của period_filter: cùng 1 câu SQL cho mọi kỳ → BigQuery dùng lại được cache kết quả, vẫn cắt partition
+PERIOD_FILTER_SQL = f"{PARTITION_FIELD} = DATE(@nam, @thang, 1)"
+
+def period_params(report_month, report_year):
+    return {'nam': int(report_year), 'thang': int(report_month)}
+
+# Quy tắc khử trùng lặp hóa đơn (giữ bản mới nhất theo CHXD + Ký hiệu + Số HĐ).
+# Chỉ còn áp dụng lúc nạp/dựng lại HD01_Current; các truy vấn đọc không phải trả chi phí sắp xếp cửa sổ nữa.
+DEDUP_QUALIFY = "QUALIFY ROW_NUMBER() OVER(PARTITION BY Nam_Bao_Cao, Thang_Bao_Cao, Ma_CHXD, Ky_Hieu, So_HD ORDER BY Ngay_Hoa_Don DESC) = 1"
+
+VALID_STATUSES_SQL = "('hoàn thành', 'thay thế', 'điều chỉnh tăng', 'điều chỉnh giảm', 'bị thay thế', 'bị điều chỉnh')"
+TARGET_PRODUCTS_SQL = "('Xăng RON95 Mức 3', 'Xăng E5 RON92 Mức 2', 'Dầu Điêzen 0,001S Mức 5', 'Dầu Điêzen 0,05S Mức 2', 'Xăng E10 RON95 Mức 3')"
+AGG_METRICS = ['So_Luong_Dong', 'Tong_San_Luong', 'Tien_Chua_Thue', 'Tien_Thue', 'Tong_Thanh_Toan', 'SL_ChuyenThang', 'SL_NoiBo']
+
+def _rollup_select_sql(source_sql, where_sql):
+    """
+    Câu SELECT tổng hợp CHXD × Nhóm hàng × Trạng thái (hợp lệ) - dùng chung cho refresh lúc nạp, dựng lại bảng rollup
+    và kho cục bộ (source_sql là tên bảng đã quote sẵn theo từng engine).
+    """
+    return f"""
+        SELECT
+            Ky_Bao_Cao,
+            Nam_Bao_Cao,
+            Thang_Bao_Cao,
+            Ma_CHXD,
+            Ten_CHXD,
+            CASE 
+                WHEN TRIM(Hang_Hoa) IN {TARGET_PRODUCTS_SQL} THEN TRIM(Hang_Hoa)
+                ELSE 'Mặt hàng khác'
+            END AS Nhom_Hang,
+            LOWER(TRIM(Trang_Thai_HD)) AS Trang_Thai_Lower,
+            COUNT(1) AS So_Luong_Dong,
+            SUM(So_Luong) AS Tong_San_Luong,
+            SUM(Tien_Chua_Thue) AS Tien_Chua_Thue,
+            SUM(Tien_Thue) AS Tien_Thue,
+            SUM(Tong_Tien) AS Tong_Thanh_Toan,
+            SUM(CASE WHEN LOWER(Loai_HD) LIKE '%chuyển thẳng%' THEN So_Luong ELSE 0 END) AS SL_ChuyenThang,
+            SUM(CASE WHEN Ma_So_Thue LIKE '%0600759399%' THEN So_Luong ELSE 0 END) AS SL_NoiBo
+        FROM {source_sql}
+        WHERE LOWER(TRIM(Trang_Thai_HD)) IN {VALID_STATUSES_SQL}
+          AND {where_sql}
+        GROUP BY Ky_Bao_Cao, Nam_Bao_Cao, Thang_Bao_Cao, Ma_CHXD, Ten_CHXD, Nhom_Hang, Trang_Thai_Lower
+    """
+
+_ARROW_TYPES = {"INTEGER": pa.int64(), "FLOAT": pa.float64(), "STRING": pa.string(), "DATE": pa.date32()}
+HD01_ARROW_SCHEMA = pa.schema([pa.field(f.name, _ARROW_TYPES[f.field_type], nullable=(f.mode != "REQUIRED")) for f in HD01_SCHEMA])
+TAX_STAGING_ARROW_SCHEMA = pa.schema([pa.field(f.name, _ARROW_TYPES[f.field_type], nullable=(f.mode != "REQUIRED")) for f in TAX_STAGING_SCHEMA])
+
+def hd01_backend():
+    """Engine trả lời các truy vấn HD01: 'bigquery' (mặc định) hoặc 'local' (DuckDB trên Parquet - xem local_store.py)."""
+    return os.getenv("HD01_BACKEND", "bigquery").strip().lower()
+
+def local_mirror_enabled():
+    """Backend BigQuery nhưng vẫn ghi thêm bản cục bộ mỗi lần nạp, để có thể chuyển sang 'local' bất cứ lúc nào."""
+    return os.getenv("HD01_LOCAL_MIRROR", "0").strip().lower() in ("1", "true", "yes")
+
 def get_bq_client():
     creds = google_handler.get_google_credentials()
     project_id = None
@@ -50,130 +187,486 @@ def get_bq_client():
         
     return bigquery.Client(credentials=creds, project=project_id)
 
+def _table_id(client, table_name):
+    return f"{client.project}.{DATASET_ID}.{table_name}"
+
+def _hd01_table(table_id):
+    table = bigquery.Table(table_id, schema=HD01_SCHEMA)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.MONTH, field=PARTITION_FIELD)
+    table.clustering_fields = CLUSTER_FIELDS
+    return table
+
 def init_bq_table():
+    if hd01_backend() == "local": return None
     client = get_bq_client()
-    dataset_id = f"{client.project}.pvoil_data"
-    table_id = f"{dataset_id}.HD01_Master_Data"
+    dataset_id = f"{client.project}.{DATASET_ID}"
+    table_id = _table_id(client, MASTER_TABLE)
     dataset = bigquery.Dataset(dataset_id)
     dataset.location = "asia-southeast1"
     dataset = client.create_dataset(dataset, exists_ok=True)
 
-    schema = [
-        bigquery.SchemaField("Nam_Bao_Cao", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("Thang_Bao_Cao", "INTEGER", mode="REQUIRED"),
-        bigquery.SchemaField("Ma_CHXD", "STRING", mode="REQUIRED"),
-        bigquery.SchemaField("Ten_CHXD", "STRING"),
-        bigquery.SchemaField("Ky_Hieu", "STRING"),
-        bigquery.SchemaField("So_HD", "STRING"),
-        bigquery.SchemaField("Ngay_Hoa_Don", "STRING"),
-        bigquery.SchemaField("Trang_Thai_HD", "STRING"),
-        bigquery.SchemaField("Loai_HD", "STRING"),
-        bigquery.SchemaField("Ma_Tra_Cuu", "STRING"),
-        bigquery.SchemaField("So_GD", "STRING"),
-        bigquery.SchemaField("Ma_Khach_Hang", "STRING"),
-        bigquery.SchemaField("Ten_Khach_Hang", "STRING"),
-        bigquery.SchemaField("Ma_So_Thue", "STRING"),
-        bigquery.SchemaField("Hang_Hoa", "STRING"),
-        bigquery.SchemaField("DVT", "STRING"),
-        bigquery.SchemaField("So_Luong", "FLOAT"),
-        bigquery.SchemaField("Don_Gia", "FLOAT"),
-        bigquery.SchemaField("Tien_Chua_Thue", "FLOAT"),
-        bigquery.SchemaField("Tien_Thue", "FLOAT"),
-        bigquery.SchemaField("Tong_Tien", "FLOAT"),
-    ]
-    table = bigquery.Table(table_id, schema=schema)
-    table.range_partitioning = bigquery.RangePartitioning(
-        field="Thang_Bao_Cao",
-        range_=bigquery.PartitionRange(start=1, end=13, interval=1)
-    )
-    table.clustering_fields = ["Ma_CHXD"]
+    master = client.create_table(_hd01_table(table_id), exists_ok=True)
+    if not any(f.name == PARTITION_FIELD for f in master.schema):
+        raise RuntimeError(f"Bảng {MASTER_TABLE} còn phân vùng kiểu cũ (theo Thang_Bao_Cao). Hãy chạy: python bq_maintenance.py migrate-partitioning")
+    try:
+        client.get_table(_table_id(client, CURRENT_TABLE))
+    except NotFound:
+        # Lần đầu: dựng bảng hiện hành từ toàn bộ dữ liệu đã có để các truy vấn đọc không bị thiếu
+        client.create_table(_hd01_table(_table_id(client, CURRENT_TABLE)))
+        rebuild_current_table(client)
+    try:
+        client.get_table(_table_id(client, ROLLUP_TABLE))
+    except NotFound:
+        rebuild_rollup_table(client)
+    try:
+        client.get_table(_table_id(client, MANIFEST_TABLE))
+    except NotFound:
+        # Lần đầu: ghi sổ nạp cho các lát đã có sẵn trong bảng chính (không có checksum)
+        rebuild_manifest_table(client)
+    _ensure_tax_staging_table(client)
+    return table_id
+
+_tax_staging_ready = set()
+
+def _ensure_tax_staging_table(client):
+    """Tạo bảng Tax_Staging 1 lần (partition theo Ngay_Nap, tự xoá sau TAX_STAGING_EXPIRATION_DAYS, cụm theo Session_Id)."""
+    table_id = _table_id(client, TAX_STAGING_TABLE)
+    if table_id in _tax_staging_ready:
+        return table_id
+    table = bigquery.Table(table_id, schema=TAX_STAGING_SCHEMA)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="Ngay_Nap",
+                                                        expiration_ms=TAX_STAGING_EXPIRATION_DAYS * 24 * 3600 * 1000)
+    table.require_partition_filter = True
+    table.clustering_fields = ["Session_Id"]
     client.create_table(table, exists_ok=True)
+    _tax_staging_ready.add(table_id)
     return table_id
 
+def stage_tax_data(client, tax_df):
+    """
+    Nạp Bảng kê Thuế (đã chuẩn hoá bởi read_tax_excel_file) vào Tax_Staging dưới 1 Session_Id mới, dạng Parquet nén.
+    Không tạo/xoá bảng theo từng lần đối soát: dòng cũ tự mất theo hạn partition, request bị ngắt giữa chừng không để lại bảng rác.
+    Trả về (source_sql, params): bảng con chỉ gồm dòng của phiên này, dùng thẳng trong câu truy vấn đối soát.
+    """
+    table_id = _ensure_tax_staging_table(client)
+    session_id, ngay_nap = uuid.uuid4().hex, datetime.now(timezone.utc).date()
+    n = len(tax_df)
+    arrays = []
+    for field in TAX_STAGING_ARROW_SCHEMA:
+        if field.name == "Ngay_Nap":
+            arrays.append(pa.array([ngay_nap] * n, type=field.type))
+        elif field.name == "Session_Id":
+            arrays.append(pa.array([session_id] * n, type=field.type))
+        else:
+            arrays.append(pa.array(tax_df[field.name], type=field.type, from_pandas=True))
+    buf = io.BytesIO()
+    pq.write_table(pa.Table.from_arrays(arrays, schema=TAX_STAGING_ARROW_SCHEMA), buf, compression=PARQUET_COMPRESSION)
+    buf.seek(0)
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, schema=TAX_STAGING_SCHEMA, write_disposition="WRITE_APPEND")
+    client.load_table_from_file(buf, table_id, job_config=job_config).result()
+    source_sql = f"(SELECT * FROM `{table_id}` WHERE Ngay_Nap = @tax_ngay_nap AND Session_Id = @tax_session_id)"
+    return source_sql, {'tax_ngay_nap': ngay_nap, 'tax_session_id': session_id}
+
+def rebuild_current_table(client=None):
+    """Dựng lại toàn bộ HD01_Current từ bảng chính (dùng cho lần đầu, hoặc khi không chạy được DML)."""
+    client = client or get_bq_client()
+    master_id = _table_id(client, MASTER_TABLE)
+    current_id = _table_id(client, CURRENT_TABLE)
+    return bq_query.run(client, f"""
+        CREATE OR REPLACE TABLE `{current_id}`
+        {PARTITION_DDL}
+        AS SELECT * FROM `{master_id}`
+        {DEDUP_QUALIFY}
+    """, call_site="rebuild_current", cost_guard=False)
+
+def rebuild_rollup_table(client=None):
+    """Dựng lại toàn bộ HD01_Monthly_Rollup từ HD01_Current."""
+    client = client or get_bq_client()
+    rollup_id = _table_id(client, ROLLUP_TABLE)
+    return bq_query.run(client, f"""
+        CREATE OR REPLACE TABLE `{rollup_id}`
+        PARTITION BY DATE_TRUNC(Ky_Bao_Cao, MONTH)
+        CLUSTER BY Ma_CHXD, Nhom_Hang
+        AS {_rollup_select_sql(f"`{_table_id(client, CURRENT_TABLE)}`", "TRUE")}
+    """, call_site="rebuild_rollup", cost_guard=False)
+
+def rebuild_manifest_table(client=None):
+    """Dựng lại sổ nạp từ bảng chính: số dòng từng lát, không có checksum (chỉ tính được lúc nạp)."""
+    client = client or get_bq_client()
+    manifest_id = _table_id(client, MANIFEST_TABLE)
+    return bq_query.run(client, f"""
+        CREATE OR REPLACE TABLE `{manifest_id}` AS
+        SELECT Nam_Bao_Cao, Thang_Bao_Cao, Ky_Bao_Cao, Ma_CHXD,
+               ANY_VALUE(Ten_CHXD) AS Ten_CHXD, COUNT(1) AS So_Dong,
+               CAST(NULL AS STRING) AS Checksum, CURRENT_TIMESTAMP() AS Loaded_At
+        FROM `{_table_id(client, MASTER_TABLE)}`
+        GROUP BY Nam_Bao_Cao, Thang_Bao_Cao, Ky_Bao_Cao, Ma_CHXD
+    """, call_site="rebuild_manifest", cost_guard=False)
+
 def delete_old_data(store_code, report_month, report_year):
-    client = get_bq_client()
-    table_id = f"{client.project}.pvoil_data.HD01_Master_Data"
-    query = f"DELETE FROM `{table_id}` WHERE Ma_CHXD = '{store_code}' AND Thang_Bao_Cao = {int(report_month)} AND Nam_Bao_Cao = {int(report_year)}"
+    """Xoá lát dữ liệu của 1 CHXD trong tháng (trên cả bảng chính lẫn bảng hiện hành)."""
     try:
-        client.query(query).result()
+        replace_month_data({store_code: None}, report_month, report_year)
     except Exception as e:
-        if "billing" in str(e).lower():
-            print("     [Cảnh báo BigQuery] Billing chưa enable, tự động Append.")
+        print(f"     [Lỗi BigQuery] {e}")
+
+def _to_arrow_table(df, store_code, report_month, report_year):
+    """
+    Chuyển DataFrame HD01 đã làm sạch của 1 CHXD thẳng sang pyarrow.Table đúng HD01_ARROW_SCHEMA.
+    Không sửa DataFrame gốc; mỗi cột chỉ ép kiểu đúng 1 lần (số: bỏ dấu phẩy/khoảng trắng, chuỗi: giữ NULL).
+    """
+    n = len(df)
+    source = {COLUMN_MAPPING[k]: df[k] for k in df.columns if k in COLUMN_MAPPING}
+    arrays = []
+    for field in HD01_ARROW_SCHEMA:
+        name = field.name
+        if name == 'Nam_Bao_Cao':
+            arrays.append(pa.array([int(report_year)] * n, type=field.type))
+        elif name == 'Thang_Bao_Cao':
+            arrays.append(pa.array([int(report_month)] * n, type=field.type))
+        elif name == 'Ma_CHXD':
+            arrays.append(pa.array([store_code] * n, type=field.type))
+        elif name == PARTITION_FIELD:
+            arrays.append(pa.array([date(int(report_year), int(report_month), 1)] * n, type=field.type))
+        elif name not in source:
+            arrays.append(pa.nulls(n, type=field.type))
+        elif pa.types.is_floating(field.type):
+            col = source[name]
+            if not pd.api.types.is_numeric_dtype(col):
+                col = col.astype(str).str.replace(',', '', regex=False).str.replace(' ', '', regex=False)
+            arrays.append(pa.array(pd.to_numeric(col, errors='coerce').fillna(0).to_numpy(dtype='float64'), type=field.type))
         else:
-            print(f"     [Lỗi BigQuery] {e}")
+            col = source[name]
+            try:
+                arrays.append(pa.array(col, type=field.type, from_pandas=True))
+            except (pa.ArrowTypeError, pa.ArrowInvalid):
+                # Cột lẫn kiểu (số/ngày trong cột chữ) → ép từng giá trị về chuỗi, giữ NULL
+                arrays.append(pa.array([None if pd.isna(v) else str(v) for v in col], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=HD01_ARROW_SCHEMA)
+
+def _load_arrow_table(client, arrow_table, table_id, write_disposition="WRITE_APPEND"):
+    """Ghi pyarrow.Table ra Parquet nén trong bộ nhớ rồi nạp vào BigQuery với schema tường minh. Trả về số byte đã đẩy lên."""
+    buf = io.BytesIO()
+    pq.write_table(arrow_table, buf, compression=PARQUET_COMPRESSION)
+    size = buf.tell()
+    buf.seek(0)
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, schema=HD01_SCHEMA, write_disposition=write_disposition)
+    client.load_table_from_file(buf, table_id, job_config=job_config).result()
+    return size
 
 def upload_dataframe(df, store_code, report_month, report_year):
+    """Ghi dữ liệu 1 CHXD; đi qua replace_month_data để HD01_Current luôn đồng bộ với bảng chính."""
     if df is None or df.empty: return
-    df['Nam_Bao_Cao'] = int(report_year)
-    df['Thang_Bao_Cao'] = int(report_month)
-    df['Mã_CHXD'] = store_code
-    df_bq = df.rename(columns=COLUMN_MAPPING)
-    float_cols = ['So_Luong', 'Don_Gia', 'Tien_Chua_Thue', 'Tien_Thue', 'Tong_Tien']
-    for col in float_cols:
-        if col in df_bq.columns:
-            df_bq[col] = pd.to_numeric(df_bq[col].astype(str).str.replace(',', '').str.replace(' ', ''), errors='coerce').fillna(0)
-    valid_cols = list(COLUMN_MAPPING.values())
-    df_bq = df_bq[[c for c in valid_cols if c in df_bq.columns]].copy()
+    replace_month_data({store_code: df}, report_month, report_year)
+
+def _replace_slices_sql(target_id, source_sql):
+    """MERGE ... ON FALSE: chèn toàn bộ nguồn, xoá các lát (Năm, Tháng, CHXD) cũ của đích - 1 câu lệnh nguyên tử."""
+    cols = ", ".join(f.name for f in HD01_SCHEMA)
+    return f"""
+        MERGE `{target_id}` T
+        USING {source_sql} S
+        ON FALSE
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT ({cols}) VALUES ({cols})
+        WHEN NOT MATCHED BY SOURCE
+            AND T.Ky_Bao_Cao = DATE(@nam, @thang, 1) AND T.Ma_CHXD IN UNNEST(@store_codes) THEN
+            DELETE
+    """
+
+def _manifest_param(entry):
+    return bigquery.StructQueryParameter(
+        None,
+        bigquery.ScalarQueryParameter("Ma_CHXD", "STRING", entry['Ma_CHXD']),
+        bigquery.ScalarQueryParameter("Ten_CHXD", "STRING", entry['Ten_CHXD']),
+        bigquery.ScalarQueryParameter("So_Dong", "INT64", entry['So_Dong']),
+        bigquery.ScalarQueryParameter("Checksum", "STRING", entry['Checksum']),
+        bigquery.ScalarQueryParameter("Loaded_At", "TIMESTAMP", entry['Loaded_At']),
+    )
+
+def replace_month_data(frames, report_month, report_year):
+    """
+    Nạp HD01 của nhiều CHXD trong 1 lần chạy, thay cho cặp DELETE + append theo từng cửa hàng:
+    - 1 load job đẩy toàn bộ dòng của lần chạy vào 1 bảng Staging tạm (tự hết hạn),
+    - 1 script thay thế nguyên tử các lát (Năm, Tháng, CHXD) trên bảng chính, HD01_Current và HD01_Monthly_Rollup.
+    frames: {store_code: DataFrame đã làm sạch}; DataFrame rỗng nghĩa là chỉ xoá dữ liệu cũ của CHXD đó.
+    Sổ nạp HD01_Ingest_Manifest (+ bản đệm cục bộ) được cập nhật cùng transaction.
+    Trả về {'stores', 'staged', 'inserted', 'deleted', 'uploaded_bytes'} để báo lại cho luồng SSE.
+    """
+    store_codes = list(frames.keys())
+    if not store_codes:
+        return {'stores': 0, 'staged': 0, 'inserted': 0, 'deleted': 0, 'uploaded_bytes': 0}
+    tables = {code: _to_arrow_table(df, code, report_month, report_year) if df is not None and not df.empty else None
+              for code, df in frames.items()}
+    entries = ingest_manifest.build_entries(tables)
+    if hd01_backend() == "local":
+        import local_store
+        stats = local_store.replace_month_data(tables, report_month, report_year)
+        ingest_manifest.record(report_month, report_year, entries)
+        query_cache.bump_versions(report_month, report_year, store_codes)
+        return stats
+
+    parts = [t for t in tables.values() if t is not None]
+    staged = pa.concat_tables(parts) if parts else HD01_ARROW_SCHEMA.empty_table()
+
     client = get_bq_client()
-    table_id = f"{client.project}.pvoil_data.HD01_Master_Data"
-    client.load_table_from_dataframe(df_bq, table_id, job_config=bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")).result()
+    master_id = _table_id(client, MASTER_TABLE)
+    current_id = _table_id(client, CURRENT_TABLE)
+    rollup_id = _table_id(client, ROLLUP_TABLE)
+    manifest_id = _table_id(client, MANIFEST_TABLE)
+    staging_id = _table_id(client, f"HD01_Staging_{uuid.uuid4().hex[:8]}")
+    staging = bigquery.Table(staging_id, schema=HD01_SCHEMA)
+    staging.expires = datetime.now(timezone.utc) + timedelta(minutes=STAGING_TTL_MINUTES)
+    client.create_table(staging)
+
+    try:
+        uploaded_bytes = _load_arrow_table(client, staged, staging_id)
+
+        # Bảng chính nhận nguyên lát; bảng hiện hành nhận lát đã khử trùng lặp; rollup chỉ tính lại
+        # đúng các lát (Năm, Tháng, CHXD) vừa nạp - tất cả trong cùng 1 transaction
+        slice_sql = f"{PERIOD_FILTER_SQL} AND Ma_CHXD IN UNNEST(@store_codes)"
+        script = f"""
+            BEGIN TRANSACTION;
+            {_replace_slices_sql(master_id, f"`{staging_id}`")};
+            {_replace_slices_sql(current_id, f"(SELECT * FROM `{staging_id}` {DEDUP_QUALIFY})")};
+            DELETE FROM `{rollup_id}` WHERE {slice_sql};
+            INSERT INTO `{rollup_id}` {_rollup_select_sql(f"`{current_id}`", slice_sql)};
+            DELETE FROM `{manifest_id}` WHERE {slice_sql};
+            INSERT INTO `{manifest_id}` ({", ".join(f.name for f in MANIFEST_SCHEMA)})
+            SELECT @nam, @thang, DATE(@nam, @thang, 1), m.Ma_CHXD, m.Ten_CHXD, m.So_Dong, m.Checksum, m.Loaded_At
+            FROM UNNEST(@manifest) m;
+            COMMIT TRANSACTION;
+        """
+        params = {**period_params(report_month, report_year), 'store_codes': store_codes,
+                  'manifest': bigquery.ArrayQueryParameter("manifest", "STRUCT", [_manifest_param(e) for e in entries])}
+        try:
+            job = bq_query.run(client, script, params, call_site="ingest_replace_month", cost_guard=False)
+            inserted, deleted = staged.num_rows, 0
+            for child in client.list_jobs(parent_job=job):
+                stats = getattr(child, 'dml_stats', None)
+                if stats and (getattr(child, 'query', '') or '').lstrip().startswith(f"MERGE `{master_id}`"):
+                    inserted, deleted = stats.inserted_row_count, stats.deleted_row_count
+        except Exception as e:
+            if "billing" not in str(e).lower(): raise
+            print("     [Cảnh báo BigQuery] Billing chưa enable, tự động Append.")
+            client.copy_table(staging_id, master_id, job_config=bigquery.CopyJobConfig(write_disposition="WRITE_APPEND")).result()
+            rebuild_current_table(client)
+            rebuild_rollup_table(client)
+            rebuild_manifest_table(client)
+            inserted, deleted = staged.num_rows, 0
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
+
+    ingest_manifest.record(report_month, report_year, entries)
+    query_cache.bump_versions(report_month, report_year, store_codes)
+    if local_mirror_enabled():
+        try:
+            import local_store
+            local_store.replace_month_data(tables, report_month, report_year)
+        except Exception as e:
+            print(f"     [Cảnh báo] Không ghi được bản HD01 cục bộ: {e}")
+
+    return {'stores': len(store_codes), 'staged': staged.num_rows, 'inserted': inserted, 'deleted': deleted, 'uploaded_bytes': uploaded_bytes}
+
+def _split_aggregates(detail):
+    """Tách bảng chi tiết (CHXD × Nhóm hàng × Trạng thái) thành 2 bảng agg_prod, agg_status mà generate_excel_from_bq cần."""
+    agg_prod = detail.groupby(['Ten_CHXD', 'Nhom_Hang'], as_index=False, dropna=False)[AGG_METRICS].sum()
+    agg_status = (detail.groupby(['Ten_CHXD', 'Trang_Thai_Lower'], as_index=False, dropna=False)['So_Luong_Dong'].sum()
+                  .rename(columns={'So_Luong_Dong': 'So_Luong_Trang_Thai'}))
+    return agg_prod, agg_status
+
+def _read_manifest(client, where_sql, params, periods, call_site):
+    """
+    Đọc sổ nạp trên BigQuery (bảng vài nghìn dòng) → {(tháng, năm): [entry, ...]}; đồng thời làm mới bản đệm cục bộ.
+    periods: các (tháng, năm) mà where_sql bao trùm - tháng không còn dòng nào trên BigQuery được ghi rỗng vào bản đệm.
+    """
+    rows = bq_query.run(client, f"SELECT * FROM `{_table_id(client, MANIFEST_TABLE)}` WHERE {where_sql}", params, call_site=call_site).result()
+    by_period = {(int(m), int(y)): [] for m, y in periods}
+    for row in rows:
+        by_period.setdefault((int(row['Thang_Bao_Cao']), int(row['Nam_Bao_Cao'])), []).append(dict(row.items()))
+    ingest_manifest.replace_periods(by_period)
+    return by_period
+
+def month_has_data(report_month, report_year):
+    """Kiểm tra tháng đã có dữ liệu HD01 chưa: bản đệm sổ nạp trước, chỉ hỏi bảng manifest khi đệm chưa có."""
+    if hd01_backend() == "local":
+        import local_store
+        return local_store.month_has_data(report_month, report_year)
+    if ingest_manifest.period_has_rows(ingest_manifest.cached_period(report_month, report_year)):
+        return True
+    by_period = _read_manifest(get_bq_client(), PERIOD_FILTER_SQL, period_params(report_month, report_year),
+                               [(report_month, report_year)], "month_has_data")
+    entries = by_period.get((int(report_month), int(report_year)), [])
+    return any((e.get('So_Dong') or 0) > 0 for e in entries)
+
+def hd01_data_version(report_month, report_year):
+    """
+    Phiên bản dữ liệu HD01 của 1 tháng (dùng làm khoá ghi nhớ đối soát HoaDon): đổi mỗi khi có lát được nạp lại/xoá.
+    Backend BigQuery đọc lại sổ nạp (bảng nhỏ) để thấy cả các lần nạp từ máy khác; None nếu không xác định được.
+    """
+    if hd01_backend() == "local":
+        import local_store
+        return local_store.month_version(report_month, report_year)
+    try:
+        _read_manifest(get_bq_client(), PERIOD_FILTER_SQL, period_params(report_month, report_year),
+                       [(report_month, report_year)], "data_version")
+    except Exception as e:
+        print(f"[Cảnh báo BigQuery] Không đọc được sổ nạp, không dùng kết quả đối soát đã ghi nhớ: {e}")
+        return None
+    return ingest_manifest.period_version(ingest_manifest.cached_period(report_month, report_year))
+
+def get_coverage(report_year):
+    """
+    Độ phủ dữ liệu theo CHXD × Tháng của 1 năm, đọc từ sổ nạp.
+    Trả về {tháng: {store_code: {'Ten_CHXD', 'So_Dong', 'Checksum', 'Loaded_At'}}}.
+    """
+    if hd01_backend() != "local":
+        try:
+            _read_manifest(get_bq_client(), "Nam_Bao_Cao = @nam", {'nam': int(report_year)},
+                           [(m, report_year) for m in range(1, 13)], "coverage")
+        except Exception as e:
+            print(f"[Cảnh báo BigQuery] Không đọc được sổ nạp, dùng bản đệm cục bộ: {e}")
+    cache = ingest_manifest.load_cache()
+    return {m: cache[f"{int(report_year):04d}-{m:02d}"] for m in range(1, 13) if cache.get(f"{int(report_year):04d}-{m:02d}")}
 
 def get_aggregated_data(report_month, report_year):
+    """Đọc bảng rollup đã tổng hợp sẵn lúc nạp (vài trăm dòng/tháng); 2 bảng tổng hợp được tách phía Python."""
+    detail = query_cache.cached_frame("aggregate", report_month, report_year, 'ALL',
+                                      lambda: _aggregate_detail(report_month, report_year), backend=hd01_backend())
+    return _split_aggregates(detail)
+
+def _aggregate_detail(report_month, report_year):
+    if hd01_backend() == "local":
+        import local_store
+        return local_store.get_aggregate_detail(report_month, report_year)
     client = get_bq_client()
-    table_id = f"`{client.project}.pvoil_data.HD01_Master_Data`"
-    sql_prod = f"""
-        WITH Deduplicated AS (
-            SELECT * FROM {table_id}
-            WHERE Thang_Bao_Cao = {int(report_month)} AND Nam_Bao_Cao = {int(report_year)}
-            QUALIFY ROW_NUMBER() OVER(PARTITION BY Ma_CHXD, Ky_Hieu, So_HD ORDER BY Ngay_Hoa_Don DESC) = 1
-        ),
-        ValidData AS (
-            SELECT * FROM Deduplicated
-            WHERE LOWER(TRIM(Trang_Thai_HD)) IN ('hoàn thành', 'thay thế', 'điều chỉnh tăng', 'điều chỉnh giảm', 'bị thay thế', 'bị điều chỉnh')
-        )
-        SELECT 
-            Ten_CHXD,
-            CASE 
-                WHEN TRIM(Hang_Hoa) IN ('Xăng RON95 Mức 3', 'Xăng E5 RON92 Mức 2', 'Dầu Điêzen 0,001S Mức 5', 'Dầu Điêzen 0,05S Mức 2', 'Xăng E10 RON95 Mức 3') THEN TRIM(Hang_Hoa)
-                ELSE 'Mặt hàng khác'
-            END AS Nhom_Hang,
-            COUNT(1) AS So_Luong_Dong,
-            SUM(So_Luong) AS Tong_San_Luong,
-            SUM(Tien_Chua_Thue) AS Tien_Chua_Thue,
-            SUM(Tien_Thue) AS Tien_Thue,
-            SUM(Tong_Tien) AS Tong_Thanh_Toan,
-            SUM(CASE WHEN LOWER(Loai_HD) LIKE '%chuyển thẳng%' THEN So_Luong ELSE 0 END) AS SL_ChuyenThang,
-            SUM(CASE WHEN Ma_So_Thue LIKE '%0600759399%' THEN So_Luong ELSE 0 END) AS SL_NoiBo
-        FROM ValidData
-        GROUP BY Ten_CHXD, Nhom_Hang
-    """
-    sql_status = f"""
-        WITH Deduplicated AS (
-            SELECT * FROM {table_id}
-            WHERE Thang_Bao_Cao = {int(report_month)} AND Nam_Bao_Cao = {int(report_year)}
-            QUALIFY ROW_NUMBER() OVER(PARTITION BY Ma_CHXD, Ky_Hieu, So_HD ORDER BY Ngay_Hoa_Don DESC) = 1
-        )
-        SELECT 
-            Ten_CHXD,
-            LOWER(TRIM(Trang_Thai_HD)) AS Trang_Thai_Lower,
-            COUNT(1) AS So_Luong_Trang_Thai
-        FROM Deduplicated
-        WHERE LOWER(TRIM(Trang_Thai_HD)) IN ('hoàn thành', 'thay thế', 'điều chỉnh tăng', 'điều chỉnh giảm', 'bị thay thế', 'bị điều chỉnh')
-        GROUP BY Ten_CHXD, Trang_Thai_Lower
+    sql = f"""
+        SELECT Ten_CHXD, Nhom_Hang, Trang_Thai_Lower, {', '.join(AGG_METRICS)}
+        FROM `{_table_id(client, ROLLUP_TABLE)}`
+        WHERE {PERIOD_FILTER_SQL}
     """
-    return client.query(sql_prod).to_dataframe(), client.query(sql_status).to_dataframe()
+    return bq_query.run(client, sql, period_params(report_month, report_year), call_site="aggregate_hd01").to_dataframe()
 
-def get_raw_hd01_data(month, year, store_code='ALL'):
-    """Tính năng mới: Truy vấn 100% cột dữ liệu thô từ BigQuery."""
-    client = get_bq_client()
-    table_id = f"`{client.project}.pvoil_data.HD01_Master_Data`"
-    where_clause = f"WHERE Thang_Bao_Cao = {int(month)} AND Nam_Bao_Cao = {int(year)}"
+# =====================================================================
+# DỮ LIỆU THÔ: CHỌN CỘT + LỌC ĐẨY XUỐNG SQL (BigQuery chỉ quét các cột/cụm cần)
+# =====================================================================
+RAW_COLUMNS = [f.name for f in HD01_SCHEMA if f.name != PARTITION_FIELD]
+
+_RAW_DIALECT = {
+    "bigquery": {
+        "param": "@{}",
+        "in_list": "{expr} IN UNNEST(@{name})",
+        "parse_date": "COALESCE(SAFE.PARSE_DATE('%d/%m/%Y', {expr}), SAFE.PARSE_DATE('%Y-%m-%d', {expr}))",
+        "order_by": "ORDER BY Ten_CHXD, Ngay_Hoa_Don, So_HD",
+    },
+    "local": {
+        "param": "${}",
+        "in_list": "list_contains(${name}, {expr})",
+        "parse_date": "CAST(COALESCE(TRY_STRPTIME({expr}, '%d/%m/%Y'), TRY_STRPTIME({expr}, '%Y-%m-%d')) AS DATE)",
+        "order_by": "ORDER BY Ten_CHXD NULLS FIRST, Ngay_Hoa_Don NULLS FIRST, So_HD NULLS FIRST",
+    },
+}
+
+def _raw_hd01_query(table_sql, base_conditions, store_code, engine, columns=None, date_from=None, date_to=None, products=None, mst=None, statuses=None):
+    """
+    Dựng câu SELECT dữ liệu thô + tham số (không nối chuỗi giá trị người dùng vào SQL).
+    - columns: danh sách cột cần lấy (mặc định tất cả), phải thuộc RAW_COLUMNS
+    - date_from / date_to: 'YYYY-MM-DD', lọc theo Ngay_Hoa_Don (dd/mm/yyyy hoặc yyyy-mm-dd)
+    - products: danh sách tên hàng hóa; mst: MST khách hàng (bỏ khoảng trắng); statuses: danh sách trạng thái HĐ
+    Trả về (sql, {tên: giá trị}); base_conditions là điều kiện cố định của engine (vd: lọc kỳ báo cáo trên BigQuery).
+    """
+    dialect = _RAW_DIALECT[engine]
+    param = dialect["param"].format
+    columns = [c.strip() for c in (columns or []) if c and c.strip()] or RAW_COLUMNS
+    unknown = [c for c in columns if c not in RAW_COLUMNS]
+    if unknown:
+        raise ValueError(f"Cột không hợp lệ: {', '.join(unknown)}")
+
+    conditions, params = list(base_conditions), {}
     if store_code and store_code != 'ALL':
-        where_clause += f" AND Ma_CHXD = '{store_code}'"
-    query = f"""
-        SELECT * FROM {table_id}
-        {where_clause}
-        QUALIFY ROW_NUMBER() OVER(PARTITION BY Ma_CHXD, Ky_Hieu, So_HD ORDER BY Ngay_Hoa_Don DESC) = 1
-        ORDER BY Ten_CHXD, Ngay_Hoa_Don, So_HD
-    """
-    return client.query(query).to_dataframe()
\ No newline at end of file
+        conditions.append(f"Ma_CHXD = {param('store_code')}")
+        params['store_code'] = store_code
+    invoice_date = dialect["parse_date"].format(expr="SUBSTR(TRIM(Ngay_Hoa_Don), 1, 10)")
+    if date_from:
+        conditions.append(f"{invoice_date} >= {param('date_from')}")
+        params['date_from'] = date.fromisoformat(date_from)
+    if date_to:
+        conditions.append(f"{invoice_date} <= {param('date_to')}")
+        params['date_to'] = date.fromisoformat(date_to)
+    if products:
+        conditions.append(dialect["in_list"].format(expr="TRIM(Hang_Hoa)", name="products"))
+        params['products'] = [p.strip() for p in products]
+    if mst:
+        conditions.append(f"REPLACE(Ma_So_Thue, ' ', '') = {param('mst')}")
+        params['mst'] = mst.replace(' ', '')
+    if statuses:
+        conditions.append(dialect["in_list"].format(expr="LOWER(TRIM(Trang_Thai_HD))", name="statuses"))
+        params['statuses'] = [st.strip().lower() for st in statuses]
+
+    where_sql = " AND ".join(conditions) or "TRUE"
+    sql = f"""
+        SELECT {', '.join(columns)} FROM {table_sql}
+        WHERE {where_sql}
+        {dialect["order_by"]}
+    """
+    return sql, params
+
+def _raw_hd01_job(month, year, store_code, filters, stats):
+    """Chạy truy vấn dữ liệu thô trên BigQuery, ghi số byte đã quét vào stats."""
+    client = get_bq_client()
+    sql, params = _raw_hd01_query(f"`{_table_id(client, CURRENT_TABLE)}`", [PERIOD_FILTER_SQL], store_code, "bigquery", **filters)
+    job = bq_query.run(client, sql, {**period_params(month, year), **params}, call_site="raw_hd01")
+    rows = job.result()
+    stats['bytes_processed'] = job.total_bytes_processed or 0
+    print(f"[BigQuery] Dữ liệu thô {month}/{year} ({store_code}): quét {stats['bytes_processed'] / 1024 / 1024:,.1f} MB")
+    return rows
+
+def get_raw_hd01_data(month, year, store_code='ALL', stats=None, **filters):
+    """
+    Tính năng mới: Truy vấn dữ liệu thô (đã khử trùng lặp) từ BigQuery.
+    filters: columns, date_from, date_to, products, mst, statuses (xem _raw_hd01_query) - lọc ngay trong SQL.
+    stats (dict, tuỳ chọn): nhận 'bytes_processed' và 'cache_hit'.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(bytes_processed=0, cache_hit=True)
+    filters = {k: v for k, v in filters.items() if v}
+    return query_cache.cached_frame("raw", month, year, store_code,
+                                    lambda: _raw_hd01_data(month, year, store_code, filters, stats), backend=hd01_backend(), **filters)
+
+def _raw_hd01_data(month, year, store_code, filters, stats):
+    stats['cache_hit'] = False
+    if hd01_backend() == "local":
+        import local_store
+        sql, params = _raw_hd01_query("hd01_current", [], store_code, "local", **filters)
+        return local_store.query(sql, month, year, params=params)
+    return _raw_hd01_job(month, year, store_code, filters, stats).to_dataframe()
+
+def _bqstorage_client():
+    """Client BigQuery Storage Read API (trả kết quả dạng Arrow theo luồng); None nếu chưa cài google-cloud-bigquery-storage."""
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        print("[Cảnh báo BigQuery] Chưa cài google-cloud-bigquery-storage, đọc kết quả theo từng trang REST.")
+        return None
+    return bigquery_storage.BigQueryReadClient(credentials=google_handler.get_google_credentials())
+
+def iter_raw_hd01_batches(month, year, store_code='ALL', stats=None, **filters):
+    """
+    Dữ liệu thô HD01 dưới dạng luồng pyarrow.RecordBatch (cùng cột, cùng thứ tự, cùng bộ lọc với get_raw_hd01_data).
+    Dùng cho xuất file lớn: không bao giờ dựng cả tháng thành 1 DataFrame.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(bytes_processed=0, cache_hit=True)
+    filters = {k: v for k, v in filters.items() if v}
+    return query_cache.cached_batches("raw", month, year, store_code,
+                                      lambda: _raw_hd01_batches(month, year, store_code, filters, stats), backend=hd01_backend(), **filters)
+
+def _raw_hd01_batches(month, year, store_code, filters, stats):
+    stats['cache_hit'] = False
+    if hd01_backend() == "local":
+        import local_store
+        sql, params = _raw_hd01_query("hd01_current", [], store_code, "local", **filters)
+        yield from local_store.iter_query_batches(sql, month, year, params=params)
+        return
+    # Câu truy vấn có ORDER BY → thư viện tự đọc bằng 1 stream để giữ đúng thứ tự
+    rows = _raw_hd01_job(month, year, store_code, filters, stats)
+    yield from rows.to_arrow_iterable(bqstorage_client=_bqstorage_client())
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+bq_maintenance.py
+Các lệnh bảo trì bảng HD01 trên BigQuery.
+
+Cách dùng:
+  1) Dựng lại toàn bộ bảng hiện hành HD01_Current (đã khử trùng lặp) từ HD01_Master_Data:
+     python bq_maintenance.py rebuild-current
+
+  2) Dựng lại bảng tổng hợp sẵn HD01_Monthly_Rollup từ HD01_Current:
+     python bq_maintenance.py rebuild-rollup
+
+  3) So sánh chi phí truy vấn cũ (QUALIFY trên bảng chính) với truy vấn trên HD01_Current:
+     python bq_maintenance.py compare-dedupe --year 2025 --month 8
+
+  4) Chuyển HD01_Master_Data từ phân vùng cũ (Thang_Bao_Cao 1-12, mọi năm dồn chung) sang phân vùng
+     theo tháng của Ky_Bao_Cao + gom cụm Ma_CHXD, Hang_Hoa; bảng cũ được giữ lại dưới tên *_Legacy_<thời điểm>:
+     python bq_maintenance.py migrate-partitioning
+
+  5) So sánh byte quét của các truy vấn chuẩn giữa bảng cũ và bảng mới:
+     python bq_maintenance.py compare-partitioning --legacy HD01_Master_Data_Legacy_20251019_0900 --year 2025 --month 8
+
+  6) Dựng lại sổ nạp HD01_Ingest_Manifest từ bảng chính (số dòng từng lát; checksum chỉ có khi nạp qua ứng dụng):
+     python bq_maintenance.py rebuild-manifest
+"""
+import argparse
+import time
+from datetime import datetime
+
+from google.cloud import bigquery
+
+import bq_handler
+import bq_query
+
+
+def _run_measured(client, sql):
+    """Chạy truy vấn không dùng cache kết quả, trả về (byte đã quét, slot-ms, thời gian giây)."""
+    t0 = time.perf_counter()
+    job = bq_query.run(client, sql, call_site="maintenance_compare", job_config=bigquery.QueryJobConfig(use_query_cache=False))
+    return job.total_bytes_processed or 0, job.slot_millis or 0, time.perf_counter() - t0
+
+
+def cmd_rebuild_current(args):
+    client = bq_handler.get_bq_client()
+    job = bq_handler.rebuild_current_table(client)
+    table = client.get_table(bq_handler._table_id(client, bq_handler.CURRENT_TABLE))
+    print(f"Đã dựng lại {table.full_table_id}: {table.num_rows:,} dòng (quét {(job.total_bytes_processed or 0) / 1024 / 1024:,.1f} MB).")
+
+
+def cmd_rebuild_rollup(args):
+    client = bq_handler.get_bq_client()
+    job = bq_handler.rebuild_rollup_table(client)
+    table = client.get_table(bq_handler._table_id(client, bq_handler.ROLLUP_TABLE))
+    print(f"Đã dựng lại {table.full_table_id}: {table.num_rows:,} dòng (quét {(job.total_bytes_processed or 0) / 1024 / 1024:,.1f} MB).")
+
+
+def cmd_rebuild_manifest(args):
+    client = bq_handler.get_bq_client()
+    bq_handler.rebuild_manifest_table(client)
+    table = client.get_table(bq_handler._table_id(client, bq_handler.MANIFEST_TABLE))
+    print(f"Đã dựng lại {table.full_table_id}: {table.num_rows:,} lát (Năm, Tháng, CHXD).")
+
+
+def cmd_compare_dedupe(args):
+    client = bq_handler.get_bq_client()
+    master_id = bq_handler._table_id(client, bq_handler.MASTER_TABLE)
+    current_id = bq_handler._table_id(client, bq_handler.CURRENT_TABLE)
+    where = f"WHERE {bq_handler.period_filter(args.month, args.year)}"
+    cases = {
+        "Cũ: QUALIFY trên bảng chính": f"SELECT * FROM `{master_id}` {where} {bq_handler.DEDUP_QUALIFY}",
+        "Mới: đọc thẳng HD01_Current": f"SELECT * FROM `{current_id}` {where}",
+    }
+    print(f"{'Truy vấn dữ liệu thô tháng ' + str(args.month) + '/' + str(args.year):<36}{'Byte quét':>14}{'Slot-ms':>12}{'Thời gian':>12}")
+    for label, sql in cases.items():
+        nbytes, slot_ms, secs = _run_measured(client, sql)
+        print(f"{label:<36}{nbytes / 1024 / 1024:>11,.1f} MB{slot_ms:>12,}{secs:>11.2f}s")
+
+
+def cmd_migrate_partitioning(args):
+    client = bq_handler.get_bq_client()
+    master_id = bq_handler._table_id(client, bq_handler.MASTER_TABLE)
+    if any(f.name == bq_handler.PARTITION_FIELD for f in client.get_table(master_id).schema):
+        print(f"{bq_handler.MASTER_TABLE} đã dùng phân vùng theo {bq_handler.PARTITION_FIELD}, không cần chuyển.")
+        return
+
+    legacy_name = f"{bq_handler.MASTER_TABLE}_Legacy_{datetime.now():%Y%m%d_%H%M}"
+    new_id = bq_handler._table_id(client, f"{bq_handler.MASTER_TABLE}_Migrating")
+    cols = ", ".join(f.name for f in bq_handler.HD01_SCHEMA if f.name != bq_handler.PARTITION_FIELD)
+
+    # 1) Tạo bảng mới đúng schema/phân vùng rồi chép toàn bộ dữ liệu sang, tính Ky_Bao_Cao từ (Năm, Tháng)
+    client.delete_table(new_id, not_found_ok=True)
+    client.create_table(bq_handler._hd01_table(new_id))
+    job = bq_query.run(client, f"""
+        INSERT INTO `{new_id}` ({cols}, {bq_handler.PARTITION_FIELD})
+        SELECT {cols}, DATE(Nam_Bao_Cao, Thang_Bao_Cao, 1) FROM `{master_id}`
+    """, call_site="migrate_partitioning", cost_guard=False)
+    print(f"Đã chép {job.num_dml_affected_rows or 0:,} dòng sang {new_id}.")
+
+    # 2) Đổi tên: bảng cũ → *_Legacy_*, bảng mới → HD01_Master_Data
+    bq_query.run(client, f"""
+        ALTER TABLE `{master_id}` RENAME TO `{legacy_name}`;
+        ALTER TABLE `{new_id}` RENAME TO `{bq_handler.MASTER_TABLE}`;
+    """, call_site="migrate_partitioning", cost_guard=False)
+    print(f"Bảng cũ được giữ lại: {bq_handler._table_id(client, legacy_name)}")
+
+    # 3) Phân vùng khác nên không CREATE OR REPLACE được - xoá rồi dựng lại các bảng dẫn xuất
+    for name in (bq_handler.CURRENT_TABLE, bq_handler.ROLLUP_TABLE):
+        client.delete_table(bq_handler._table_id(client, name), not_found_ok=True)
+    bq_handler.rebuild_current_table(client)
+    bq_handler.rebuild_rollup_table(client)
+    print(f"Đã dựng lại {bq_handler.CURRENT_TABLE} và {bq_handler.ROLLUP_TABLE} theo phân vùng mới.")
+
+
+def cmd_compare_partitioning(args):
+    client = bq_handler.get_bq_client()
+    legacy_id = bq_handler._table_id(client, args.legacy)
+    master_id = bq_handler._table_id(client, bq_handler.MASTER_TABLE)
+    old_where = f"WHERE Thang_Bao_Cao = {int(args.month)} AND Nam_Bao_Cao = {int(args.year)}"
+    new_where = f"WHERE {bq_handler.period_filter(args.month, args.year)}"
+    store_sql = f" AND Ma_CHXD = '{args.store}'" if args.store else ""
+    queries = {
+        "Dữ liệu thô 1 tháng": "SELECT * FROM `{table}` {where}",
+        "Khử trùng lặp 1 tháng": "SELECT * FROM `{table}` {where} " + bq_handler.DEDUP_QUALIFY,
+        "Tổng hợp CHXD × Hàng hóa": "SELECT Ma_CHXD, Hang_Hoa, COUNT(1), SUM(So_Luong), SUM(Tong_Tien) FROM `{table}` {where} GROUP BY 1, 2",
+        "Dữ liệu 1 CHXD" if args.store else "Kiểm tra tồn tại": "SELECT * FROM `{table}` {where}" + store_sql + ("" if args.store else " LIMIT 1"),
+    }
+    print(f"{'Truy vấn (tháng ' + str(args.month) + '/' + str(args.year) + ')':<28}{'Bảng cũ':>14}{'Bảng mới':>14}{'Giảm':>8}")
+    for label, sql in queries.items():
+        old_bytes, _, _ = _run_measured(client, sql.format(table=legacy_id, where=old_where))
+        new_bytes, _, _ = _run_measured(client, sql.format(table=master_id, where=new_where))
+        saved = f"{(1 - new_bytes / old_bytes) * 100:.0f}%" if old_bytes else "-"
+        print(f"{label:<28}{old_bytes / 1024 / 1024:>11,.1f} MB{new_bytes / 1024 / 1024:>11,.1f} MB{saved:>8}")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Bảo trì các bảng HD01 trên BigQuery.")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    p_rc = sub.add_parser("rebuild-current", help="Dựng lại HD01_Current từ HD01_Master_Data.")
+    p_rc.set_defaults(func=cmd_rebuild_current)
+
+    p_rr = sub.add_parser("rebuild-rollup", help="Dựng lại HD01_Monthly_Rollup từ HD01_Current.")
+    p_rr.set_defaults(func=cmd_rebuild_rollup)
+
+    p_rm = sub.add_parser("rebuild-manifest", help="Dựng lại HD01_Ingest_Manifest từ HD01_Master_Data.")
+    p_rm.set_defaults(func=cmd_rebuild_manifest)
+
+    p_cd = sub.add_parser("compare-dedupe", help="So sánh byte quét/slot-ms giữa truy vấn cũ và HD01_Current.")
+    p_cd.add_argument("--year", type=int, required=True, help="Năm (vd: 2025)")
+    p_cd.add_argument("--month", type=int, required=True, help="Tháng (1-12)")
+    p_cd.set_defaults(func=cmd_compare_dedupe)
+
+    p_mp = sub.add_parser("migrate-partitioning", help="Chuyển HD01_Master_Data sang phân vùng theo Ky_Bao_Cao (tháng) + gom cụm Ma_CHXD, Hang_Hoa.")
+    p_mp.set_defaults(func=cmd_migrate_partitioning)
+
+    p_cp = sub.add_parser("compare-partitioning", help="So sánh byte quét của truy vấn chuẩn giữa bảng cũ và bảng đã chuyển phân vùng.")
+    p_cp.add_argument("--legacy", required=True, help="Tên bảng cũ do migrate-partitioning giữ lại (vd: HD01_Master_Data_Legacy_20251019_0900)")
+    p_cp.add_argument("--year", type=int, required=True, help="Năm (vd: 2025)")
+    p_cp.add_argument("--month", type=int, required=True, help="Tháng (1-12)")
+    p_cp.add_argument("--store", help="Mã CHXD để đo thêm truy vấn theo 1 cửa hàng (tuỳ chọn)")
+    p_cp.set_defaults(func=cmd_compare_partitioning)
+
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
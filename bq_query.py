@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+bq_query.py
+Lớp chạy truy vấn BigQuery dùng chung: tham số hoá, dry-run tuỳ chọn và ghi số liệu chi phí theo từng nơi gọi.
+
+Mỗi lần chạy ghi lại: nơi gọi (call_site), byte đã quét/tính tiền, slot-ms, có trúng cache kết quả của BigQuery
+không, thời gian chạy; truy vấn lỗi ghi thời gian + lỗi. Số liệu được cộng dồn trong RAM (xem /metrics) và ghi thêm
+từng dòng JSON ra file.
+
+Biến môi trường:
+  HD01_BQ_DRY_RUN=1                 → dry-run trước mỗi truy vấn để ước lượng byte sẽ quét
+  HD01_BQ_MAX_BYTES=<số byte>       → chặn truy vấn đọc/báo cáo vượt ngưỡng (dry-run báo trước + maximum_bytes_billed);
+                                      nạp dữ liệu, dựng lại bảng và migrate chạy với cost_guard=False nên không bị chặn
+  HD01_BQ_METRICS_FILE=cache_data/bq_metrics.jsonl (mặc định; để trống để tắt ghi file)
+"""
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+
+from google.cloud import bigquery
+
+_lock = threading.Lock()
+_by_call_site = {}
+
+
+def _dry_run_enabled():
+    return os.getenv("HD01_BQ_DRY_RUN", "0").strip().lower() in ("1", "true", "yes")
+
+def _max_bytes():
+    value = os.getenv("HD01_BQ_MAX_BYTES", "").strip()
+    return int(value) if value else None
+
+def _metrics_file():
+    return os.getenv("HD01_BQ_METRICS_FILE", os.path.join("cache_data", "bq_metrics.jsonl")).strip()
+
+def _param(name, value):
+    if isinstance(value, (bigquery.ScalarQueryParameter, bigquery.ArrayQueryParameter, bigquery.StructQueryParameter)):
+        return value
+    if isinstance(value, (list, tuple)):
+        item_type = "INT64" if value and all(isinstance(v, int) for v in value) else "STRING"
+        return bigquery.ArrayQueryParameter(name, item_type, list(value))
+    if isinstance(value, bool):
+        return bigquery.ScalarQueryParameter(name, "BOOL", value)
+    if isinstance(value, int):
+        return bigquery.ScalarQueryParameter(name, "INT64", value)
+    if isinstance(value, float):
+        return bigquery.ScalarQueryParameter(name, "FLOAT64", value)
+    if isinstance(value, datetime):
+        return bigquery.ScalarQueryParameter(name, "TIMESTAMP", value)
+    if isinstance(value, date):
+        return bigquery.ScalarQueryParameter(name, "DATE", value)
+    return bigquery.ScalarQueryParameter(name, "STRING", value)
+
+def to_query_parameters(params):
+    """{tên: giá trị} → danh sách tham số BigQuery có kiểu (giá trị đã là QueryParameter thì giữ nguyên)."""
+    return [_param(name, value) for name, value in (params or {}).items()]
+
+def estimate_bytes(client, sql, query_parameters, call_site):
+    """Dry-run: số byte BigQuery sẽ quét (không tốn tiền); None nếu câu lệnh không dry-run được."""
+    try:
+        dry_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=query_parameters)
+        estimated = client.query(sql, job_config=dry_config).total_bytes_processed or 0
+    except Exception as e:
+        print(f"[Cảnh báo BigQuery] Không dry-run được '{call_site}': {e}")
+        return None
+    print(f"[BigQuery] {call_site}: dự kiến quét {estimated / 1024 / 1024:,.1f} MB")
+    return estimated
+
+def run(client, sql, params=None, call_site="khong_ro", dry_run=None, job_config=None, cost_guard=True):
+    """
+    Chạy truy vấn có tham số, đợi xong rồi trả về QueryJob (gọi tiếp .result() / .to_dataframe() như thường).
+    dry_run=None → theo HD01_BQ_DRY_RUN. job_config: cấu hình bổ sung (vd: use_query_cache=False).
+    cost_guard=False → không áp HD01_BQ_MAX_BYTES (câu lệnh ghi bắt buộc phải chạy hết: nạp dữ liệu, dựng lại bảng, migrate).
+    Truy vấn lỗi (kể cả vượt ngưỡng byte) vẫn được ghi số liệu rồi ném lại lỗi.
+    """
+    job_config = job_config or bigquery.QueryJobConfig()
+    job_config.query_parameters = to_query_parameters(params)
+    max_bytes = _max_bytes() if cost_guard else None
+    if max_bytes:
+        job_config.maximum_bytes_billed = max_bytes
+
+    estimated = None
+    if dry_run is None:
+        dry_run = _dry_run_enabled()
+    if dry_run:
+        estimated = estimate_bytes(client, sql, job_config.query_parameters, call_site)
+        if max_bytes and estimated and estimated > max_bytes:
+            _record(call_site, {'estimated_bytes': estimated, 'blocked': True})
+            raise ValueError(f"Truy vấn '{call_site}' dự kiến quét {estimated / 1024 / 1024:,.1f} MB, vượt ngưỡng HD01_BQ_MAX_BYTES.")
+
+    t0 = time.perf_counter()
+    job = None
+    try:
+        job = client.query(sql, job_config=job_config)
+        job.result()
+    except Exception as e:
+        _record(call_site, {
+            'job_id': getattr(job, 'job_id', None),
+            'estimated_bytes': estimated,
+            'failed': True,
+            'error': str(e)[:500],
+            'duration_s': round(time.perf_counter() - t0, 3),
+        })
+        raise
+    _record(call_site, {
+        'job_id': getattr(job, 'job_id', None),
+        'estimated_bytes': estimated,
+        'bytes_processed': getattr(job, 'total_bytes_processed', None) or 0,
+        'bytes_billed': getattr(job, 'total_bytes_billed', None) or 0,
+        'slot_ms': getattr(job, 'slot_millis', None) or 0,
+        'cache_hit': bool(getattr(job, 'cache_hit', False)),
+        'duration_s': round(time.perf_counter() - t0, 3),
+    })
+    return job
+
+def _record(call_site, entry):
+    entry = {'ts': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'call_site': call_site, **entry}
+    with _lock:
+        agg = _by_call_site.setdefault(call_site, {'queries': 0, 'blocked': 0, 'failed': 0, 'cache_hits': 0, 'bytes_processed': 0,
+                                                   'bytes_billed': 0, 'slot_ms': 0, 'duration_s': 0.0, 'max_duration_s': 0.0})
+        if entry.get('blocked'):
+            agg['blocked'] += 1
+        elif entry.get('failed'):
+            agg['failed'] += 1
+            agg['duration_s'] = round(agg['duration_s'] + entry['duration_s'], 3)
+            agg['max_duration_s'] = max(agg['max_duration_s'], entry['duration_s'])
+        else:
+            agg['queries'] += 1
+            agg['cache_hits'] += int(entry['cache_hit'])
+            agg['bytes_processed'] += entry['bytes_processed']
+            agg['bytes_billed'] += entry['bytes_billed']
+            agg['slot_ms'] += entry['slot_ms']
+            agg['duration_s'] = round(agg['duration_s'] + entry['duration_s'], 3)
+            agg['max_duration_s'] = max(agg['max_duration_s'], entry['duration_s'])
+
+        path = _metrics_file()
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"[Cảnh báo] Không ghi được số liệu truy vấn BigQuery: {e}")
+
+def metrics_snapshot():
+    """Số liệu cộng dồn theo nơi gọi (của tiến trình hiện tại), xếp giảm dần theo byte đã quét."""
+    with _lock:
+        rows = {site: dict(agg) for site, agg in _by_call_site.items()}
+    return dict(sorted(rows.items(), key=lambda kv: kv[1]['bytes_processed'], reverse=True))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+cache_utils.py
+Hàm dùng chung cho các bộ đệm trên đĩa (query_cache, result_store, reconcile_memo):
+đọc cờ bật/tắt + số nguyên từ biến môi trường, ghi file nguyên tử, đếm hit/miss theo loại.
+"""
+import os
+import uuid
+
+
+def env_enabled(name, default="1"):
+    """Cờ bật/tắt từ biến môi trường: '0' / 'false' / 'no' là tắt (đọc mỗi lần gọi)."""
+    return os.getenv(name, default).strip().lower() not in ("0", "false", "no")
+
+def env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+def write_atomic(path, write):
+    """Ghi file qua file tạm rồi os.replace: nơi đọc không bao giờ thấy file dở. write(đường dẫn tạm) ghi nội dung."""
+    # File tạm ẩn (bắt đầu bằng '.') và giữ đuôi gốc: openpyxl cần đuôi .xlsx, glob '*' không nhặt file dở
+    tmp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex[:8]}-{os.path.basename(path)}")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def count(stats, kind, field, fields):
+    """Cộng 1 vào stats[kind][field]; stats[kind] được tạo với các trường fields = 0. Nơi gọi tự giữ khoá."""
+    stats.setdefault(kind, dict.fromkeys(fields, 0))[field] += 1
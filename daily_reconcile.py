@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+daily_reconcile.py
+Đối soát theo ngày (Sản lượng, Tiền mặt, Công nợ) dùng chung cho /reconcile (1 loại) và /reconcile_daily (cả 3 loại 1 lần).
+
+- Xác thực Google 1 lần cho mỗi phiên (PosSession), nhớ id thư mục Năm/Tháng đã tìm.
+- Tìm các Sheet POS cần (BCBH.<ngày>, CongNo.<ngày>) bằng 1 truy vấn Drive, lấy luôn modifiedTime cho reconcile_memo.
+- Tải các Sheet POS (mỗi Sheet 1 lệnh đọc values, Sản lượng + Tiền mặt dùng chung BCBH) song song với việc đọc các file SSE.
+- Mỗi loại có kết quả riêng (lưu result_store + ghi nhớ reconcile_memo); 1 loại lỗi không làm hỏng các loại còn lại.
+"""
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+import pandas as pd
+from googleapiclient.discovery import build
+
+import config
+import google_handler
+import reconcile_memo
+import reconciliation_handler
+import result_store
+
+DAILY_TYPES = ('SanLuong', 'TienMat', 'CongNo')
+# Loại đối soát → (tiền tố tên Sheet POS trên Drive, tab tổng hợp)
+POS_SOURCES = {
+    'SanLuong': ('BCBH', 'TongHopBCBH'),
+    'TienMat': ('BCBH', 'TongHopBCBH'),
+    'CongNo': ('CongNo', 'TongHopCongNo'),
+}
+TYPE_LABELS = {'SanLuong': 'sản lượng', 'TienMat': 'tiền mặt', 'CongNo': 'công nợ'}
+SPREADSHEET_MIME = "application/vnd.google-apps.spreadsheet"
+
+
+class PosSession:
+    """Phiên Google dùng chung cho nhiều lần đối soát: xác thực 1 lần, nhớ id thư mục Năm/Tháng."""
+
+    def __init__(self):
+        creds = google_handler.get_google_credentials()
+        self.gspread_client = gspread.authorize(creds)
+        self.drive_service = build('drive', 'v3', credentials=creds)
+        self._folders = {}
+        self._drive_lock = threading.Lock()  # googleapiclient (httplib2) không an toàn đa luồng
+
+    def month_folder(self, day):
+        key = (day.year, day.month)
+        with self._drive_lock:
+            if key not in self._folders:
+                year_folder_id = google_handler.get_or_create_gdrive_folder(self.drive_service, f"Năm {day.year}", config.GOOGLE_DRIVE_ROOT_FOLDER_ID)
+                self._folders[key] = google_handler.get_or_create_gdrive_folder(self.drive_service, f"Tháng {day.month}", year_folder_id)
+            return self._folders[key]
+
+    def find_sheets(self, names, folder_id):
+        """{tên: file Drive} của các Sheet tìm thấy trong thư mục (1 truy vấn Drive)."""
+        with self._drive_lock:
+            return google_handler.find_files_in_folder(self.drive_service, names, folder_id, mime=SPREADSHEET_MIME)
+
+    def sheet_values(self, pos_file, sheet_name):
+        """Toàn bộ giá trị 1 tab (như worksheet.get_all_values) bằng 1 lệnh đọc, qua đệm reconcile_memo theo modifiedTime."""
+        def fetch():
+            resp = self.gspread_client.http_client.values_get(pos_file['id'], gspread.utils.absolute_range_name(sheet_name))
+            return gspread.utils.fill_gaps(resp.get('values', []))
+        if not pos_file.get('modifiedTime'):
+            return fetch()
+        version = {'id': pos_file['id'], 'modifiedTime': pos_file['modifiedTime']}
+        return reconcile_memo.cached_values(f"pos_{sheet_name}", reconcile_memo.make_key(version, sheet_name), fetch)
+
+
+def pos_frame(values):
+    return pd.DataFrame(values[1:], columns=values[0]) if len(values) > 1 else pd.DataFrame()
+
+def read_sse_frame(reconcile_type, file_stream, file_hash, reconcile_date):
+    """DataFrame đọc từ file kế toán (None nếu file không hợp lệ), qua đệm reconcile_memo theo hash file."""
+    readers = {
+        'SanLuong': lambda: reconciliation_handler.read_sse_product_xml(file_stream),
+        'TienMat': lambda: reconciliation_handler.read_sse_cash_xml(file_stream, reconcile_date),
+        'CongNo': lambda: reconciliation_handler.read_sse_debt_xml(file_stream),
+    }
+    # File tiền mặt được lọc theo ngày đối soát ngay lúc đọc → ngày là một phần của khoá
+    input_key = reconcile_memo.make_key(file_hash, reconcile_date.strftime('%Y-%m-%d') if reconcile_type == 'TienMat' else None)
+    sse_df, _ = reconcile_memo.cached_frame(f"input_{reconcile_type}", input_key, lambda: (readers[reconcile_type](), {}))
+    return sse_df
+
+def reconcile_frames(reconcile_type, pos_df, sse_df):
+    if reconcile_type == 'SanLuong':
+        return reconciliation_handler.reconcile_product_data(pos_df, sse_df)
+    if reconcile_type == 'TienMat':
+        return reconciliation_handler.reconcile_cash_data(pos_df, sse_df)
+    return reconciliation_handler.reconcile_debt_data(pos_df, sse_df)
+
+def reconcile_day(session, reconcile_date, uploads, progress_callback=None):
+    """
+    Đối soát 1 ngày cho các loại trong uploads = {loại: (file nhị phân seek được, sha256)}.
+    Trả về {loại: kết quả}, kết quả là 1 trong:
+      {'status': 'success', 'result_id', 'results' (None nếu dùng lại kết quả đã lưu), 'cached'}
+      {'status': 'report_not_found' | 'error', 'message'}
+    """
+    progress = progress_callback or (lambda msg: None)
+    date_str = reconcile_date.strftime('%Y-%m-%d')
+    date_str_dmy = reconcile_date.strftime('%d.%m.%Y')
+
+    progress(f"... Đang tìm báo cáo ngày {date_str_dmy}.....")
+    folder_id = session.month_folder(reconcile_date)
+    pos_files = session.find_sheets([f"{POS_SOURCES[t][0]}.{date_str_dmy}" for t in uploads], folder_id)
+
+    outcomes, pending = {}, {}
+    for reconcile_type, (file_stream, file_hash) in uploads.items():
+        prefix, sheet_name = POS_SOURCES[reconcile_type]
+        pos_file = pos_files.get(f"{prefix}.{date_str_dmy}")
+        if pos_file is None:
+            outcomes[reconcile_type] = {'status': 'report_not_found', 'message': f"Không tìm thấy báo cáo POS ({prefix}) ngày {date_str_dmy}."}
+            continue
+        pos_version = {'id': pos_file['id'], 'modifiedTime': pos_file.get('modifiedTime')}
+        memo_key = reconcile_memo.result_key(reconcile_type, file_hash, pos_version if pos_version['modifiedTime'] else None, reconcile_date=date_str)
+        cached_id = reconcile_memo.lookup_result(memo_key)
+        if cached_id:
+            outcomes[reconcile_type] = {'status': 'success', 'result_id': cached_id, 'results': None, 'cached': True}
+        else:
+            pending[reconcile_type] = (file_stream, file_hash, pos_file, sheet_name, memo_key)
+    if not pending:
+        return outcomes
+
+    # Tải Sheet POS (mỗi Sheet 1 lần) song song với đọc các file SSE
+    with ThreadPoolExecutor(max_workers=2 * len(pending)) as pool:
+        pos_futures = {}
+        for _, _, pos_file, sheet_name, _ in pending.values():
+            if (pos_file['id'], sheet_name) not in pos_futures:
+                progress(f"... Đang tải dữ liệu POS từ Google Sheet {pos_file['name']}.....")
+                pos_futures[(pos_file['id'], sheet_name)] = pool.submit(session.sheet_values, pos_file, sheet_name)
+        progress("... Đang đọc file Kế toán (XML/Excel).....")
+        sse_futures = {t: pool.submit(read_sse_frame, t, file_stream, file_hash, reconcile_date)
+                       for t, (file_stream, file_hash, _, _, _) in pending.items()}
+
+        for reconcile_type, (_, _, pos_file, sheet_name, memo_key) in pending.items():
+            try:
+                sse_df = sse_futures[reconcile_type].result()
+                if sse_df is None:
+                    outcomes[reconcile_type] = {'status': 'error', 'message': f"Định dạng file kế toán ({TYPE_LABELS[reconcile_type]}) không hợp lệ."}
+                    continue
+                pos_df = pos_frame(pos_futures[(pos_file['id'], sheet_name)].result())
+                progress(f"... Bắt đầu so khớp dữ liệu {TYPE_LABELS[reconcile_type].capitalize()}.....")
+                results = reconcile_frames(reconcile_type, pos_df, sse_df)
+                result_id = result_store.save(results, reconcile_type, reconcile_date=date_str)
+                reconcile_memo.remember_result(memo_key, result_id)
+                outcomes[reconcile_type] = {'status': 'success', 'result_id': result_id, 'results': results, 'cached': False}
+            except Exception as e:
+                print(f"Lỗi khi đối soát {reconcile_type} ngày {date_str_dmy}: {e}")
+                traceback.print_exc()
+                outcomes[reconcile_type] = {'status': 'error', 'message': f"Đã xảy ra lỗi không mong muốn: {str(e)}"}
+    return outcomes
@@ -34,16 +34,42 @@ def get_google_credentials():
 
 
 # ---- Drive helpers ----
-def _search_file_in_folder(drive_service, name: str, parent_id: str, mime: str | None = None):
-    """Tìm file theo tên trong 1 thư mục. Trả về file id nếu thấy, None nếu không."""
+def find_file_in_folder(drive_service, name: str, parent_id: str, mime: str | None = None):
+    """Tìm file theo tên trong 1 thư mục. Trả về {'id', 'name', 'modifiedTime'} nếu thấy, None nếu không."""
     safe_name = name.replace("'", "\\'")
     query_parts = [f"name = '{safe_name}'", f"'{parent_id}' in parents", "trashed = false"]
     if mime:
         query_parts.append(f"mimeType = '{mime}'")
     query = " and ".join(query_parts)
-    resp = drive_service.files().list(q=query, fields="files(id, name)", pageSize=1).execute()
+    resp = drive_service.files().list(q=query, fields="files(id, name, modifiedTime)", pageSize=1).execute()
     files = resp.get("files", [])
-    return files[0]["id"] if files else None
+    return files[0] if files else None
+
+
+def find_files_in_folder(drive_service, names, parent_id: str, mime: str | None = None) -> dict:
+    """Tìm nhiều file theo tên trong 1 thư mục bằng 1 truy vấn Drive. Trả về {tên: {'id', 'name', 'modifiedTime'}} (chỉ các file tìm thấy)."""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    name_parts = " or ".join("name = '{}'".format(n.replace("'", "\\'")) for n in names)
+    query_parts = [f"({name_parts})", f"'{parent_id}' in parents", "trashed = false"]
+    if mime:
+        query_parts.append(f"mimeType = '{mime}'")
+    query = " and ".join(query_parts)
+    found, page_token = {}, None
+    while True:
+        resp = drive_service.files().list(q=query, fields="nextPageToken, files(id, name, modifiedTime)", pageSize=1000, pageToken=page_token).execute()
+        for f in resp.get("files", []):
+            found.setdefault(f["name"], f)
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return found
+
+
+def _search_file_in_folder(drive_service, name: str, parent_id: str, mime: str | None = None):
+    """Tìm file theo tên trong 1 thư mục. Trả về file id nếu thấy, None nếu không."""
+    found = find_file_in_folder(drive_service, name, parent_id, mime)
+    return found["id"] if found else None
 
 
 def get_or_create_gdrive_folder(drive_service, folder_name: str, parent_id: str | None = None) -> str:
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+ingest_manifest.py
+Sổ nạp dữ liệu HD01: mỗi lát (Năm, Tháng, CHXD) đã nạp có 1 dòng (số dòng, checksum, thời điểm nạp).
+Bảng gốc là HD01_Ingest_Manifest trên BigQuery (xem bq_handler); file JSON ở đây là bản đệm cục bộ
+để kiểm tra "tháng đã có dữ liệu chưa" / "CHXD nào còn thiếu" mà không cần chạy job BigQuery.
+
+Biến môi trường: HD01_MANIFEST_CACHE=cache_data/hd01_manifest.json (mặc định)
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import pyarrow as pa
+
+_lock = threading.Lock()
+
+
+def _cache_path():
+    return os.getenv("HD01_MANIFEST_CACHE", os.path.join("cache_data", "hd01_manifest.json"))
+
+def _period_key(report_month, report_year):
+    return f"{int(report_year):04d}-{int(report_month):02d}"
+
+def load_cache():
+    try:
+        with open(_cache_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_cache(cache):
+    os.makedirs(os.path.dirname(_cache_path()) or ".", exist_ok=True)
+    tmp_path = _cache_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, _cache_path())
+
+def slice_checksum(arrow_table):
+    """SHA-256 trên dạng Arrow IPC của lát dữ liệu - cùng dữ liệu nạp lại sẽ ra cùng checksum."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return hashlib.sha256(sink.getvalue().to_pybytes()).hexdigest()
+
+def build_entries(tables):
+    """tables: {store_code: pyarrow.Table hoặc None (chỉ xoá)} → danh sách dòng manifest của lần nạp."""
+    loaded_at = datetime.now(timezone.utc)
+    entries = []
+    for store_code, table in tables.items():
+        has_rows = table is not None and table.num_rows > 0
+        entries.append({
+            'Ma_CHXD': store_code,
+            'Ten_CHXD': table.column('Ten_CHXD')[0].as_py() if has_rows else None,
+            'So_Dong': table.num_rows if has_rows else 0,
+            'Checksum': slice_checksum(table) if has_rows else None,
+            'Loaded_At': loaded_at,
+        })
+    return entries
+
+def _to_json(entry):
+    loaded_at = entry.get('Loaded_At')
+    return {
+        'Ten_CHXD': entry.get('Ten_CHXD'),
+        'So_Dong': int(entry.get('So_Dong') or 0),
+        'Checksum': entry.get('Checksum'),
+        'Loaded_At': loaded_at.isoformat() if hasattr(loaded_at, 'isoformat') else loaded_at,
+    }
+
+def record(report_month, report_year, entries):
+    """Ghi các lát vừa nạp vào bản đệm (giữ nguyên các CHXD khác của tháng)."""
+    with _lock:
+        cache = load_cache()
+        period = cache.setdefault(_period_key(report_month, report_year), {})
+        for entry in entries:
+            period[entry['Ma_CHXD']] = _to_json(entry)
+        _save_cache(cache)
+
+def replace_periods(entries_by_period):
+    """
+    Thay toàn bộ các tháng bằng dữ liệu đọc từ bảng manifest gốc. entries_by_period: {(tháng, năm): [entry, ...]};
+    danh sách rỗng → tháng được ghi {} (không còn dữ liệu), không giữ lại bản đệm cũ.
+    """
+    with _lock:
+        cache = load_cache()
+        for (report_month, report_year), entries in entries_by_period.items():
+            cache[_period_key(report_month, report_year)] = {e['Ma_CHXD']: _to_json(e) for e in entries}
+        _save_cache(cache)
+
+def cached_period(report_month, report_year):
+    """{store_code: {...}} của tháng trong bản đệm, hoặc None nếu tháng chưa từng được ghi nhận."""
+    return load_cache().get(_period_key(report_month, report_year))
+
+def period_has_rows(period):
+    return bool(period) and any(e.get('So_Dong', 0) > 0 for e in period.values())
+
+def period_version(period):
+    """Dấu phiên bản dữ liệu của 1 tháng (đổi khi có lát được nạp lại/xoá) từ {store_code: {...}}; None nếu tháng chưa ghi nhận."""
+    if period is None:
+        return None
+    raw = json.dumps(period, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+local_store.py
+Kho HD01 cục bộ: Parquet phân vùng theo kỳ báo cáo + DuckDB, dùng làm engine HD01 không cần BigQuery.
+
+Cấu trúc thư mục (mỗi file = 1 lát (Tháng, CHXD), ghi đè nguyên tử khi nạp lại):
+  <HD01_LOCAL_DIR>/hd01/Ky_Bao_Cao=2025-08/<Ma_CHXD>.parquet
+
+Bật bằng biến môi trường (xem bq_handler.hd01_backend):
+  HD01_BACKEND=local        → nạp + đọc hoàn toàn cục bộ (chạy offline được)
+  HD01_LOCAL_MIRROR=1       → backend BigQuery nhưng mỗi lần nạp ghi thêm 1 bản cục bộ
+  HD01_LOCAL_DIR=local_data (mặc định)
+"""
+import glob
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+
+import pyarrow.parquet as pq
+
+import bq_handler
+
+
+def _duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise RuntimeError("Chưa cài thư viện duckdb (pip install duckdb) - cần cho kho HD01 cục bộ.")
+    return duckdb
+
+def _root_dir():
+    return os.path.join(os.getenv("HD01_LOCAL_DIR", "local_data"), "hd01")
+
+def _month_dir(report_month, report_year):
+    return os.path.join(_root_dir(), f"{bq_handler.PARTITION_FIELD}={int(report_year):04d}-{int(report_month):02d}")
+
+def _slice_path(store_code, report_month, report_year):
+    return os.path.join(_month_dir(report_month, report_year), re.sub(r'[^\w.\-]', '_', str(store_code)) + ".parquet")
+
+def _month_files(report_month, report_year):
+    return sorted(glob.glob(os.path.join(_month_dir(report_month, report_year), "*.parquet")))
+
+def month_has_data(report_month, report_year):
+    return bool(_month_files(report_month, report_year))
+
+def month_version(report_month, report_year):
+    """Dấu phiên bản dữ liệu của tháng: tên + kích thước + thời điểm ghi của từng file lát (nạp lại lát nào là đổi)."""
+    parts = []
+    for path in _month_files(report_month, report_year):
+        st = os.stat(path)
+        parts.append(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}")
+    return hashlib.sha256("\n".join(parts).encode('utf-8')).hexdigest()[:16]
+
+def replace_month_data(tables, report_month, report_year):
+    """
+    Thay nguyên lát (Tháng, CHXD), trả về cùng dạng thống kê với bq_handler.replace_month_data.
+    tables: {store_code: pyarrow.Table đã đúng HD01_ARROW_SCHEMA, hoặc None = chỉ xoá}.
+    """
+    os.makedirs(_month_dir(report_month, report_year), exist_ok=True)
+    staged, deleted, written = 0, 0, 0
+    for store_code, table in tables.items():
+        path = _slice_path(store_code, report_month, report_year)
+        if os.path.exists(path):
+            deleted += pq.read_metadata(path).num_rows
+        if table is None or table.num_rows == 0:
+            if os.path.exists(path): os.remove(path)
+            continue
+        tmp_path = path + ".tmp"
+        pq.write_table(table, tmp_path, compression=bq_handler.PARQUET_COMPRESSION)
+        os.replace(tmp_path, path)
+        staged += table.num_rows
+        written += os.path.getsize(path)
+    return {'stores': len(tables), 'staged': staged, 'inserted': staged, 'deleted': deleted, 'uploaded_bytes': written}
+
+@contextmanager
+def _month_connection(report_month, report_year, frames):
+    """
+    Kết nối DuckDB đã khai báo sẵn các bảng của 1 tháng:
+    - hd01_current: dữ liệu tháng đã khử trùng lặp (đúng quy tắc DEDUP_QUALIFY như HD01_Current),
+    - các DataFrame truyền qua frames theo đúng tên khoá.
+    """
+    con = _duckdb().connect()
+    try:
+        files = _month_files(report_month, report_year)
+        if files:
+            con.read_parquet(files).create_view("hd01_raw")
+        else:
+            con.register("hd01_raw", bq_handler.HD01_ARROW_SCHEMA.empty_table())
+        con.execute(f"CREATE VIEW hd01_current AS SELECT * FROM hd01_raw {bq_handler.DEDUP_QUALIFY}")
+        for name, frame in frames.items():
+            con.register(name, frame)
+        yield con
+    finally:
+        con.close()
+
+def query(sql, report_month, report_year, params=None, **frames):
+    """Chạy SQL (DuckDB) trên dữ liệu 1 tháng, trả về DataFrame (xem _month_connection cho tên bảng dùng được)."""
+    with _month_connection(report_month, report_year, frames) as con:
+        return con.execute(sql, params or []).df()
+
+def iter_query_batches(sql, report_month, report_year, params=None, batch_rows=50000, **frames):
+    """Như query() nhưng trả về lần lượt từng pyarrow.RecordBatch."""
+    with _month_connection(report_month, report_year, frames) as con:
+        yield from con.execute(sql, params or []).fetch_record_batch(batch_rows)
+
+def get_aggregate_detail(report_month, report_year):
+    """Bảng chi tiết CHXD × Nhóm hàng × Trạng thái, cùng dạng với bảng HD01_Monthly_Rollup."""
+    sql = f"""
+        SELECT Ten_CHXD, Nhom_Hang, Trang_Thai_Lower, {', '.join(bq_handler.AGG_METRICS)}
+        FROM ({bq_handler._rollup_select_sql("hd01_current", "TRUE")})
+    """
+    return query(sql, report_month, report_year)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+query_cache.py
+Bộ nhớ đệm kết quả truy vấn HD01 (RAM + Parquet trên đĩa) cho các hàm đọc của bq_handler.
+
+- Khoá = loại truy vấn + engine + tham số + "phiên bản nạp" của (Năm, Tháng, CHXD) liên quan.
+- Mỗi lần nạp/xoá dữ liệu (bq_handler.replace_month_data, nên cả upload_dataframe / delete_old_data)
+  tăng phiên bản các CHXD vừa nạp → khoá cũ tự mất hiệu lực; file đệm của tháng đó bị dọn luôn.
+- TTL (mặc định 6 giờ) chặn trường hợp dữ liệu được nạp từ máy khác không đi qua tiến trình này.
+
+Biến môi trường:
+  HD01_CACHE=0                 → tắt bộ nhớ đệm
+  HD01_CACHE_DIR=cache_data    (mặc định)
+  HD01_CACHE_TTL_SECONDS=21600 (mặc định)
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import cache_utils
+
+MEMORY_MAX_ENTRIES = 32
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # key -> (thời điểm tạo, DataFrame)
+_stats = {}              # kind -> {'memory_hits', 'disk_hits', 'misses'}
+
+
+def enabled():
+    return cache_utils.env_enabled("HD01_CACHE")
+
+def _cache_dir():
+    return os.path.join(os.getenv("HD01_CACHE_DIR", "cache_data"), "hd01")
+
+def _ttl_seconds():
+    return cache_utils.env_int("HD01_CACHE_TTL_SECONDS", 21600)
+
+def _period_key(report_month, report_year):
+    return f"{int(report_year):04d}-{int(report_month):02d}"
+
+def _versions_path():
+    return os.path.join(_cache_dir(), "versions.json")
+
+def _load_versions():
+    try:
+        with open(_versions_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def bump_versions(report_month, report_year, store_codes):
+    """Tăng phiên bản nạp của các CHXD trong tháng và dọn các kết quả đệm của tháng đó."""
+    period = _period_key(report_month, report_year)
+    with _lock:
+        os.makedirs(_cache_dir(), exist_ok=True)
+        versions = _load_versions()
+        month_versions = versions.setdefault(period, {})
+        for code in store_codes:
+            month_versions[code] = month_versions.get(code, 0) + 1
+        def write_versions(p):
+            with open(p, 'w', encoding='utf-8') as f:
+                json.dump(versions, f, ensure_ascii=False, indent=1)
+        cache_utils.write_atomic(_versions_path(), write_versions)
+
+        for key in [k for k in _memory if f"_{period}_" in k]:
+            del _memory[key]
+        for path in glob.glob(os.path.join(_cache_dir(), f"*_{period}_*.parquet")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _version_token(report_month, report_year, store_code):
+    month_versions = _load_versions().get(_period_key(report_month, report_year), {})
+    if store_code and store_code != 'ALL':
+        return month_versions.get(store_code, 0)
+    return month_versions
+
+def _count(kind, field):
+    cache_utils.count(_stats, kind, field, ('memory_hits', 'disk_hits', 'misses'))
+
+def _key_and_path(kind, report_month, report_year, store_code, backend, params):
+    period = _period_key(report_month, report_year)
+    raw_key = json.dumps({'kind': kind, 'backend': backend, 'period': period, 'store': store_code or 'ALL', 'params': params,
+                          'version': _version_token(report_month, report_year, store_code)}, sort_keys=True, ensure_ascii=False)
+    key = f"{kind}_{period}_{hashlib.sha1(raw_key.encode('utf-8')).hexdigest()[:16]}"
+    return key, os.path.join(_cache_dir(), f"{key}.parquet")
+
+def cached_frame(kind, report_month, report_year, store_code, compute, backend="", **params):
+    """
+    Trả về DataFrame của compute() qua bộ nhớ đệm 2 tầng (RAM → Parquet trên đĩa → chạy truy vấn thật).
+    Luôn trả về bản sao để nơi gọi sửa thoải mái mà không làm hỏng dữ liệu đệm.
+    """
+    if not enabled():
+        return compute()
+
+    key, path = _key_and_path(kind, report_month, report_year, store_code, backend, params)
+    now = time.time()
+
+    with _lock:
+        entry = _memory.get(key)
+        if entry and now - entry[0] < _ttl_seconds():
+            _memory.move_to_end(key)
+            _count(kind, 'memory_hits')
+            return entry[1].copy()
+
+    df = None
+    if os.path.exists(path) and now - os.path.getmtime(path) < _ttl_seconds():
+        try:
+            df = pd.read_parquet(path)
+            field = 'disk_hits'
+        except Exception as e:
+            print(f"[Cache] Bỏ qua file đệm hỏng {path}: {e}")
+    if df is None:
+        df = compute()
+        field = 'misses'
+        try:
+            os.makedirs(_cache_dir(), exist_ok=True)
+            cache_utils.write_atomic(path, lambda p: df.to_parquet(p, index=False))
+        except Exception as e:
+            print(f"[Cache] Không ghi được file đệm {path}: {e}")
+
+    with _lock:
+        _count(kind, field)
+        _memory[key] = (now, df)
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_MAX_ENTRIES:
+            _memory.popitem(last=False)
+    return df.copy()
+
+def cached_batches(kind, report_month, report_year, store_code, produce, backend="", **params):
+    """
+    Bản dạng luồng của cached_frame cho các kết quả lớn: trả về từng pyarrow.RecordBatch, không giữ cả bảng trong RAM.
+    - Trúng đệm: đọc lần lượt từng lô từ file Parquet trên đĩa.
+    - Trượt: vừa chuyển tiếp từng lô của produce() vừa ghi dần ra file đệm; chỉ công bố file khi đã đọc hết
+      (người dùng huỷ tải giữa chừng thì bỏ file dở). Dùng chung khoá/file với cached_frame cùng loại truy vấn.
+    """
+    if not enabled():
+        yield from produce()
+        return
+
+    key, path = _key_and_path(kind, report_month, report_year, store_code, backend, params)
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < _ttl_seconds():
+        with _lock:
+            _count(kind, 'disk_hits')
+        yield from pq.ParquetFile(path).iter_batches()
+        return
+
+    with _lock:
+        _count(kind, 'misses')
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    writer, complete = None, False
+    try:
+        for batch in produce():
+            if writer is None:
+                os.makedirs(_cache_dir(), exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, batch.schema)
+            writer.write_batch(batch)
+            yield batch
+        complete = True
+    finally:
+        if writer is not None:
+            writer.close()
+            if complete:
+                os.replace(tmp_path, path)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def stats():
+    """Số liệu hit/miss theo loại truy vấn (của tiến trình hiện tại) + trạng thái bộ nhớ đệm."""
+    with _lock:
+        by_kind = {kind: dict(counts) for kind, counts in _stats.items()}
+        memory_entries = len(_memory)
+    for counts in by_kind.values():
+        total = counts['memory_hits'] + counts['disk_hits'] + counts['misses']
+        counts['hit_rate'] = round((total - counts['misses']) / total, 3) if total else 0.0
+    disk_files = glob.glob(os.path.join(_cache_dir(), "*.parquet"))
+    return {
+        'enabled': enabled(),
+        'ttl_seconds': _ttl_seconds(),
+        'memory_entries': memory_entries,
+        'disk_files': len(disk_files),
+        'disk_bytes': sum(os.path.getsize(p) for p in disk_files),
+        'by_kind': by_kind,
+    }
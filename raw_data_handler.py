@@ -1,45 +1,65 @@
 # -*- coding: utf-8 -*-
-import pandas as pd
 import io
+import csv
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, PatternFill
 from openpyxl.utils import get_column_letter
 
-def export_to_excel_raw(df):
+RAW_SHEET_NAME = 'Du_Lieu_Tho_HD01'
+CENTER_COLS = ['Ma_CHXD', 'Ky_Hieu', 'So_HD', 'Ngay_Hoa_Don', 'DVT', 'Trang_Thai_HD']
+
+def export_batches_to_excel_raw(batches, output):
     """
-    Hàm nguyên tử: Biến DataFrame thô từ BigQuery thành file Excel chuyên nghiệp.
-    Tách biệt hoàn toàn để không ảnh hưởng đến logic tính toán tổng hợp.
+    Xuất dữ liệu thô HD01 ra Excel: ghi lần lượt từng lô pyarrow.RecordBatch vào workbook write_only
+    (openpyxl đẩy dòng ra file tạm), nên bộ nhớ không tăng theo số hóa đơn của tháng.
+    Tiêu đề nền xanh chữ trắng, cột rộng 22, căn giữa các cột mã/ngày/trạng thái (CENTER_COLS).
+    Trả về số dòng đã ghi; 0 nghĩa là không có dữ liệu và không ghi gì vào output.
     """
-    if df is None or df.empty:
-        return None
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(RAW_SHEET_NAME)
+    header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    center_align = Alignment(horizontal="center", vertical="center")
 
-    output = io.BytesIO()
-    # Sử dụng engine openpyxl để format bảng biểu
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Du_Lieu_Tho_HD01')
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Du_Lieu_Tho_HD01']
-        
-        # 1. Định dạng Header (Dòng 1)
-        header_fill = PatternFill(start_color="1F4E78", end_color="1F4E78", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        center_align = Alignment(horizontal="center", vertical="center")
-        
-        for col_idx, cell in enumerate(worksheet[1], 1):
+    def styled(value, header=False):
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.alignment = center_align
+        if header:
             cell.fill = header_fill
             cell.font = header_font
-            cell.alignment = center_align
-            
-            # 2. Tự động chỉnh độ rộng cột cơ bản
-            column_letter = get_column_letter(col_idx)
-            worksheet.column_dimensions[column_letter].width = 22
+        return cell
+
+    total_rows, center_flags = 0, None
+    for batch in batches:
+        if center_flags is None:
+            names = batch.schema.names
+            for col_idx in range(1, len(names) + 1):
+                worksheet.column_dimensions[get_column_letter(col_idx)].width = 22
+            worksheet.append([styled(name, header=True) for name in names])
+            center_flags = [name in CENTER_COLS for name in names]
+        columns = [column.to_pylist() for column in batch.columns]
+        for values in zip(*columns):
+            worksheet.append([styled(v) if center else v for v, center in zip(values, center_flags)])
+        total_rows += batch.num_rows
 
-        # 3. Định dạng dữ liệu: Căn giữa các cột mã, ngày tháng, trạng thái
-        center_cols = ['Ma_CHXD', 'Ky_Hieu', 'So_HD', 'Ngay_Hoa_Don', 'DVT', 'Trang_Thai_HD']
-        for col_idx, column in enumerate(df.columns, 1):
-            if column in center_cols:
-                for row in range(2, worksheet.max_row + 1):
-                    worksheet.cell(row=row, column=col_idx).alignment = center_align
+    if total_rows == 0:
+        return 0
+    workbook.save(output)
+    return total_rows
 
-    output.seek(0)
-    return output
\ No newline at end of file
+def iter_csv_raw(batches):
+    """Xuất dữ liệu thô dạng CSV (UTF-8 có BOM để Excel đọc đúng tiếng Việt), trả về từng đoạn văn bản theo lô → tải về được ngay."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    for batch in batches:
+        if not header_written:
+            buffer.write('\ufeff')
+            writer.writerow(batch.schema.names)
+            header_written = True
+        columns = [column.to_pylist() for column in batch.columns]
+        writer.writerows(['' if v is None else v for v in values] for values in zip(*columns))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
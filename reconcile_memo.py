@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+reconcile_memo.py
+Ghi nhớ đối soát theo nội dung file tải lên + phiên bản dữ liệu phía hệ thống: nhân viên tải lại đúng file cũ
+(trong lúc chờ sửa dữ liệu nguồn) thì không phải đọc lại file, tải lại Google Sheet hay hỏi lại BigQuery.
+
+- Khoá kết quả = loại đối soát + SHA-256 của file tải lên + phiên bản dữ liệu đối chiếu
+  (modifiedTime trên Drive của Sheet BCBH/CongNo, hoặc phiên bản sổ nạp HD01 của tháng) + cấu hình ánh xạ đang dùng.
+  Trúng → trả lại result_id đã lưu trong result_store (kết quả còn hạn), không chạy lại gì.
+- Chỉ 1 phía thay đổi → mỗi phía có đệm riêng nên chỉ phía đổi phải làm lại:
+    input_<loại>  → DataFrame đọc từ file kế toán / Bảng kê Thuế, khoá theo hash file (Parquet + JSON thông tin thêm)
+    pos_<loại>    → giá trị Sheet TongHop* của POS, khoá theo id file + modifiedTime (JSON)
+- Đệm quá TTL bị bỏ qua khi đọc và được dọn mỗi lần ghi.
+
+Biến môi trường:
+  RECONCILE_MEMO=0                     → tắt (luôn đối soát lại từ đầu)
+  RECONCILE_MEMO_DIR=cache_data/reconcile_memo (mặc định)
+  RECONCILE_MEMO_TTL_SECONDS=86400     (mặc định 1 ngày, bằng TTL của result_store)
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+import cache_utils
+import config
+import result_store
+
+_lock = threading.Lock()
+_stats = {}  # kind -> {'hits', 'misses'}
+
+
+def enabled():
+    return cache_utils.env_enabled("RECONCILE_MEMO")
+
+def _memo_dir():
+    return os.getenv("RECONCILE_MEMO_DIR", os.path.join("cache_data", "reconcile_memo"))
+
+def _ttl_seconds():
+    return cache_utils.env_int("RECONCILE_MEMO_TTL_SECONDS", 86400)
+
+def _path(kind, key, ext):
+    return os.path.join(_memo_dir(), f"{kind}_{key}.{ext}")
+
+def _fresh(path):
+    try:
+        return time.time() - os.path.getmtime(path) < _ttl_seconds()
+    except OSError:
+        return False
+
+def _count(kind, field):
+    with _lock:
+        cache_utils.count(_stats, kind, field, ('hits', 'misses'))
+
+def _write_json(path, payload):
+    def write(p):
+        with open(p, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, default=str)
+    cache_utils.write_atomic(path, write)
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def make_key(*parts):
+    """Khoá ngắn (hex) từ các thành phần bất kỳ (chuỗi, số, dict...)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+def file_digest(file_stream, chunk_size=1024 * 1024):
+    """SHA-256 nội dung file nhị phân seek được; đưa con trỏ về đầu file sau khi băm."""
+    digest = hashlib.sha256()
+    file_stream.seek(0)
+    for chunk in iter(lambda: file_stream.read(chunk_size), b''):
+        digest.update(chunk)
+    file_stream.seek(0)
+    return digest.hexdigest()
+
+def _rules_fingerprint(reconcile_type):
+    """Cấu hình quyết định kết quả so khớp (ánh xạ CHXD, mặt hàng, ngưỡng ghép tên, engine HoaDon) - đổi cấu hình là đổi khoá."""
+    import reconciliation_handler
+    if reconcile_type == 'HoaDon':
+        return {'engine': reconciliation_handler.invoice_engine()}
+    rules = {'stores': config.STORE_INFO}
+    if reconcile_type == 'SanLuong':
+        rules.update(mapping=config.STORE_MAPPING_SSE_TO_POS, products=config.TARGET_PRODUCTS_BH03)
+    elif reconcile_type == 'TienMat':
+        rules.update(mapping=config.STORE_MAPPING_CASH_SSE_TO_POS)
+    elif reconcile_type == 'CongNo':
+        rules.update(fuzzy_threshold=reconciliation_handler.debt_fuzzy_threshold())
+    return rules
+
+def result_key(reconcile_type, file_hash, data_version, **params):
+    """Khoá kết quả đối soát; data_version None (không xác định được phiên bản dữ liệu) → None, tức không dùng memo kết quả."""
+    if data_version is None:
+        return None
+    return make_key('result', reconcile_type, file_hash, data_version, params, _rules_fingerprint(reconcile_type))
+
+def lookup_result(key):
+    """result_id đã lưu cho khoá (và kết quả vẫn còn trong result_store), hoặc None."""
+    if not enabled() or key is None:
+        return None
+    path = _path('result', key, "json")
+    entry = _read_json(path) if _fresh(path) else None
+    result_id = entry.get('result_id') if entry else None
+    if result_id and result_store.load_meta(result_id) is not None:
+        _count('result', 'hits')
+        return result_id
+    _count('result', 'misses')
+    return None
+
+def remember_result(key, result_id):
+    """Ghi nhớ result_id cho khoá (bỏ qua nếu kết quả không lưu được)."""
+    if not enabled() or key is None or not result_id:
+        return
+    try:
+        os.makedirs(_memo_dir(), exist_ok=True)
+        _write_json(_path('result', key, "json"), {'result_id': result_id, 'created_at': time.time()})
+    except Exception as e:
+        print(f"[Cảnh báo] Không ghi nhớ được kết quả đối soát: {e}")
+    _sweep_quietly()
+
+def cached_frame(kind, key, compute):
+    """
+    (DataFrame, dict thông tin thêm) của compute() qua đệm đĩa. compute() trả về (df, extra);
+    df None (file không hợp lệ) thì không ghi đệm để lần sau vẫn báo lỗi như cũ.
+    """
+    if not enabled():
+        return compute()
+    frame_path, extra_path = _path(kind, key, "parquet"), _path(kind, key, "json")
+    if _fresh(frame_path) and _fresh(extra_path):
+        try:
+            df, extra = pd.read_parquet(frame_path), _read_json(extra_path)
+            if extra is not None:
+                _count(kind, 'hits')
+                return df, extra
+        except Exception as e:
+            print(f"[Cảnh báo] Bỏ qua file đệm hỏng {frame_path}: {e}")
+    _count(kind, 'misses')
+    df, extra = compute()
+    if df is not None:
+        try:
+            os.makedirs(_memo_dir(), exist_ok=True)
+            cache_utils.write_atomic(frame_path, lambda p: df.to_parquet(p, index=False))
+            _write_json(extra_path, extra)
+        except Exception as e:
+            print(f"[Cảnh báo] Không ghi được file đệm {frame_path}: {e}")
+        _sweep_quietly()
+    return df, extra
+
+def cached_values(kind, key, compute):
+    """Giá trị JSON được (vd list các dòng của 1 Google Sheet) của compute() qua đệm đĩa."""
+    if not enabled():
+        return compute()
+    path = _path(kind, key, "json")
+    if _fresh(path):
+        entry = _read_json(path)
+        if entry is not None:
+            _count(kind, 'hits')
+            return entry['values']
+    _count(kind, 'misses')
+    values = compute()
+    try:
+        os.makedirs(_memo_dir(), exist_ok=True)
+        _write_json(path, {'values': values})
+    except Exception as e:
+        print(f"[Cảnh báo] Không ghi được file đệm {path}: {e}")
+    _sweep_quietly()
+    return values
+
+def sweep():
+    """Xoá các file đệm đã quá TTL. Trả về số file đã xoá."""
+    removed = 0
+    for path in glob.glob(os.path.join(_memo_dir(), "*")):
+        if not _fresh(path):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def _sweep_quietly():
+    try:
+        sweep()
+    except Exception as e:
+        print(f"[Cảnh báo] Không dọn được đệm đối soát cũ: {e}")
+
+def stats():
+    """Số liệu hit/miss theo loại đệm (của tiến trình hiện tại) + dung lượng trên đĩa."""
+    with _lock:
+        by_kind = {kind: dict(counts) for kind, counts in _stats.items()}
+    for counts in by_kind.values():
+        total = counts['hits'] + counts['misses']
+        counts['hit_rate'] = round(counts['hits'] / total, 3) if total else 0.0
+    files = glob.glob(os.path.join(_memo_dir(), "*"))
+    return {
+        'enabled': enabled(),
+        'ttl_seconds': _ttl_seconds(),
+        'disk_files': len(files),
+        'disk_bytes': sum(os.path.getsize(p) for p in files),
+        'by_kind': by_kind,
+    }
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 import config
-import xml.etree.ElementTree as ET
+import os
+from lxml import etree
 import re
 from datetime import datetime
 import logging
 import unicodedata
-import uuid
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+import heapq
 
 logger = logging.getLogger(__name__)
 
@@ -14,31 +17,34 @@ logger = logging.getLogger(__name__)
 # HÀM DÙNG CHUNG
 # ==============================================================================
 
+_DIACRITICS_TABLE = str.maketrans({
+    'à':'a','á':'a','ả':'a','ã':'a','ạ':'a','ă':'a','ằ':'a','ắ':'a','ẳ':'a','ẵ':'a','ặ':'a','â':'a','ầ':'a','ấ':'a','ẩ':'a','ẫ':'a','ậ':'a',
+    'è':'e','é':'e','ẻ':'e','ẽ':'e','ẹ':'e','ê':'e','ề':'e','ế':'e','ể':'e','ễ':'e','ệ':'e',
+    'ì':'i','í':'i','ỉ':'i','ĩ':'i','ị':'i',
+    'ò':'o','ó':'o','ỏ':'o','õ':'o','ọ':'o','ô':'o','ồ':'o','ố':'o','ổ':'o','ỗ':'o','ộ':'o','ơ':'o','ờ':'o','ớ':'o','ở':'o','ỡ':'o','ợ':'o',
+    'ù':'u','ú':'u','ủ':'u','ũ':'u','ụ':'u','ư':'u','ừ':'u','ứ':'u','ử':'u','ữ':'u','ự':'u',
+    'ỳ':'y','ý':'y','ỷ':'y','ỹ':'y','ỵ':'y',
+    'đ':'d','À':'A','Á':'A','Ả':'A','Ã':'A','Ạ':'A','Ă':'A','Ằ':'A','Ắ':'A','Ẳ':'A','Ẵ':'A','Ặ':'A','Â':'A','Ầ':'A','Ấ':'A','Ẩ':'A','Ẫ':'A','Ậ':'A',
+    'È':'E','É':'E','Ẻ':'E','Ẽ':'E','Ẹ':'E','Ê':'E','Ề':'E','Ế':'E','Ể':'E','Ễ':'E','Ệ':'E',
+    'Ì':'I','Í':'I','Ỉ':'I','Ĩ':'I','Ị':'I',
+    'Ò':'O','Ó':'O','Ỏ':'O','Õ':'O','Ọ':'O','Ô':'O','Ồ':'O','Ố':'O','Ổ':'O','Ỗ':'O','Ộ':'O','Ơ':'O','Ờ':'O','Ớ':'O','Ở':'O','Ỡ':'O','Ợ':'O',
+    'Ù':'U','Ú':'U','Ủ':'U','Ũ':'U','Ụ':'U','Ư':'U','Ừ':'U','Ứ':'U','Ử':'U','Ữ':'U','Ự':'U',
+    'Ỳ':'Y','Ý':'Y','Ỷ':'Y','Ỹ':'Y','Ỵ':'Y','Đ':'D'
+})
+
 def _strip_diacritics(s: str) -> str:
     """Bỏ dấu tiếng Việt (đủ dùng cho so khớp mềm)."""
     if s is None:
         return ''
-    s = str(s)
-    repl = {
-        'à':'a','á':'a','ả':'a','ã':'a','ạ':'a','ă':'a','ằ':'a','ắ':'a','ẳ':'a','ẵ':'a','ặ':'a','â':'a','ầ':'a','ấ':'a','ẩ':'a','ẫ':'a','ậ':'a',
-        'è':'e','é':'e','ẻ':'e','ẽ':'e','ẹ':'e','ê':'e','ề':'e','ế':'e','ể':'e','ễ':'e','ệ':'e',
-        'ì':'i','í':'i','ỉ':'i','ĩ':'i','ị':'i',
-        'ò':'o','ó':'o','ỏ':'o','õ':'o','ọ':'o','ô':'o','ồ':'o','ố':'o','ổ':'o','ỗ':'o','ộ':'o','ơ':'o','ờ':'o','ớ':'o','ở':'o','ỡ':'o','ợ':'o',
-        'ù':'u','ú':'u','ủ':'u','ũ':'u','ụ':'u','ư':'u','ừ':'u','ứ':'u','ử':'u','ữ':'u','ự':'u',
-        'ỳ':'y','ý':'y','ỷ':'y','ỹ':'y','ỵ':'y',
-        'đ':'d','À':'A','Á':'A','Ả':'A','Ã':'A','Ạ':'A','Ă':'A','Ằ':'A','Ắ':'A','Ẳ':'A','Ẵ':'A','Ặ':'A','Â':'A','Ầ':'A','Ấ':'A','Ẩ':'A','Ẫ':'A','Ậ':'A',
-        'È':'E','É':'E','Ẻ':'E','Ẽ':'E','Ẹ':'E','Ê':'E','Ề':'E','Ế':'E','Ể':'E','Ễ':'E','Ệ':'E',
-        'Ì':'I','Í':'I','Ỉ':'I','Ĩ':'I','Ị':'I',
-        'Ò':'O','Ó':'O','Ỏ':'O','Õ':'O','Ọ':'O','Ô':'O','Ồ':'O','Ố':'O','Ổ':'O','Ỗ':'O','Ộ':'O','Ơ':'O','Ờ':'O','Ớ':'O','Ở':'O','Ỡ':'O','Ợ':'O',
-        'Ù':'U','Ú':'U','Ủ':'U','Ũ':'U','Ụ':'U','Ư':'U','Ừ':'U','Ứ':'U','Ử':'U','Ữ':'U','Ự':'U',
-        'Ỳ':'Y','Ý':'Y','Ỷ':'Y','Ỹ':'Y','Ỵ':'Y','Đ':'D'
-    }
-    return ''.join(repl.get(c, c) for c in s)
+    return str(s).translate(_DIACRITICS_TABLE)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_O_BEFORE_DIGIT_RE = re.compile(r'O(?=\d)')
 
 def _norm_key(s: str) -> str:
     """Chuẩn hoá để so khớp: lower + bỏ dấu + gộp khoảng trắng."""
     s = _strip_diacritics(s).lower().strip()
-    return re.sub(r'\s+', ' ', s)
+    return _WHITESPACE_RE.sub(' ', s)
 
 def _canon_store_key(name: str) -> str:
     """Khoá CHXD thống nhất để ghép: bỏ phần trong ngoặc cuối, lower + bỏ dấu + gộp khoảng trắng."""
@@ -56,25 +62,138 @@ def _canon_store_display(name: str) -> str:
 def _norm_code(s: str) -> str:
     """Chuẩn hoá mã KH/đơn vị: upper, bỏ khoảng trắng, đổi O→0 khi ngay trước số."""
     s = '' if s is None else str(s)
-    s = re.sub(r'\s+', '', s).upper()
-    s = re.sub(r'O(?=\d)', '0', s)  # KDNLO72 ~ KDNL072
+    s = _WHITESPACE_RE.sub('', s).upper()
+    s = _O_BEFORE_DIGIT_RE.sub('0', s)  # KDNLO72 ~ KDNL072
     return s
 
 def _codes_equal(a: str, b: str) -> bool:
     return _norm_code(a) == _norm_code(b)
 
+HEADER_KEYS = {'ma khach', 'ma kh', 'ten khach', 'ten khach hang', 'phat sinh no', 'ps no', 'stt'}
+
+def _is_header_row(row):
+    """Dòng tiêu đề: chứa 1 trong các cột khoá."""
+    safe = [str(x) if x is not None else '' for x in row]
+    if _norm_key(' '.join(safe)) == '':
+        return False
+    return bool({_norm_key(c) for c in safe if c} & HEADER_KEYS)
+
 def find_header_row_index(all_rows):
     """Tìm dòng tiêu đề: chứa 1 trong các cột khoá."""
-    must_have_any = {'ma khach', 'ma kh', 'ten khach', 'ten khach hang', 'phat sinh no', 'ps no', 'stt'}
     for i, row in enumerate(all_rows):
-        safe = [str(x) if x is not None else '' for x in row]
-        if _norm_key(' '.join(safe)) == '':
-            continue
-        keys = {_norm_key(c) for c in safe if c}
-        if keys & must_have_any:
+        if _is_header_row(row):
             return i
     return -1
 
+# ==============================================================================
+# ĐỌC FILE SPREADSHEETML (XML 2003) XUẤT TỪ SSE - ĐỌC LUỒNG, BỘ NHỚ GIỚI HẠN
+# ==============================================================================
+SS_NS = "urn:schemas-microsoft-com:office:spreadsheet"
+_SS_ROW, _SS_CELL, _SS_DATA, _SS_TABLE = (f"{{{SS_NS}}}{name}" for name in ("Row", "Cell", "Data", "Table"))
+_SS_INDEX = f"{{{SS_NS}}}Index"
+_SS_MERGE_ACROSS = f"{{{SS_NS}}}MergeAcross"
+
+_TABLE_TAGS = frozenset((_SS_TABLE, "Table"))
+_CELL_TAGS = frozenset((_SS_CELL, "Cell"))
+_DATA_TAGS = frozenset((_SS_DATA, "Data"))
+_ROW_BATCH = 1000
+# Cả lô dòng "đơn giản" (mọi con của Row là Cell, không Index/MergeAcross, con của Cell chỉ là Data) → lấy giá trị
+# bằng 1 list comprehension thay vì xét từng ô; 1 lần XPath (chạy trong libxml2) cho cả lô rẻ hơn nhiều so với kiểm tra trong Python
+_SIMPLE_ROWS = etree.XPath(
+    "not(ss:Row/ss:Cell/@*[local-name()='Index' or local-name()='MergeAcross'])"
+    " and count(ss:Row/*) = count(ss:Row/ss:Cell) and count(ss:Row/ss:Cell/*) = count(ss:Row/ss:Cell/ss:Data)",
+    namespaces={'ss': SS_NS})
+
+def _row_values(row_elem):
+    values, col = [], 0
+    for cell in row_elem:
+        if cell.tag not in _CELL_TAGS:
+            continue
+        merge = 0
+        if cell.attrib:
+            index = cell.get(_SS_INDEX) or cell.get('Index')
+            if index:
+                col = int(index) - 1
+            merge = int(cell.get(_SS_MERGE_ACROSS) or cell.get('MergeAcross') or 0)
+        if col > len(values):
+            values.extend([None] * (col - len(values)))
+        value = None
+        for data in cell:
+            if data.tag in _DATA_TAGS:
+                value = data.text or ''
+                break
+        values.append(value)
+        col += 1 + merge
+    return values
+
+def _flush_rows(batch):
+    """Giá trị các dòng trong lô (cùng 1 cha) rồi giải phóng chúng khỏi cây đang dựng."""
+    parent = batch[0].getparent()
+    if parent is None or parent.tag not in _TABLE_TAGS:
+        rows = []
+    elif parent.tag == _SS_TABLE and _SIMPLE_ROWS(parent):
+        rows = [[(cell[0].text or '') if len(cell) else None for cell in row_elem] for row_elem in batch]
+    else:
+        rows = [_row_values(row_elem) for row_elem in batch]
+    for row_elem in batch:
+        row_elem.clear()
+    last = batch[-1]
+    while parent is not None and last.getprevious() is not None:
+        del parent[0]
+    batch.clear()
+    return rows
+
+def _iter_rows(file_stream, encoding):
+    context = etree.iterparse(file_stream, events=('end',), tag=(_SS_ROW, "Row"),
+                              encoding=encoding, huge_tree=True, remove_comments=True)
+    batch = []
+    for _, row_elem in context:
+        if batch and row_elem.getparent() is not batch[0].getparent():
+            yield from _flush_rows(batch)
+        batch.append(row_elem)
+        if len(batch) >= _ROW_BATCH:
+            yield from _flush_rows(batch)
+    if batch:
+        yield from _flush_rows(batch)
+    del context
+
+def iter_spreadsheetml_rows(file_stream):
+    """
+    Đọc lần lượt từng dòng <Row> trong các <Table> của file SpreadsheetML bằng lxml.iterparse, trên bytes gốc (không giải mã cả file).
+    Mỗi dòng là list giá trị <Data> đặt đúng cột theo ss:Index / ss:MergeAcross (ô bị bỏ qua = None; <Data> rỗng = '').
+    Các dòng được xử lý theo lô 1000 dòng rồi giải phóng ngay nên bộ nhớ không tăng theo độ dài file.
+
+    Mã hoá theo khai báo <?xml encoding=...?> (không có thì UTF-8). Gặp byte sai mã hoá thì đọc lại file bằng
+    windows-1252 như cách đọc cũ, bỏ qua các dòng đã trả về trước đó.
+    """
+    yielded = 0
+    try:
+        for values in _iter_rows(file_stream, None):
+            yield values
+            yielded += 1
+        return
+    except etree.XMLSyntaxError as e:
+        if e.code != etree.ErrorTypes.ERR_INVALID_ENCODING:
+            raise
+    file_stream.seek(0)
+    for i, values in enumerate(_iter_rows(file_stream, 'windows-1252')):
+        if i >= yielded:
+            yield values
+
+def read_spreadsheetml_table(file_stream):
+    """
+    Dò dòng tiêu đề ngay trong lúc đọc luồng. Trả về (header, data_rows) với data_rows là iterator các dòng
+    dữ liệu (bỏ 1 dòng ngay dưới tiêu đề như cách đọc cũ), hoặc (None, None) nếu không thấy tiêu đề/thiếu dữ liệu.
+    """
+    rows = iter_spreadsheetml_rows(file_stream)
+    for row in rows:
+        if _is_header_row(row):
+            if next(rows, None) is None:
+                break
+            return row, rows
+    rows.close()
+    return None, None
+
 def clean_and_convert_to_numeric(series):
     return pd.to_numeric(
         series.astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False),
@@ -93,177 +212,190 @@ def find_date_in_headers(header_list):
                 return m.group(0)
     return None
 
+SSE_PRODUCT_COLUMNS = {
+    'Dầu Điêzen 0,001S Mức 5': 'Dầu DO 0,001S-V',
+    'Dầu mỡ nhờn': 'Dầu mỡ nhờn',
+    'Dầu Điêzen 0,05S Mức 2': 'DO',
+    'Xăng RON95 Mức 3': 'Xăng A95',
+    'Xăng E5 RON92 Mức 2': 'Xăng E5',
+}
+_PRODUCT_DAY_RE = re.compile(r'^(Ngày \d{2}/\d{2}) ')
+
+def _sse_product_frame(header_row, rows, date_str):
+    """DataFrame sản lượng của 1 ngày ('Ngày dd/mm') từ các dòng dữ liệu XML đã đọc."""
+    colmap = {'sse_ma_khach': 'Mã khách', 'sse_ten_khach': 'Tên khách',
+              **{product: f'{date_str} {suffix}' for product, suffix in SSE_PRODUCT_COLUMNS.items()}}
+    idx = {}
+    for k, colname in colmap.items():
+        if colname in header_row:
+            idx[k] = header_row.index(colname)
+    if 'sse_ma_khach' not in idx:
+        for alt in ['Mã KH', 'Mã khách hàng']:
+            if alt in header_row:
+                idx['sse_ma_khach'] = header_row.index(alt); break
+    if 'sse_ma_khach' not in idx:
+        raise ValueError("Không tìm thấy cột 'Mã khách' trong XML sản lượng.")
+
+    data = []
+    for row in rows:
+        if any(row):
+            rec = {k: (row[i] if i < len(row) else None) for k, i in idx.items()}
+            data.append(rec)
+
+    sse_df = pd.DataFrame(data)
+    sse_df['sse_ma_khach'] = sse_df['sse_ma_khach'].astype(str).str.strip()
+    sse_df = sse_df[sse_df['sse_ma_khach'].notna() & (sse_df['sse_ma_khach'] != '') & (sse_df['sse_ma_khach'] != 'None')].copy()
+    for p in list(colmap.keys())[2:]:
+        if p in sse_df.columns:
+            sse_df[p] = pd.to_numeric(sse_df[p], errors='coerce').fillna(0).round(0)
+    return sse_df
+
 def read_sse_product_xml(file_stream):
     try:
-        xml_bytes = file_stream.read()
-        try:
-            xml_content = xml_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            xml_content = xml_bytes.decode('windows-1252')
-        xml_content = xml_content.replace('xmlns="urn:schemas-microsoft-com:office:spreadsheet"', '')
-        root = ET.fromstring(xml_content)
-
-        all_rows = [[cell.findtext("Data") for cell in row.findall("Cell")]
-                    for row in root.findall(".//Table/Row")]
-
-        header_row_index = find_header_row_index(all_rows)
-        if header_row_index == -1 or len(all_rows) < header_row_index + 2:
+        header_row, data_rows = read_spreadsheetml_table(file_stream)
+        if header_row is None:
             raise ValueError("File XML sản lượng không hợp lệ (không thấy tiêu đề).")
 
-        header_row = all_rows[header_row_index]
         date_str = find_date_in_headers(header_row)
         if not date_str:
             raise ValueError("Không xác định được ngày từ tiêu đề XML sản lượng.")
-
-        colmap = {
-            'sse_ma_khach': 'Mã khách',
-            'sse_ten_khach': 'Tên khách',
-            'Dầu Điêzen 0,001S Mức 5': f'{date_str} Dầu DO 0,001S-V',
-            'Dầu mỡ nhờn': f'{date_str} Dầu mỡ nhờn',
-            'Dầu Điêzen 0,05S Mức 2': f'{date_str} DO',
-            'Xăng RON95 Mức 3': f'{date_str} Xăng A95',
-            'Xăng E5 RON92 Mức 2': f'{date_str} Xăng E5'
-        }
-        idx = {}
-        for k, colname in colmap.items():
-            if colname in header_row:
-                idx[k] = header_row.index(colname)
-        if 'sse_ma_khach' not in idx:
-            for alt in ['Mã KH', 'Mã khách hàng']:
-                if alt in header_row:
-                    idx['sse_ma_khach'] = header_row.index(alt); break
-        if 'sse_ma_khach' not in idx:
-            raise ValueError("Không tìm thấy cột 'Mã khách' trong XML sản lượng.")
-
-        data = []
-        for row in all_rows[header_row_index + 2:]:
-            if any(row):
-                rec = {k: (row[i] if i < len(row) else None) for k, i in idx.items()}
-                data.append(rec)
-
-        sse_df = pd.DataFrame(data)
-        sse_df['sse_ma_khach'] = sse_df['sse_ma_khach'].astype(str).str.strip()
-        sse_df = sse_df[sse_df['sse_ma_khach'].notna() & (sse_df['sse_ma_khach'] != '') & (sse_df['sse_ma_khach'] != 'None')].copy()
-        for p in list(colmap.keys())[2:]:
-            if p in sse_df.columns:
-                sse_df[p] = pd.to_numeric(sse_df[p], errors='coerce').fillna(0).round(0)
-        return sse_df
+        return _sse_product_frame(header_row, data_rows, date_str)
     except Exception as e:
         print(f"Lỗi nghiêm trọng khi đọc file XML sản lượng: {e}")
         logger.exception("Lỗi nghiêm trọng khi đọc file XML sản lượng")
         return None
 
+def read_sse_product_xml_by_day(file_stream):
+    """
+    File sản lượng SSE xuất nhiều ngày (cột 'Ngày dd/mm <mặt hàng>' cho từng ngày) → {'dd/mm': DataFrame như read_sse_product_xml}
+    theo thứ tự ngày trên tiêu đề. File chỉ có 1 ngày cho ra 1 phần tử. None nếu file không hợp lệ.
+    """
+    try:
+        header_row, data_rows = read_spreadsheetml_table(file_stream)
+        if header_row is None:
+            raise ValueError("File XML sản lượng không hợp lệ (không thấy tiêu đề).")
+        dates = list(dict.fromkeys(m.group(1) for m in map(_PRODUCT_DAY_RE.match, (h or '' for h in header_row)) if m))
+        if not dates:
+            raise ValueError("Không xác định được ngày từ tiêu đề XML sản lượng.")
+        rows = list(data_rows)
+        return {date_str[len('Ngày '):]: _sse_product_frame(header_row, rows, date_str) for date_str in dates}
+    except Exception as e:
+        print(f"Lỗi nghiêm trọng khi đọc file XML sản lượng nhiều ngày: {e}")
+        logger.exception("Lỗi nghiêm trọng khi đọc file XML sản lượng nhiều ngày")
+        return None
+
+def _reconcile_store_values(pos_df, sse_df, sse_code_col, store_mapping, items):
+    """
+    Đối soát theo CHXD bằng phép ghép bảng (thay cho lọc pos_df lại cho từng dòng SSE).
+    items: [(tên mục hiển thị, cột POS, cột SSE)]. Bản ghi ra đúng như cách cũ: theo thứ tự dòng SSE rồi thứ tự items,
+    sau đó là các CHXD chỉ có trên POS (theo thứ tự STORE_INFO).
+    """
+    labels = [label for label, _, _ in items]
+    sse2pos = {sse: config.STORE_INFO.get(pos) for sse, pos in store_mapping.items() if config.STORE_INFO.get(pos)}
+
+    # POS: dòng đầu tiên của mỗi CHXD (như prows.iloc[0]), dạng dài 1 dòng / (CHXD, mục); thiếu cột = 0
+    pos_first = pos_df.drop_duplicates('Tên CHXD').set_index('Tên CHXD')
+    pos_long = (pd.DataFrame({label: (pos_first[col] if col in pos_first.columns else 0) for label, col, _ in items}, index=pos_first.index)
+                .rename_axis('pos_name').reset_index()
+                .melt(id_vars='pos_name', var_name='product_name', value_name='pos_value'))
+
+    # SSE: ánh xạ mã → tên CHXD trên POS, bỏ dòng không có trong bảng ánh xạ
+    sse = pd.DataFrame({'pos_name': sse_df[sse_code_col].map(sse2pos).to_numpy(dtype=object)})
+    for label, _, col in items:
+        sse[label] = sse_df[col].to_numpy() if col in sse_df.columns else 0
+    sse = sse[sse['pos_name'].notna()].reset_index(drop=True)
+    sse_long = (sse.rename_axis('_row').reset_index()
+                .melt(id_vars=['_row', 'pos_name'], value_vars=labels, var_name='product_name', value_name='sse_value')
+                .sort_values('_row', kind='stable'))
+
+    merged = sse_long.merge(pos_long, on=['pos_name', 'product_name'], how='left', indicator=True)
+    on_pos = merged['_merge'] == 'both'
+    pv = merged['pos_value'].astype(float).fillna(0)
+    sv = merged['sse_value'].astype(float).fillna(0)
+    ok = on_pos & (pv.astype('int64') == sv.astype('int64'))
+    keep = (on_pos & (~ok | (pv != 0) | (sv != 0))) | (~on_pos & (sv != 0))
+
+    chxd = merged['pos_name'].where(on_pos, merged['pos_name'] + " (Không có trên POS)")
+    results = [
+        {"chxd_name": ch, "product_name": p, "pos_value": pval, "sse_value": sval, "is_match": m}
+        for ch, p, pval, sval, m in zip(chxd[keep], merged['product_name'][keep], pv.astype(object).where(on_pos, "N/A")[keep],
+                                        sv[keep].tolist(), ok[keep].tolist())
+    ]
+
+    # CHXD có trên POS nhưng không có dòng nào trên file KT
+    processed = set(sse['pos_name'])
+    store_order = {name: i for i, name in enumerate(dict.fromkeys(config.STORE_INFO.values())) if name not in processed}
+    tail = pos_long[pos_long['pos_name'].isin(store_order.keys())]
+    tail = tail.assign(_store=tail['pos_name'].map(store_order)).sort_values('_store', kind='stable')
+    tail = tail[tail['pos_value'].astype(float) != 0]
+    results.extend(
+        {"chxd_name": f"{ch} (Không có trên file KT)", "product_name": p, "pos_value": pval, "sse_value": "N/A", "is_match": False}
+        for ch, p, pval in zip(tail['pos_name'], tail['product_name'], tail['pos_value'].astype(float).tolist())
+    )
+    return results
+
 def reconcile_product_data(pos_df, sse_df):
     for product in config.TARGET_PRODUCTS_BH03:
         if product in pos_df.columns:
             pos_df[product] = clean_and_convert_to_numeric(pos_df[product])
-
-    results = []
-    all_pos_chxd_names = set(config.STORE_INFO.values())
-    processed = set()
-    sse2pos = {sse: config.STORE_INFO.get(pos) for sse, pos in config.STORE_MAPPING_SSE_TO_POS.items() if config.STORE_INFO.get(pos)}
-
-    for _, r in sse_df.iterrows():
-        pos_name = sse2pos.get(r['sse_ma_khach'])
-        if not pos_name:
-            continue
-        processed.add(pos_name)
-        prows = pos_df[pos_df['Tên CHXD'] == pos_name]
-        if prows.empty:
-            for p in config.TARGET_PRODUCTS_BH03:
-                if r.get(p, 0) != 0:
-                    results.append({"chxd_name": f"{pos_name} (Không có trên POS)", "product_name": p, "pos_value": "N/A", "sse_value": float(r.get(p,0)), "is_match": False})
-            continue
-        for p in config.TARGET_PRODUCTS_BH03:
-            pv = prows.iloc[0].get(p, 0); sv = r.get(p, 0)
-            ok = int(pv) == int(sv)
-            if not ok or pv != 0 or sv != 0:
-                results.append({"chxd_name": pos_name, "product_name": p, "pos_value": float(pv), "sse_value": float(sv), "is_match": ok})
-
-    for ch in (all_pos_chxd_names - processed):
-        prows = pos_df[pos_df['Tên CHXD'] == ch]
-        if not prows.empty:
-            for p in config.TARGET_PRODUCTS_BH03:
-                pv = prows.iloc[0].get(p, 0)
-                if pv != 0:
-                    results.append({"chxd_name": f"{ch} (Không có trên file KT)", "product_name": p, "pos_value": float(pv), "sse_value": "N/A", "is_match": False})
-    return results
+    items = [(p, p, p) for p in config.TARGET_PRODUCTS_BH03]
+    return _reconcile_store_values(pos_df, sse_df, 'sse_ma_khach', config.STORE_MAPPING_SSE_TO_POS, items)
 
 # ==============================================================================
 # TIỀN MẶT
 # ==============================================================================
 
-def read_sse_cash_xml(file_stream, reconcile_date: datetime):
-    try:
-        xml_bytes = file_stream.read()
-        try:
-            xml_content = xml_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            xml_content = xml_bytes.decode('windows-1252')
-        xml_content = xml_content.replace('xmlns="urn:schemas-microsoft-com:office:spreadsheet"', '')
-        root = ET.fromstring(xml_content)
+def _sse_cash_frame(rows, ix_code, ix_cash):
+    data = []
+    for row in rows:
+        if len(row) > max(ix_cash, ix_code):
+            code = row[ix_code]; val = row[ix_cash]
+            if code and str(code).strip():
+                data.append({'sse_ma_dv': str(code).strip(), 'sse_tien_mat': val})
 
-        all_rows = [[cell.findtext("Data") for cell in row.findall("Cell")]
-                    for row in root.findall(".//Table/Row")]
+    sse_df = pd.DataFrame(data)
+    sse_df['sse_tien_mat'] = pd.to_numeric(sse_df['sse_tien_mat'], errors='coerce').fillna(0).round(0)
+    return sse_df
 
-        header_row_index = find_header_row_index(all_rows)
-        if header_row_index == -1 or len(all_rows) < header_row_index + 2:
+def read_sse_cash_xml(file_stream, reconcile_date: datetime):
+    try:
+        header, data_rows = read_spreadsheetml_table(file_stream)
+        if header is None:
             raise ValueError("XML tiền mặt không hợp lệ (không thấy tiêu đề).")
 
-        header = all_rows[header_row_index]
         date_dm = reconcile_date.strftime('%d/%m')
         col_cash = f"Bán - {date_dm}"
         if col_cash not in header or 'Mã ĐV' not in header:
             raise ValueError(f"Thiếu cột '{col_cash}' hoặc 'Mã ĐV' trong XML tiền mặt.")
-
-        ix_cash = header.index(col_cash); ix_code = header.index('Mã ĐV')
-        data = []
-        for row in all_rows[header_row_index + 2:]:
-            if len(row) > max(ix_cash, ix_code):
-                code = row[ix_code]; val = row[ix_cash]
-                if code and str(code).strip():
-                    data.append({'sse_ma_dv': str(code).strip(), 'sse_tien_mat': val})
-
-        sse_df = pd.DataFrame(data)
-        sse_df['sse_tien_mat'] = pd.to_numeric(sse_df['sse_tien_mat'], errors='coerce').fillna(0).round(0)
-        return sse_df
+        return _sse_cash_frame(data_rows, header.index('Mã ĐV'), header.index(col_cash))
     except Exception as e:
         print(f"Lỗi nghiêm trọng khi đọc file XML tiền mặt: {e}")
         logger.exception("Lỗi nghiêm trọng khi đọc file XML tiền mặt")
         return None
 
+def read_sse_cash_xml_by_day(file_stream):
+    """File tiền mặt SSE (mỗi ngày 1 cột 'Bán - dd/mm') → {'dd/mm': DataFrame như read_sse_cash_xml}, đọc file 1 lượt. None nếu không hợp lệ."""
+    try:
+        header, data_rows = read_spreadsheetml_table(file_stream)
+        if header is None:
+            raise ValueError("XML tiền mặt không hợp lệ (không thấy tiêu đề).")
+        day_columns = {h[len("Bán - "):]: i for i, h in enumerate(header) if h and re.fullmatch(r'Bán - \d{2}/\d{2}', h)}
+        if not day_columns or 'Mã ĐV' not in header:
+            raise ValueError("Thiếu cột 'Bán - dd/mm' hoặc 'Mã ĐV' trong XML tiền mặt.")
+        rows = list(data_rows)
+        return {date_dm: _sse_cash_frame(rows, header.index('Mã ĐV'), ix_cash) for date_dm, ix_cash in day_columns.items()}
+    except Exception as e:
+        print(f"Lỗi nghiêm trọng khi đọc file XML tiền mặt nhiều ngày: {e}")
+        logger.exception("Lỗi nghiêm trọng khi đọc file XML tiền mặt nhiều ngày")
+        return None
+
 def reconcile_cash_data(pos_df, sse_df):
     if 'Tiền mặt' in pos_df.columns:
         pos_df['Tiền mặt'] = clean_and_convert_to_numeric(pos_df['Tiền mặt'])
     else:
         pos_df['Tiền mặt'] = 0
-
-    results = []
-    all_pos_names = set(config.STORE_INFO.values()); processed = set()
-    sse2pos = {sse: config.STORE_INFO.get(pos) for sse,pos in config.STORE_MAPPING_CASH_SSE_TO_POS.items() if config.STORE_INFO.get(pos)}
-
-    for _, r in sse_df.iterrows():
-        pos_name = sse2pos.get(r['sse_ma_dv'])
-        if not pos_name: continue
-        processed.add(pos_name)
-        prow = pos_df[pos_df['Tên CHXD'] == pos_name]
-        sse_cash = r.get('sse_tien_mat', 0); pos_cash = 0
-        if prow.empty:
-            if sse_cash != 0:
-                results.append({"chxd_name": f"{pos_name} (Không có trên POS)","product_name":"Tiền mặt","pos_value":"N/A","sse_value":float(sse_cash),"is_match":False})
-            continue
-        pos_cash = prow.iloc[0].get('Tiền mặt', 0)
-        ok = int(pos_cash) == int(sse_cash)
-        if not ok or pos_cash != 0 or sse_cash != 0:
-            results.append({"chxd_name": pos_name,"product_name":"Tiền mặt","pos_value":float(pos_cash),"sse_value":float(sse_cash),"is_match":ok})
-
-    for ch in (all_pos_names - processed):
-        prow = pos_df[pos_df['Tên CHXD'] == ch]
-        if not prow.empty:
-            pos_cash = prow.iloc[0].get('Tiền mặt', 0)
-            if pos_cash != 0:
-                results.append({"chxd_name": f"{ch} (Không có trên file KT)","product_name":"Tiền mặt","pos_value":float(pos_cash),"sse_value":"N/A","is_match":False})
-    return results
+    items = [("Tiền mặt", 'Tiền mặt', 'sse_tien_mat')]
+    return _reconcile_store_values(pos_df, sse_df, 'sse_ma_dv', config.STORE_MAPPING_CASH_SSE_TO_POS, items)
 
 # ==============================================================================
 # CÔNG NỢ
@@ -275,22 +407,11 @@ def read_sse_debt_xml(file_stream):
       store_display, store_key, sse_ma_khach, sse_ten_khach, sse_phat_sinh_no
     """
     try:
-        xml_bytes = file_stream.read()
-        try:
-            xml_content = xml_bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            xml_content = xml_bytes.decode('windows-1252')
-        xml_content = xml_content.replace('xmlns="urn:schemas-microsoft-com:office:spreadsheet"', '')
-        root = ET.fromstring(xml_content)
-
-        all_rows = [[cell.findtext("Data") for cell in row.findall("Cell")]
-                    for row in root.findall(".//Table/Row")]
-
-        hidx = find_header_row_index(all_rows)
-        if hidx == -1 or len(all_rows) < hidx + 2:
+        header_row, data_rows = read_spreadsheetml_table(file_stream)
+        if header_row is None:
             raise ValueError("XML công nợ không hợp lệ (không thấy tiêu đề).")
 
-        header = [str(h) if h is not None else '' for h in all_rows[hidx]]
+        header = [str(h) if h is not None else '' for h in header_row]
         # vị trí cột cần thiết
         idx_stt  = header.index('STT') if 'STT' in header else 0
         idx_code = header.index('Mã khách') if 'Mã khách' in header else header.index('Mã KH')
@@ -302,7 +423,7 @@ def read_sse_debt_xml(file_stream):
         cur_store_name_disp = None
         cur_store_key = None
 
-        for row in all_rows[hidx + 2:]:
+        for row in data_rows:
             row = list(row) if row is not None else []
             while len(row) < len(header):
                 row.append(None)
@@ -362,28 +483,114 @@ def read_sse_debt_xml(file_stream):
         logger.exception("Lỗi nghiêm trọng khi đọc file XML công nợ")
         return None
 
+def _map_unique(series, fn):
+    """Áp hàm chuẩn hoá cho từng giá trị khác nhau đúng 1 lần rồi ánh xạ lại cả cột."""
+    return series.map({v: fn(v) for v in series.drop_duplicates().tolist()}).astype(object)
+
 def _pos_expand_store_from_tonghop(pos_df: pd.DataFrame) -> pd.DataFrame:
     cols_needed = ['Tên Khách hàng', 'Mã khách hàng', 'Phát sinh nợ']
     for c in cols_needed:
         if c not in pos_df.columns:
             raise KeyError(f"Thiếu cột bắt buộc trong POS: '{c}'")
-    records = []
-    current_store = None
-    for _, row in pos_df.iterrows():
-        ten_kh = str(row['Tên Khách hàng']).strip()
-        if _norm_key(ten_kh).startswith('chxd'):
-            current_store = ten_kh
+    # Dòng có tên bắt đầu bằng 'CHXD' là dòng tiêu đề cửa hàng; các dòng khách hàng bên dưới thuộc cửa hàng đó
+    ten_kh = _str_values(pos_df['Tên Khách hàng']).str.strip().reset_index(drop=True)
+    is_store = _map_unique(ten_kh, lambda v: _norm_key(v).startswith('chxd')).astype(bool)
+    current_store = ten_kh.where(is_store).ffill()
+    rows = ~is_store & current_store.notna()
+    ma_kh = pos_df['Mã khách hàng'].reset_index(drop=True)
+    df = pd.DataFrame({
+        'Cửa hàng': current_store[rows].astype(object),
+        'Tên Khách hàng': ten_kh[rows].astype(object),
+        'Mã khách hàng': _str_values(ma_kh[rows]).str.strip().where(ma_kh[rows].notna(), '').astype(object),
+        'Phát sinh nợ': pos_df['Phát sinh nợ'].reset_index(drop=True)[rows],
+    }).reset_index(drop=True)
+    return df
+
+# Ghép gần đúng tên KH không mã (sau khi đã ghép đúng theo mã và theo tên)
+DEBT_FUZZY_NGRAM = 3
+DEBT_FUZZY_MAX_CANDIDATES = 10  # Mỗi tên chỉ so chi tiết với tối đa N ứng viên chung nhiều n-gram nhất
+_DIGITS_RE = re.compile(r'\d+')
+
+def debt_fuzzy_threshold():
+    """Ngưỡng độ giống (0-1) để ghép gần đúng tên KH công nợ; DEBT_FUZZY_THRESHOLD=0 để tắt (mặc định 0.85)."""
+    value = os.getenv("DEBT_FUZZY_THRESHOLD", "0.85").strip()
+    try:
+        return float(value or 0)
+    except ValueError:
+        print(f"[Cảnh báo] DEBT_FUZZY_THRESHOLD='{value}' không hợp lệ, dùng mặc định 0.85.")
+        return 0.85
+
+def _name_ngrams(key, n=DEBT_FUZZY_NGRAM):
+    padded = f" {key} "
+    return {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+def _fuzzy_name_pairs(left_keys, right_keys, threshold, max_candidates=DEBT_FUZZY_MAX_CANDIDATES):
+    """
+    Ghép 1-1 gần đúng 2 danh sách tên đã chuẩn hoá (_norm_key) của cùng 1 cửa hàng → [(i_trái, j_phải, điểm)].
+    Chỉ mục chặn: n-gram ký tự → các tên bên phải chứa nó (bỏ n-gram quá phổ biến), mỗi tên bên trái chỉ chấm điểm
+    SequenceMatcher với tối đa max_candidates ứng viên; hai tên có dãy số khác nhau (vd 'KH 1' / 'KH 12') không bao giờ ghép.
+    """
+    right_grams = [_name_ngrams(k) for k in right_keys]
+    index = defaultdict(list)
+    for j, grams in enumerate(right_grams):
+        for g in grams:
+            index[g].append(j)
+    max_postings = max(50, len(right_keys) // 5)
+    right_digits = [_DIGITS_RE.findall(k) for k in right_keys]
+
+    scored = []
+    for i, key in enumerate(left_keys):
+        shared = Counter()
+        for g in _name_ngrams(key):
+            postings = index.get(g)
+            if postings and len(postings) <= max_postings:
+                shared.update(postings)
+        if not shared:
             continue
-        if not current_store:
+        digits = _DIGITS_RE.findall(key)
+        candidates = [(j, n) for j, n in shared.items() if right_digits[j] == digits]
+        matcher = SequenceMatcher(None, b=key, autojunk=False)
+        # Ứng viên chung nhiều n-gram nhất; hoà thì lấy theo thứ tự → kết quả không phụ thuộc thứ tự duyệt set
+        for j, _ in heapq.nsmallest(max_candidates, candidates, key=lambda kv: (-kv[1], kv[0])):
+            matcher.set_seq1(right_keys[j])
+            if matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold:
+                score = matcher.ratio()
+                if score >= threshold:
+                    scored.append((score, i, j))
+
+    scored.sort(key=lambda t: (-t[0], t[1], t[2]))
+    used_left, used_right, pairs = set(), set(), []
+    for score, i, j in scored:
+        if i not in used_left and j not in used_right:
+            used_left.add(i); used_right.add(j)
+            pairs.append((i, j, score))
+    return pairs
+
+def _fuzzy_merge_names(names, threshold):
+    """Gộp cặp (chỉ có trên POS, chỉ có trên KT) có tên gần giống nhau trong cùng cửa hàng thành 1 dòng; ghi điểm vào match_confidence."""
+    left = names[names['_merge'] == 'left_only']
+    right = names[names['_merge'] == 'right_only']
+    if left.empty or right.empty:
+        return names
+    right_by_store = dict(tuple(right.groupby('store_key', sort=False)))
+    left_idx, right_idx, scores = [], [], []
+    for skey, lgroup in left.groupby('store_key', sort=False):
+        rgroup = right_by_store.get(skey)
+        if rgroup is None:
             continue
-        records.append({
-            'Cửa hàng': current_store,
-            'Tên Khách hàng': ten_kh,
-            'Mã khách hàng': ('' if pd.isna(row['Mã khách hàng']) else str(row['Mã khách hàng']).strip()),
-            'Phát sinh nợ': row['Phát sinh nợ']
-        })
-    df = pd.DataFrame(records) if records else pd.DataFrame(columns=['Cửa hàng','Tên Khách hàng','Mã khách hàng','Phát sinh nợ'])
-    return df
+        for i, j, score in _fuzzy_name_pairs(lgroup['key'].tolist(), rgroup['key'].tolist(), threshold):
+            left_idx.append(lgroup.index[i]); right_idx.append(rgroup.index[j]); scores.append(round(score, 3))
+    if not left_idx:
+        return names
+    names.loc[left_idx, 'name_sse'] = names.loc[right_idx, 'name_sse'].to_numpy()
+    names.loc[left_idx, 'value_sse'] = names.loc[right_idx, 'value_sse'].to_numpy()
+    names.loc[left_idx, '_merge'] = 'both'
+    names.loc[left_idx, 'match_confidence'] = scores
+    names.loc[left_idx, 'fuzzy'] = True
+    names = names.drop(index=right_idx)
+    names['ok'] = names['value_pos'].round(0) == names['value_sse'].round(0)
+    names['keep'] = ~names['ok'] | (names['value_pos'] != 0) | (names['value_sse'] != 0)
+    return names
 
 def reconcile_debt_data(pos_df: pd.DataFrame, sse_df: pd.DataFrame):
     try:
@@ -398,8 +605,8 @@ def reconcile_debt_data(pos_df: pd.DataFrame, sse_df: pd.DataFrame):
         print(">>> WARNING[Debt]: POS (sau parse) rỗng – có thể sheet TongHopCongNo không đúng cấu trúc.")
         logger.warning("Debt: POS parsed is empty")
 
-    pos['Cửa hàng'] = pos['Cửa hàng'].astype(str).map(_canon_store_display)
-    pos['store_key'] = pos['Cửa hàng'].map(_canon_store_key)
+    pos['Cửa hàng'] = _map_unique(pos['Cửa hàng'].astype(str), _canon_store_display)
+    pos['store_key'] = _map_unique(pos['Cửa hàng'], _canon_store_key)
     pos['Mã khách hàng'] = pos['Mã khách hàng'].fillna('').astype(str).str.strip()
     pos['Phát sinh nợ'] = clean_and_convert_to_numeric(pos['Phát sinh nợ'])
     pos = pos[~pos['Tên Khách hàng'].astype(str).str.strip().str.lower().isin(
@@ -414,89 +621,80 @@ def reconcile_debt_data(pos_df: pd.DataFrame, sse_df: pd.DataFrame):
     sse['sse_ten_khach'] = sse['sse_ten_khach'].fillna('').astype(str).str.strip()
     sse['sse_phat_sinh_no'] = pd.to_numeric(sse['sse_phat_sinh_no'], errors='coerce').fillna(0).round(0)
 
-    results = []
-
-    all_keys = sorted(set(pos['store_key']).union(set(sse['store_key'])))
-    print(">>> DEBUG[Debt]: Tổng số store_key để so khớp:", len(all_keys))
-
-    for skey in all_keys:
-        pos_store = pos[pos['store_key'] == skey]
-        sse_store = sse[sse['store_key'] == skey]
-
-        if pos_store.empty and sse_store.empty:
-            continue
-
-        display_name = pos_store['Cửa hàng'].iloc[0] if not pos_store.empty else sse_store['store_display'].iloc[0]
-
-        # 1) Ghép theo MÃ KH
-        pos_by_code = (pos_store[pos_store['Mã khách hàng'] != '']
-                       .groupby(['Mã khách hàng','Tên Khách hàng'], as_index=False)['Phát sinh nợ'].sum())
-        sse_by_code = (sse_store[sse_store['sse_ma_khach'] != '']
-                       .groupby(['sse_ma_khach','sse_ten_khach'], as_index=False)['sse_phat_sinh_no'].sum())
-
-        pos_code_map = {_norm_code(r['Mã khách hàng']):(r['Tên Khách hàng'], float(r['Phát sinh nợ'])) for _,r in pos_by_code.iterrows()}
-        sse_code_map = {_norm_code(r['sse_ma_khach']):(r['sse_ten_khach'], float(r['sse_phat_sinh_no'])) for _,r in sse_by_code.iterrows()}
-
-        codes = set(pos_code_map.keys()).union(set(sse_code_map.keys()))
-        matched_pos_names = set(); matched_sse_names = set()
-
-        for c in sorted(codes):
-            pn, pv = pos_code_map.get(c, (None, 0.0))
-            sn, sv = sse_code_map.get(c, (None, 0.0))
-            cname = pn or sn or ''
-            ok = int(round(pv)) == int(round(sv))
-            status = ''
-            if c not in pos_code_map:
-                status = 'Có trên file KT, thiếu trên POS'
-            elif c not in sse_code_map:
-                status = 'Có trên POS, thiếu trên file KT'
-            if (not ok) or (pv != 0) or (sv != 0):
-                results.append({
-                    'chxd_name': display_name,
-                    'customer_code': c,
-                    'customer_name': cname,
-                    'pos_value': float(round(pv)),
-                    'sse_value': float(round(sv)),
-                    'is_match': ok,
-                    'status': status
-                })
-            if pn: matched_pos_names.add(_norm_key(pn))
-            if sn: matched_sse_names.add(_norm_key(sn))
-
-        # 2) Ghép theo TÊN
-        pos_no_code = pos_store[(pos_store['Mã khách hàng'] == '') | (pos_store['Mã khách hàng'].str.lower() == 'không tìm thấy mã khách')] \
-                                .groupby('Tên Khách hàng', as_index=False)['Phát sinh nợ'].sum()
-        sse_no_code = sse_store[sse_store['sse_ma_khach'] == ''] \
-                                .groupby('sse_ten_khach', as_index=False)['sse_phat_sinh_no'].sum()
-
-        pos_name_map = {_norm_key(r['Tên Khách hàng']):(r['Tên Khách hàng'], float(r['Phát sinh nợ'])) for _,r in pos_no_code.iterrows()}
-        sse_name_map = {_norm_key(r['sse_ten_khach']):(r['sse_ten_khach'], float(r['sse_phat_sinh_no'])) for _,r in sse_no_code.iterrows()}
-
-        names = set(pos_name_map.keys()).union(set(sse_name_map.keys()))
-        for nk in sorted(names):
-            if nk in matched_pos_names or nk in matched_sse_names:
-                continue
-            pn, pv = pos_name_map.get(nk, ('', 0.0))
-            sn, sv = sse_name_map.get(nk, ('', 0.0))
-            disp = pn or sn
-            ok = int(round(pv)) == int(round(sv))
-            status = ''
-            if nk not in pos_name_map:
-                status = 'Có trên file KT, thiếu trên POS (không mã)'
-            elif nk not in sse_name_map:
-                status = 'Có trên POS, thiếu trên file KT (không mã)'
-            if (not ok) or (pv != 0) or (sv != 0):
-                results.append({
-                    'chxd_name': display_name,
-                    'customer_code': '',
-                    'customer_name': disp,
-                    'pos_value': float(round(pv)),
-                    'sse_value': float(round(sv)),
-                    'is_match': ok,
-                    'status': status
-                })
-
-    return results
+    print(">>> DEBUG[Debt]: Tổng số store_key để so khớp:", pd.concat([pos['store_key'], sse['store_key']]).nunique())
+
+    # Tên hiển thị của từng cửa hàng: dòng POS đầu tiên, không có thì dòng SSE đầu tiên
+    display_names = sse.drop_duplicates('store_key').set_index('store_key')['store_display'].to_dict()
+    display_names.update(pos.drop_duplicates('store_key').set_index('store_key')['Cửa hàng'].to_dict())
+
+    def grouped(df, key_col, name_col, value_col, norm):
+        """Cộng theo (cửa hàng, mã/tên gốc) cho mọi cửa hàng 1 lượt; trùng khoá sau chuẩn hoá thì nhóm xếp sau cùng thắng (như dict cũ)."""
+        by = ['store_key', key_col] if key_col == name_col else ['store_key', key_col, name_col]
+        g = df.groupby(by, as_index=False)[value_col].sum()
+        g['key'] = _map_unique(g[key_col], norm)
+        g = g.drop_duplicates(['store_key', 'key'], keep='last')
+        return g[['store_key', 'key', name_col, value_col]].set_axis(['store_key', 'key', 'name', 'value'], axis=1)
+
+    def joined(pos_g, sse_g):
+        m = pos_g.merge(sse_g, on=['store_key', 'key'], how='outer', suffixes=('_pos', '_sse'), indicator=True)
+        m['value_pos'] = m['value_pos'].fillna(0.0)
+        m['value_sse'] = m['value_sse'].fillna(0.0)
+        m['ok'] = m['value_pos'].round(0) == m['value_sse'].round(0)
+        m['keep'] = ~m['ok'] | (m['value_pos'] != 0) | (m['value_sse'] != 0)
+        return m
+
+    # 1) Ghép theo MÃ KH
+    codes = joined(
+        grouped(pos[pos['Mã khách hàng'] != ''], 'Mã khách hàng', 'Tên Khách hàng', 'Phát sinh nợ', _norm_code),
+        grouped(sse[sse['sse_ma_khach'] != ''], 'sse_ma_khach', 'sse_ten_khach', 'sse_phat_sinh_no', _norm_code))
+    pos_name = codes['name_pos'].where(codes['name_pos'].notna() & (codes['name_pos'] != ''))
+    sse_name = codes['name_sse'].where(codes['name_sse'].notna() & (codes['name_sse'] != ''))
+    codes['customer_code'] = codes['key']
+    codes['customer_name'] = pos_name.fillna(sse_name).fillna('')
+    codes['status'] = ''
+    codes['match_confidence'] = pd.Series(1.0, index=codes.index, dtype=object).where(codes['_merge'] == 'both', None)
+    codes.loc[codes['_merge'] == 'right_only', 'status'] = 'Có trên file KT, thiếu trên POS'
+    codes.loc[codes['_merge'] == 'left_only', 'status'] = 'Có trên POS, thiếu trên file KT'
+    # Tên KH đã ghép được theo mã (ở bất kỳ phía nào) thì không ghép theo tên nữa
+    matched_names = pd.concat([codes[['store_key']].assign(key=pos_name), codes[['store_key']].assign(key=sse_name)]).dropna()
+    matched_names['key'] = _map_unique(matched_names['key'], _norm_key)
+
+    # 2) Ghép theo TÊN (khách không có mã)
+    pos_no_code = pos[(pos['Mã khách hàng'] == '') | (pos['Mã khách hàng'].str.lower() == 'không tìm thấy mã khách')]
+    names = joined(
+        grouped(pos_no_code, 'Tên Khách hàng', 'Tên Khách hàng', 'Phát sinh nợ', _norm_key),
+        grouped(sse[sse['sse_ma_khach'] == ''], 'sse_ten_khach', 'sse_ten_khach', 'sse_phat_sinh_no', _norm_key))
+    names = names.merge(matched_names.drop_duplicates(), on=['store_key', 'key'], how='left', indicator='_matched')
+    names = names[names['_matched'] == 'left_only'].copy()
+    names['match_confidence'] = pd.Series(1.0, index=names.index, dtype=object).where(names['_merge'] == 'both', None)
+    names['fuzzy'] = False
+
+    # 3) Ghép GẦN ĐÚNG theo tên các dòng còn lệch 1 phía (cùng cửa hàng)
+    threshold = debt_fuzzy_threshold()
+    if 0 < threshold <= 1:
+        names = _fuzzy_merge_names(names, threshold)
+
+    pos_disp = names['name_pos'].fillna('')
+    names['customer_code'] = ''
+    names['customer_name'] = pos_disp.where(pos_disp != '', names['name_sse'].fillna(''))
+    names['status'] = ''
+    names.loc[names['_merge'] == 'right_only', 'status'] = 'Có trên file KT, thiếu trên POS (không mã)'
+    names.loc[names['_merge'] == 'left_only', 'status'] = 'Có trên POS, thiếu trên file KT (không mã)'
+    fuzzy = names['fuzzy'].astype(bool)
+    names.loc[fuzzy, 'status'] = [f"Ghép gần đúng theo tên với file KT: '{sse_name}' (độ tin cậy {score:.0%})"
+                                  for sse_name, score in zip(names['name_sse'][fuzzy], names['match_confidence'][fuzzy])]
+
+    # Thứ tự như cách cũ: cửa hàng tăng dần, trong mỗi cửa hàng các dòng theo mã (tăng dần) rồi các dòng theo tên (tăng dần)
+    out = pd.concat([codes[codes['keep']].assign(_pass=0), names[names['keep']].assign(_pass=1)], ignore_index=True)
+    out = out.sort_values(['store_key', '_pass', 'key'], kind='stable')
+    return [
+        {'chxd_name': display_names[skey], 'customer_code': code, 'customer_name': cname,
+         'pos_value': pv, 'sse_value': sv, 'is_match': ok, 'status': status, 'match_confidence': conf}
+        for skey, code, cname, pv, sv, ok, status, conf in zip(
+            out['store_key'].tolist(), out['customer_code'].tolist(), out['customer_name'].tolist(),
+            (out['value_pos'].round(0) + 0.0).tolist(), (out['value_sse'].round(0) + 0.0).tolist(),
+            out['ok'].tolist(), out['status'].tolist(), out['match_confidence'].astype(object).where(out['match_confidence'].notna(), None).tolist())
+    ]
 
 # ==============================================================================
 # PHẦN MỚI BỔ SUNG: ĐỐI SOÁT HÓA ĐƠN (HD01) VỚI BIGQUERY
@@ -514,165 +712,191 @@ def _vn_normalize(s: str) -> str:
     s = "".join(ch for ch in unicodedata.normalize("NFD", s) if unicodedata.category(ch) != "Mn")
     return re.sub(r"[\s\._\-]+", " ", s).strip()
 
-def read_tax_excel_file(file_stream, progress_callback=None):
-    """
-    CHIẾN LƯỢC TỐI ƯU RAM: CHỈ ĐỌC CÁC CỘT CẦN THIẾT TỪ FILE 50MB DƯỚI DẠNG TEXT (dtype=str).
-    Sử dụng Thuật toán Định vị Không va chạm + Blacklist để loại bỏ cột Người Bán.
-    Tự động trích xuất Tháng/Năm từ cột Ngày Hóa Đơn.
-    """
-    try:
-        if progress_callback: progress_callback(".... Đang tìm kiếm các cột mục tiêu.....")
-        
-        # BƯỚC 1: Đọc nhanh 30 dòng đầu để dò tìm Header
-        df_preview = pd.read_excel(file_stream, header=None, nrows=30)
-        header_idx = -1
-        
-        for i in range(len(df_preview)):
-            row_vals = [_vn_normalize(str(x)) for x in df_preview.iloc[i].values if pd.notna(x)]
-            if 'stt' in row_vals or 'so tt' in row_vals or 'so thu tu' in row_vals:
-                header_idx = i
-                break
+TAX_HEADER_SCAN_ROWS = 30  # Số dòng (không trống) đầu file được dò để tìm dòng tiêu đề chứa 'STT'
+
+# Từ khoá nhận diện cột của Bảng kê Thuế (đã bỏ dấu, in thường)
+TAX_KW_MAPPING = {
+    'KyHieu': ['ky hieu hoa don', 'ky hieu'], 
+    'SoHD': ['so hoa don', 'so hd'],
+    'KhachHang': ['ten nguoi mua', 'ten nguoi mua (trong nuoc)', 'ten don vi', 'ten khach hang', 'nguoi mua', 'khach hang'],
+    'MST': ['ma so thue nguoi mua', 'mst nguoi mua', 'ma so thue', 'mst'],
+    'TienChuaThue': ['tong tien chua thue', 'tien chua thue', 'doanh thu chua thue', 'cong tien hang', 'tien hang'],
+    'TienThue': ['tong tien thue', 'tien thue gtgt', 'thue gtgt', 'tien thue'],
+    'TongTien': ['tong tien thanh toan', 'tong tien', 'tong cong', 'thanh toan'],
+    'NgayLap': ['ngay lap', 'ngay hoa don', 'ngay thang nam lap', 'thoi gian']
+}
+
+# FIX 1: TỪ KHÓA BLACKLIST (Loại bỏ triệt để các cột của Người Bán)
+TAX_COLUMN_BLACKLIST = ['nguoi ban', 'xuat hang']
+
+def _is_tax_header(row_vals):
+    return 'stt' in row_vals or 'so tt' in row_vals or 'so thu tu' in row_vals
+
+def _resolve_tax_columns(header_row):
+    """BƯỚC 2: Định vị Index Không Va Chạm - header_row là các ô tiêu đề đã _vn_normalize. Trả về {tên chuẩn: vị trí cột}."""
+    col_indices = {}
+    used_indices = set()
+    
+    for col_key, keywords in TAX_KW_MAPPING.items():
+        # Ưu tiên 1: Quét tìm khớp chính xác 100%
+        for idx, col_name in enumerate(header_row):
+            if idx in used_indices: continue
+            # Chống nhiễu lấy nhầm cột của Người Bán
+            if (col_key in ['MST', 'KhachHang']) and any(b in col_name for b in TAX_COLUMN_BLACKLIST):
+                continue
                 
-        if header_idx == -1:
-            raise ValueError("Không nhận diện được cấu trúc Bảng kê Thuế (Không tìm thấy dòng tiêu đề chứa 'STT').")
-
-        header_row = [_vn_normalize(str(x)) for x in df_preview.iloc[header_idx].values]
-        
-        # TỪ KHÓA MỞ RỘNG
-        kw_mapping = {
-            'KyHieu': ['ky hieu hoa don', 'ky hieu'], 
-            'SoHD': ['so hoa don', 'so hd'],
-            'KhachHang': ['ten nguoi mua', 'ten nguoi mua (trong nuoc)', 'ten don vi', 'ten khach hang', 'nguoi mua', 'khach hang'],
-            'MST': ['ma so thue nguoi mua', 'mst nguoi mua', 'ma so thue', 'mst'],
-            'TienChuaThue': ['tong tien chua thue', 'tien chua thue', 'doanh thu chua thue', 'cong tien hang', 'tien hang'],
-            'TienThue': ['tong tien thue', 'tien thue gtgt', 'thue gtgt', 'tien thue'],
-            'TongTien': ['tong tien thanh toan', 'tong tien', 'tong cong', 'thanh toan'],
-            'NgayLap': ['ngay lap', 'ngay hoa don', 'ngay thang nam lap', 'thoi gian']
-        }
-        
-        # FIX 1: TỪ KHÓA BLACKLIST (Loại bỏ triệt để các cột của Người Bán)
-        blacklist = ['nguoi ban', 'xuat hang']
-        
-        # BƯỚC 2: Định vị Index Không Va Chạm
-        col_indices = {}
-        used_indices = set()
+            if col_name in keywords:
+                col_indices[col_key] = idx
+                used_indices.add(idx)
+                break
         
-        for col_key, keywords in kw_mapping.items():
-            # Ưu tiên 1: Quét tìm khớp chính xác 100%
+        # Ưu tiên 2: Quét tìm chứa từ khóa
+        if col_key not in col_indices:
             for idx, col_name in enumerate(header_row):
                 if idx in used_indices: continue
                 # Chống nhiễu lấy nhầm cột của Người Bán
-                if (col_key in ['MST', 'KhachHang']) and any(b in col_name for b in blacklist):
+                if (col_key in ['MST', 'KhachHang']) and any(b in col_name for b in TAX_COLUMN_BLACKLIST):
                     continue
                     
-                if col_name in keywords:
+                if any(kw in col_name for kw in keywords):
+                    if col_key == 'KyHieu' and 'mau so' in col_name: continue
+                    if col_key == 'SoHD' and ('thue' in col_name or 'ma so' in col_name): continue
+                    if col_key == 'KhachHang' and ('mst' in col_name or 'ma so' in col_name): continue # Ngăn Khách Hàng cướp nhầm cột của MST
+                    
                     col_indices[col_key] = idx
                     used_indices.add(idx)
                     break
-            
-            # Ưu tiên 2: Quét tìm chứa từ khóa
-            if col_key not in col_indices:
-                for idx, col_name in enumerate(header_row):
-                    if idx in used_indices: continue
-                    # Chống nhiễu lấy nhầm cột của Người Bán
-                    if (col_key in ['MST', 'KhachHang']) and any(b in col_name for b in blacklist):
-                        continue
-                        
-                    if any(kw in col_name for kw in keywords):
-                        if col_key == 'KyHieu' and 'mau so' in col_name: continue
-                        if col_key == 'SoHD' and ('thue' in col_name or 'ma so' in col_name): continue
-                        if col_key == 'KhachHang' and ('mst' in col_name or 'ma so' in col_name): continue # Ngăn Khách Hàng cướp nhầm cột của MST
-                        
-                        col_indices[col_key] = idx
-                        used_indices.add(idx)
-                        break
-
-        missing_cols = [k for k in kw_mapping.keys() if k not in col_indices]
-        if missing_cols:
-            print("====== BÁO CÁO LỖI ĐỌC FILE BẢNG KÊ THUẾ ======")
-            print(f"CÁC CỘT TÌM THẤY TRONG FILE: {header_row}")
-            print(f"CÁC THUỘC TÍNH BỊ THIẾU: {missing_cols}")
-            print("===============================================")
-            raise ValueError(f"Không tìm thấy cột tương ứng cho {', '.join(missing_cols)} trong Bảng kê Thuế.")
-
-        sorted_indices = sorted(list(col_indices.values()))
-
-        if progress_callback: progress_callback(".... Đang đọc và hút dữ liệu từ bảng kê của cơ quan thuế .....")
-
-        # BƯỚC 3: Đọc file lần 2 (FIX 2: Thêm dtype=str để không bao giờ bị mất số 0 ở đầu)
-        file_stream.seek(0)
-        tax_df = pd.read_excel(file_stream, header=header_idx, usecols=sorted_indices, dtype=str)
+
+    missing_cols = [k for k in TAX_KW_MAPPING.keys() if k not in col_indices]
+    if missing_cols:
+        print("====== BÁO CÁO LỖI ĐỌC FILE BẢNG KÊ THUẾ ======")
+        print(f"CÁC CỘT TÌM THẤY TRONG FILE: {header_row}")
+        print(f"CÁC THUỘC TÍNH BỊ THIẾU: {missing_cols}")
+        print("===============================================")
+        raise ValueError(f"Không tìm thấy cột tương ứng cho {', '.join(missing_cols)} trong Bảng kê Thuế.")
+    return col_indices
+
+# Các chuỗi pd.read_excel mặc định coi là NA (keep_default_na=True) - chép lại tại đây thay vì import từ module nội bộ của pandas
+_EXCEL_NA_STRINGS = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+def _excel_text(value):
+    """
+    Giá trị 1 ô Excel → chuỗi giống pd.read_excel(dtype=str): số thực nguyên → '123' (không có '.0'),
+    ô trống và các chuỗi NA mặc định của pandas ('', 'N/A', 'NULL', 'nan', ...) → None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    text = str(value)
+    return None if text in _EXCEL_NA_STRINGS else text
+
+def _iter_excel_rows(file_stream):
+    """Đọc tuần tự từng dòng (tuple giá trị) của sheet đầu tiên bằng openpyxl read_only - không dựng cả sheet trong RAM."""
+    from openpyxl import load_workbook
+    wb = load_workbook(file_stream, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        # read_only tin thẻ <dimension> của sheet; nhiều phần mềm xuất ghi sai (vd "A1") → chỉ thấy cột A.
+        # Bỏ kích thước khai báo để đọc đúng mọi ô như pd.read_excel.
+        ws.reset_dimensions()
+        yield from ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def read_tax_excel_file(file_stream, progress_callback=None):
+    """
+    CHIẾN LƯỢC TỐI ƯU RAM: ĐỌC FILE 50MB ĐÚNG 1 LƯỢT, TỪNG DÒNG (openpyxl read_only), CHỈ GIỮ CÁC CỘT CẦN THIẾT DƯỚI DẠNG TEXT.
+    Sử dụng Thuật toán Định vị Không va chạm + Blacklist để loại bỏ cột Người Bán.
+    Tự động trích xuất Tháng/Năm từ cột Ngày Hóa Đơn.
+    file_stream: file nhị phân seek được (BytesIO hoặc file tạm trên đĩa).
+    """
+    try:
+        if progress_callback: progress_callback(".... Đang tìm kiếm các cột mục tiêu.....")
         
-        # BƯỚC 4: Gán lại tên cột chuẩn xác 100%
-        new_col_names = []
-        for original_idx in sorted_indices:
-            found_key = next(k for k, v in col_indices.items() if v == original_idx)
-            new_col_names.append(found_key)
-            
-        tax_df.columns = new_col_names
-
-        # Kiểm tra tính toàn vẹn của Thời gian và Tự động trích xuất Tháng/Năm
-        if 'NgayLap' in tax_df.columns:
-            tax_df['NgayLap'] = pd.to_datetime(tax_df['NgayLap'], errors='coerce', dayfirst=True)
-            tax_df = tax_df.dropna(subset=['NgayLap']) 
-            unique_months = tax_df['NgayLap'].dt.to_period('M').unique()
-            if len(unique_months) > 1:
-                raise ValueError(f"File dữ liệu không hợp lệ: Bảng kê chứa dữ liệu của nhiều tháng khác nhau ({', '.join([str(m) for m in unique_months])}). Vui lòng chỉ tải bảng kê của đúng 1 tháng duy nhất!")
-            
-            if len(unique_months) == 1:
-                target_month = unique_months[0].month
-                target_year = unique_months[0].year
-            else:
-                raise ValueError("Không tìm thấy dữ liệu ngày tháng hợp lệ trong Bảng kê Thuế.")
-        else:
-             raise ValueError("Không tìm thấy cột Ngày lập/Ngày hóa đơn trong Bảng kê Thuế.")
+        # BƯỚC 1: Dò tìm Header trong 30 dòng có dữ liệu đầu tiên (cùng 1 lượt đọc với phần dữ liệu bên dưới)
+        rows = _iter_excel_rows(file_stream)
+        try:
+            header_row = None
+            scanned = 0
+            for row in rows:
+                texts = [_excel_text(x) for x in row]
+                if all(t is None for t in texts): continue
+                scanned += 1
+                if scanned > TAX_HEADER_SCAN_ROWS: break
+                if _is_tax_header([_vn_normalize(t) for t in texts if t is not None]):
+                    header_row = [_vn_normalize(t if t is not None else 'nan') for t in texts]
+                    break
+                    
+            if header_row is None:
+                raise ValueError("Không nhận diện được cấu trúc Bảng kê Thuế (Không tìm thấy dòng tiêu đề chứa 'STT').")
 
-        # Chuẩn hóa kiểu dữ liệu trước khi đẩy lên mây
-        for c in ['TienChuaThue', 'TienThue', 'TongTien']:
-            if c in tax_df.columns:
-                tax_df[c] = pd.to_numeric(tax_df[c].astype(str).str.replace(',', '').str.replace(' ', ''), errors='coerce').fillna(0.0)
-                
-        for c in ['KyHieu', 'SoHD', 'KhachHang', 'MST']:
-            if c in tax_df.columns: tax_df[c] = tax_df[c].astype(str).fillna('')
+            col_indices = _resolve_tax_columns(header_row)
+            sorted_indices = sorted(col_indices.values())
+            col_names = [next(k for k, v in col_indices.items() if v == idx) for idx in sorted_indices]
 
-        if progress_callback: progress_callback(".... Đang tạo Chứng minh thư Hóa đơn (HD_ID) ....")
+            if progress_callback: progress_callback(".... Đang đọc và hút dữ liệu từ bảng kê của cơ quan thuế .....")
 
-        # Xóa các hậu tố ".0" (nếu có do Excel sinh ra) và tạo ID
-        tx_sohd_str = tax_df['SoHD'].str.replace(r'\.0$', '', regex=True)
-        tax_df['HD_ID'] = tax_df['KyHieu'].str.strip() + "_" + tx_sohd_str.str.replace("'", "").str.strip().str.lstrip('0')
-        tax_df = tax_df[~tax_df['HD_ID'].str.contains('nan', case=False, na=False)]
+            # BƯỚC 3-4: Đọc tiếp các dòng dữ liệu, chỉ lấy các cột đã định vị (FIX 2: giữ dạng text để không mất số 0 ở đầu)
+            columns = {name: [] for name in col_names}
+            for row in rows:
+                values = [_excel_text(row[idx]) if idx < len(row) else None for idx in sorted_indices]
+                if all(v is None for v in values): continue
+                for name, value in zip(col_names, values):
+                    columns[name].append(value)
+        finally:
+            rows.close()
+        tax_df = pd.DataFrame(columns, dtype=object)
 
-        return tax_df, target_month, target_year
+        return _finalize_tax_frame(tax_df, progress_callback)
 
     except Exception as e:
         raise ValueError(f"Lỗi đọc file Thuế: {str(e)}")
 
-def reconcile_invoice_data_bq(report_month, report_year, tax_df, progress_callback=None):
-    """
-    THUẬT TOÁN ĐỐI SOÁT ĐÁM MÂY (FULL OUTER JOIN TRÊN BIGQUERY)
-    """
-    import bq_handler
-    
-    if tax_df is None or tax_df.empty:
-        return []
-
-    client = bq_handler.get_bq_client()
-    
-    # 1. Tạo Tên Bảng Tạm ngẫu nhiên
-    temp_table_id = f"{client.project}.pvoil_data.Temp_Tax_Data_{uuid.uuid4().hex[:8]}"
-    
-    try:
-        if progress_callback: progress_callback(".... Đang tải dữ liệu bảng kê thuế lên BigQuery....")
+def _finalize_tax_frame(tax_df, progress_callback=None):
+    """Kiểm tra tháng, chuẩn hoá kiểu dữ liệu và tạo HD_ID cho Bảng kê Thuế đã đọc (cột text). Trả về (tax_df, tháng, năm)."""
+    # Kiểm tra tính toàn vẹn của Thời gian và Tự động trích xuất Tháng/Năm
+    if 'NgayLap' in tax_df.columns:
+        tax_df['NgayLap'] = pd.to_datetime(tax_df['NgayLap'], errors='coerce', dayfirst=True)
+        tax_df = tax_df.dropna(subset=['NgayLap']) 
+        unique_months = tax_df['NgayLap'].dt.to_period('M').unique()
+        if len(unique_months) > 1:
+            raise ValueError(f"File dữ liệu không hợp lệ: Bảng kê chứa dữ liệu của nhiều tháng khác nhau ({', '.join([str(m) for m in unique_months])}). Vui lòng chỉ tải bảng kê của đúng 1 tháng duy nhất!")
         
-        # 2. Bơm file Thuế (đã rút gọn chỉ còn vài MB) lên BigQuery
-        job_config = bq_handler.bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-        job = client.load_table_from_dataframe(tax_df, temp_table_id, job_config=job_config)
-        job.result() # Đợi upload xong
+        if len(unique_months) == 1:
+            target_month = unique_months[0].month
+            target_year = unique_months[0].year
+        else:
+            raise ValueError("Không tìm thấy dữ liệu ngày tháng hợp lệ trong Bảng kê Thuế.")
+    else:
+         raise ValueError("Không tìm thấy cột Ngày lập/Ngày hóa đơn trong Bảng kê Thuế.")
 
-        if progress_callback: progress_callback(".... Đang chờ kết quả đối soát từ BigQuery (So khớp chéo)....")
-        
-        # 3. Kích hoạt Lệnh SQL So Khớp Chéo
-        sql_query = f"""
+    # Chuẩn hóa kiểu dữ liệu trước khi đẩy lên mây
+    for c in ['TienChuaThue', 'TienThue', 'TongTien']:
+        if c in tax_df.columns:
+            tax_df[c] = pd.to_numeric(tax_df[c].astype(str).str.replace(',', '').str.replace(' ', ''), errors='coerce').fillna(0.0)
+            
+    for c in ['KyHieu', 'SoHD', 'KhachHang', 'MST']:
+        if c in tax_df.columns: tax_df[c] = tax_df[c].astype(str).fillna('')
+
+    if progress_callback: progress_callback(".... Đang tạo Chứng minh thư Hóa đơn (HD_ID) ....")
+
+    # Xóa các hậu tố ".0" (nếu có do Excel sinh ra) và tạo ID
+    tx_sohd_str = tax_df['SoHD'].str.replace(r'\.0$', '', regex=True)
+    tax_df['HD_ID'] = tax_df['KyHieu'].str.strip() + "_" + tx_sohd_str.str.replace("'", "").str.strip().str.lstrip('0')
+    tax_df = tax_df[~tax_df['HD_ID'].str.contains('nan', case=False, na=False)]
+
+    return tax_df, target_month, target_year
+
+def _invoice_mismatch_sql(pvoil_source_sql, tax_source_sql):
+    """
+    Câu SQL so khớp chéo (FULL OUTER JOIN) giữa dữ liệu PVOIL và Bảng kê Thuế - cú pháp chạy được trên cả BigQuery lẫn DuckDB.
+    pvoil_source_sql: bảng (+ điều kiện WHERE) dữ liệu PVOIL đã khử trùng lặp; tax_source_sql: bảng dữ liệu Thuế.
+    """
+    return f"""
         WITH PVOIL_Data AS (
             SELECT 
                 Ten_CHXD,
@@ -683,10 +907,8 @@ def reconcile_invoice_data_bq(report_month, report_year, tax_df, progress_callba
                 Tien_Chua_Thue AS TienChuaThue,
                 Tien_Thue AS TienThue,
                 Tong_Tien AS TongTien,
-                CONCAT(TRIM(Ky_Hieu), '_', LTRIM(TRIM(So_HD), '0')) AS HD_ID
-            FROM `{client.project}.pvoil_data.HD01_Master_Data`
-            WHERE Thang_Bao_Cao = {int(report_month)} AND Nam_Bao_Cao = {int(report_year)}
-            QUALIFY ROW_NUMBER() OVER(PARTITION BY Ma_CHXD, Ky_Hieu, So_HD ORDER BY Ngay_Hoa_Don DESC) = 1
+                TRIM(Ky_Hieu) || '_' || LTRIM(TRIM(So_HD), '0') AS HD_ID  -- || : NULL lan truyền như nhau trên BigQuery lẫn DuckDB
+            FROM {pvoil_source_sql}
         ),
         TAX_Data AS (
             SELECT 
@@ -698,7 +920,7 @@ def reconcile_invoice_data_bq(report_month, report_year, tax_df, progress_callba
                 TienThue,
                 TongTien,
                 HD_ID
-            FROM `{temp_table_id}`
+            FROM {tax_source_sql}
         )
         SELECT 
             COALESCE(p.Ten_CHXD, 'Bảng kê Thuế') AS chxd_name,
@@ -723,62 +945,158 @@ def reconcile_invoice_data_bq(report_month, report_year, tax_df, progress_callba
             OR LOWER(TRIM(IFNULL(p.KhachHang, ''))) != LOWER(TRIM(IFNULL(t.KhachHang, '')))
         """
 
-        mismatched_df = client.query(sql_query).to_dataframe()
-        
-        if progress_callback: progress_callback(".... Đang nhận kết quả từ BigQuery....")
-        
-    finally:
-        # 5. DỌN DẸP CHIẾN TRƯỜNG
-        client.delete_table(temp_table_id, not_found_ok=True)
-
-    # 6. XỬ LÝ KẾT QUẢ
-    results = []
-    for _, row in mismatched_df.iterrows():
-        pv_val_tong = row['pos_value'] if pd.notna(row.get('pos_value')) else 0.0
-        tx_val_tong = row['sse_value'] if pd.notna(row.get('sse_value')) else 0.0
-
-        status_msgs = []
-        is_missing = False
-        if pd.isna(row.get('KyHieu_pv')):
-            status_msgs.append("❗ Chỉ có trên Bảng kê Thuế (Không có trên PVOIL)")
-            is_missing = True
-        elif pd.isna(row.get('KyHieu_tx')):
-            status_msgs.append("❗ Chỉ có trên GSheet PVOIL (Không có trên Thuế)")
-            is_missing = True
-        else:
-            name_pv = _vn_normalize(str(row.get('KhachHang_pv', '')))
-            name_tx = _vn_normalize(str(row.get('KhachHang_tx', '')))
-            mst_pv = str(row.get('MST_pv', '')).replace('nan', '').replace(' ', '').lower()
-            mst_tx = str(row.get('MST_tx', '')).replace('nan', '').replace(' ', '').lower()
-            
-            is_money_diff = False
-            if abs(row.get('TienChuaThue_pv', 0) - row.get('TienChuaThue_tx', 0)) >= 1.0:
-                status_msgs.append("Lệch Tiền Chưa Thuế")
-                is_money_diff = True
-            if abs(row.get('TienThue_pv', 0) - row.get('TienThue_tx', 0)) >= 1.0:
-                status_msgs.append("Lệch Tiền Thuế")
-                is_money_diff = True
-            if abs(row.get('TongTien_pv', 0) - row.get('TongTien_tx', 0)) >= 1.0:
-                status_msgs.append(f"Lệch Tổng Tiền (PV: {pv_val_tong:,.0f} vs Thuế: {tx_val_tong:,.0f})")
-                is_money_diff = True
-                
-            is_mst_diff = (mst_pv != mst_tx)
-            if is_mst_diff:
-                status_msgs.append(f"Khác MST (PV: '{row.get('MST_pv', '')}' vs Thuế: '{row.get('MST_tx', '')}')")
-                
-            if name_pv != name_tx:
-                status_msgs.append(f"Khác Tên KH (PV: '{row.get('KhachHang_pv', '')}' vs Thuế: '{row.get('KhachHang_tx', '')}')")
-            elif not is_money_diff and not is_mst_diff:
-                continue 
+# Cột HD01 cần cho đối soát HoaDon (engine pandas chỉ đọc đúng các cột này)
+INVOICE_PVOIL_COLUMNS = ['Ten_CHXD', 'Ky_Hieu', 'So_HD', 'Ten_Khach_Hang', 'Ma_So_Thue', 'Tien_Chua_Thue', 'Tien_Thue', 'Tong_Tien']
 
-        results.append({
-            'chxd_name': row['chxd_name'],
-            'invoice_id': str(row['invoice_id']).replace('_', ' '),
-            'pos_value': pv_val_tong,
-            'sse_value': tx_val_tong,
-            'is_match': False,
-            'status': " - ".join(status_msgs)
-        })
+def invoice_engine():
+    """Engine đối soát HoaDon: 'sql' (mặc định - FULL OUTER JOIN trên BigQuery/DuckDB) hoặc 'pandas' (hash-join trong tiến trình)."""
+    return os.getenv("HD01_INVOICE_ENGINE", "sql").strip().lower()
+
+def _invoice_mismatches_pandas(pvoil_df, tax_df):
+    """
+    Bản pandas của _invoice_mismatch_sql: hash-join theo HD_ID, trả về đúng các cột/giá trị như câu SQL.
+    Giữ ngữ nghĩa NULL của SQL: HD_ID NULL (thiếu Ký hiệu/Số HĐ) không khớp với dòng nào, kể cả dòng NULL khác.
+    """
+    p = pd.DataFrame({
+        'Ten_CHXD': pvoil_df['Ten_CHXD'],
+        'HD_ID': pvoil_df['Ky_Hieu'].str.strip() + '_' + pvoil_df['So_HD'].str.strip().str.lstrip('0'),
+        'KyHieu_pv': pvoil_df['Ky_Hieu'], 'KhachHang_pv': pvoil_df['Ten_Khach_Hang'], 'MST_pv': pvoil_df['Ma_So_Thue'],
+        'TienChuaThue_pv': pvoil_df['Tien_Chua_Thue'], 'TienThue_pv': pvoil_df['Tien_Thue'], 'TongTien_pv': pvoil_df['Tong_Tien'],
+    })
+    t = pd.DataFrame({
+        'HD_ID': tax_df['HD_ID'],
+        'KyHieu_tx': tax_df['KyHieu'], 'KhachHang_tx': tax_df['KhachHang'], 'MST_tx': tax_df['MST'],
+        'TienChuaThue_tx': tax_df['TienChuaThue'], 'TienThue_tx': tax_df['TienThue'], 'TongTien_tx': tax_df['TongTien'],
+    })
+    p_null, t_null = p['HD_ID'].isna(), t['HD_ID'].isna()
+    merged = pd.concat([
+        p[~p_null].merge(t[~t_null], on='HD_ID', how='outer', indicator=True, sort=False),
+        p[p_null].assign(_merge='left_only'),
+        t[t_null].assign(_merge='right_only'),
+    ], ignore_index=True)
+
+    def money_diff(col):
+        return (merged[f'{col}_pv'].fillna(0) - merged[f'{col}_tx'].fillna(0)).abs() >= 1.0
+    def norm_mst(col):
+        return merged[col].fillna('').astype(str).str.lower().str.replace(' ', '', regex=False)
+    def norm_name(col):
+        return merged[col].fillna('').astype(str).str.strip().str.lower()
+
+    keep = ((merged['_merge'] != 'both')
+            | money_diff('TongTien') | money_diff('TienChuaThue') | money_diff('TienThue')
+            | (norm_mst('MST_pv') != norm_mst('MST_tx'))
+            | (norm_name('KhachHang_pv') != norm_name('KhachHang_tx')))
+    merged = merged[keep]
+
+    return pd.DataFrame({
+        'chxd_name': merged['Ten_CHXD'].astype(object).where(merged['Ten_CHXD'].notna(), 'Bảng kê Thuế'),
+        'invoice_id': merged['HD_ID'].astype(object).where(merged['HD_ID'].notna(), None),
+        'pos_value': merged['TongTien_pv'], 'sse_value': merged['TongTien_tx'],
+        'KyHieu_pv': merged['KyHieu_pv'], 'KyHieu_tx': merged['KyHieu_tx'],
+        'KhachHang_pv': merged['KhachHang_pv'], 'KhachHang_tx': merged['KhachHang_tx'],
+        'MST_pv': merged['MST_pv'], 'MST_tx': merged['MST_tx'],
+        'TienChuaThue_pv': merged['TienChuaThue_pv'], 'TienChuaThue_tx': merged['TienChuaThue_tx'],
+        'TienThue_pv': merged['TienThue_pv'], 'TienThue_tx': merged['TienThue_tx'],
+        'TongTien_pv': merged['TongTien_pv'], 'TongTien_tx': merged['TongTien_tx'],
+    }).reset_index(drop=True)
+
+def reconcile_invoice_data_bq(report_month, report_year, tax_df, progress_callback=None, engine=None):
+    """
+    THUẬT TOÁN ĐỐI SOÁT ĐÁM MÂY (FULL OUTER JOIN TRÊN BIGQUERY)
+    Khi HD01_BACKEND=local: cùng câu SQL chạy trên DuckDB với kho Parquet cục bộ, không cần mạng.
+    engine='pandas' (hoặc HD01_INVOICE_ENGINE=pandas): đọc HD01 của tháng 1 lần (qua bộ nhớ đệm query_cache)
+    rồi hash-join ngay trong tiến trình - không phải đẩy bảng kê Thuế lên BigQuery.
+    """
+    import bq_handler
+    import bq_query
+    
+    if tax_df is None or tax_df.empty:
+        return []
+
+    if (engine or invoice_engine()) == "pandas":
+        if progress_callback: progress_callback(".... Đang đọc dữ liệu HD01 của tháng để đối soát trong bộ nhớ....")
+        pvoil_df = bq_handler.get_raw_hd01_data(report_month, report_year, columns=INVOICE_PVOIL_COLUMNS)
+        if progress_callback: progress_callback(".... Đang so khớp chéo (hash-join theo HD_ID)....")
+        return _build_invoice_results(_invoice_mismatches_pandas(pvoil_df, tax_df))
+
+    if bq_handler.hd01_backend() == "local":
+        import local_store
+        if progress_callback: progress_callback(".... Đang đối soát trên kho dữ liệu cục bộ (DuckDB)....")
+        mismatched_df = local_store.query(_invoice_mismatch_sql("hd01_current", "tax_data"), report_month, report_year, tax_data=tax_df)
+        return _build_invoice_results(mismatched_df)
+
+    client = bq_handler.get_bq_client()
+
+    if progress_callback: progress_callback(".... Đang tải dữ liệu bảng kê thuế lên BigQuery....")
+
+    # 1-2. Bơm file Thuế (Parquet nén) vào bảng Tax_Staging dùng chung, tách riêng theo Session_Id của lần đối soát này
+    tax_source, tax_params = bq_handler.stage_tax_data(client, tax_df)
+
+    if progress_callback: progress_callback(".... Đang chờ kết quả đối soát từ BigQuery (So khớp chéo)....")
+
+    # 3. Kích hoạt Lệnh SQL So Khớp Chéo
+    pvoil_source = f"`{bq_handler._table_id(client, bq_handler.CURRENT_TABLE)}` WHERE {bq_handler.PERIOD_FILTER_SQL}"
+    mismatched_df = bq_query.run(client, _invoice_mismatch_sql(pvoil_source, tax_source),
+                                 {**bq_handler.period_params(report_month, report_year), **tax_params},
+                                 call_site="reconcile_invoice").to_dataframe()
+
+    if progress_callback: progress_callback(".... Đang nhận kết quả từ BigQuery....")
+
+    # 4-5. Không còn bảng tạm phải dọn: dữ liệu phiên tự hết hạn theo partition ngày của Tax_Staging
+    return _build_invoice_results(mismatched_df)
+
+def _str_values(series):
+    """str() từng giá trị như khi đọc qua iterrows (None → 'None', NaN → 'nan'), chỉ tính 1 lần mỗi giá trị khác nhau."""
+    return series.astype(object).map(str)
+
+def _build_invoice_results(mismatched_df):
+    # 6. XỬ LÝ KẾT QUẢ (dùng mặt nạ theo cột thay cho iterrows; thông báo giữ nguyên từng chữ)
+    df = mismatched_df.reset_index(drop=True)
+    # Chuỗi NULL luôn là None như kết quả BigQuery (DuckDB/pandas trả NaN) → str() ra cùng một chữ trên mọi engine
+    for col in ['chxd_name', 'invoice_id', 'KyHieu_pv', 'KyHieu_tx', 'KhachHang_pv', 'KhachHang_tx', 'MST_pv', 'MST_tx']:
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    pos_values = df['pos_value'].where(df['pos_value'].notna(), 0.0)
+    sse_values = df['sse_value'].where(df['sse_value'].notna(), 0.0)
+
+    only_tax = df['KyHieu_pv'].isna()
+    only_pv = ~only_tax & df['KyHieu_tx'].isna()
+    both = ~only_tax & ~only_pv
+
+    status = pd.Series('', index=df.index, dtype=object)
+    status[only_tax] = "❗ Chỉ có trên Bảng kê Thuế (Không có trên PVOIL)"
+    status[only_pv] = "❗ Chỉ có trên GSheet PVOIL (Không có trên Thuế)"
+
+    keep = ~both
+    b = df[both]
+    if not b.empty:
+        name_cache = {}
+        def normalize_name(col):
+            return _str_values(b[col]).map(lambda v: name_cache[v] if v in name_cache else name_cache.setdefault(v, _vn_normalize(v)))
+        def normalize_mst(col):
+            return _str_values(b[col]).str.replace('nan', '', regex=False).str.replace(' ', '', regex=False).str.lower()
+
+        diff_ct = (b['TienChuaThue_pv'] - b['TienChuaThue_tx']).abs() >= 1.0
+        diff_tt = (b['TienThue_pv'] - b['TienThue_tx']).abs() >= 1.0
+        diff_tong = (b['TongTien_pv'] - b['TongTien_tx']).abs() >= 1.0
+        diff_mst = normalize_mst('MST_pv') != normalize_mst('MST_tx')
+        diff_name = normalize_name('KhachHang_pv') != normalize_name('KhachHang_tx')
+
+        parts = pd.DataFrame('', index=b.index, columns=['ct', 'tt', 'tong', 'mst', 'name'], dtype=object)
+        parts.loc[diff_ct, 'ct'] = "Lệch Tiền Chưa Thuế"
+        parts.loc[diff_tt, 'tt'] = "Lệch Tiền Thuế"
+        parts.loc[diff_tong, 'tong'] = [f"Lệch Tổng Tiền (PV: {pv:,.0f} vs Thuế: {tx:,.0f})"
+                                        for pv, tx in zip(pos_values[b.index][diff_tong], sse_values[b.index][diff_tong])]
+        parts.loc[diff_mst, 'mst'] = "Khác MST (PV: '" + _str_values(b['MST_pv'][diff_mst]) + "' vs Thuế: '" + _str_values(b['MST_tx'][diff_mst]) + "')"
+        parts.loc[diff_name, 'name'] = ("Khác Tên KH (PV: '" + _str_values(b['KhachHang_pv'][diff_name])
+                                        + "' vs Thuế: '" + _str_values(b['KhachHang_tx'][diff_name]) + "')")
+        status[b.index] = [" - ".join(p for p in row if p) for row in parts.itertuples(index=False, name=None)]
+        keep[b.index] = diff_ct | diff_tt | diff_tong | diff_mst | diff_name
+
+    results = [
+        {'chxd_name': chxd, 'invoice_id': inv, 'pos_value': pv, 'sse_value': sv, 'is_match': False, 'status': st}
+        for chxd, inv, pv, sv, st in zip(df['chxd_name'][keep], _str_values(df['invoice_id'][keep]).str.replace('_', ' ', regex=False),
+                                         pos_values[keep], sse_values[keep], status[keep])
+    ]
 
     if not results:
         results.append({
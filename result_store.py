@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+result_store.py
+Lưu kết quả đối soát phía máy chủ theo mã kết quả (result_id) để tải Excel / xem lại bằng GET, không cần trình duyệt
+gửi ngược cả danh sách kết quả lên.
+
+Mỗi kết quả gồm 2 file trong thư mục lưu:
+  <result_id>.parquet  → các bản ghi kết quả (nén zstd), xếp dòng lệch lên trước, mỗi row group = 1 trang
+                         (đọc 1 trang chỉ giải nén đúng row group đó); cột _row giữ thứ tự gốc cho Excel / xem lại
+  <result_id>.json     → metadata: loại đối soát, thời điểm tạo, số dòng, cột, thông tin thêm (ngày/tháng đối soát...)
+  <result_id>.xlsx     → file Excel đã dựng (tạo ở lần tải đầu tiên, dùng lại cho các lần sau)
+Kết quả quá TTL bị bỏ qua khi đọc và được dọn mỗi lần lưu kết quả mới.
+
+Biến môi trường:
+  RECONCILE_RESULT_DIR=cache_data/results (mặc định)
+  RECONCILE_RESULT_TTL_SECONDS=86400      (mặc định 1 ngày)
+  RECONCILE_PAGE_ROWS=2000                (số dòng mỗi trang kết quả)
+"""
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import cache_utils
+
+PARQUET_COMPRESSION = "zstd"
+ROW_COLUMN = "_row"      # Vị trí dòng trong danh sách kết quả gốc
+TEXT_SUFFIX = "__text"  # Cột lẫn số và chữ (vd pos_value = 'N/A') được tách thành cột số + cột chữ khi ghi Parquet
+
+# Tên cột khi xuất Excel theo loại đối soát
+RESULT_COLUMN_NAMES = {
+    'TienMat': {'chxd_name': 'Cửa hàng', 'product_name': 'Đối tượng', 'pos_value': 'Tiền mặt POS (VND)', 'sse_value': 'Tiền mặt Kế toán (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú'},
+    'CongNo': {'chxd_name': 'Cửa hàng', 'customer_code': 'Mã khách', 'customer_name': 'Tên khách hàng', 'pos_value': 'Phát sinh nợ POS (VND)', 'sse_value': 'Phát sinh nợ Kế toán (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú', 'match_confidence': 'Độ tin cậy ghép'},
+    'HoaDon': {'chxd_name': 'Cửa hàng / Phân loại', 'invoice_id': 'Chứng minh thư HĐ', 'pos_value': 'Tổng tiền PVOIL (VND)', 'sse_value': 'Tổng tiền Bảng kê Thuế (VND)', 'is_match': 'Khớp', 'status': 'Ghi chú'},
+    'SanLuong': {'chxd_name': 'Cửa hàng', 'product_name': 'Mặt hàng', 'pos_value': 'Sản lượng POS', 'sse_value': 'Sản lượng Kế toán', 'is_match': 'Khớp', 'status': 'Ghi chú'},
+}
+
+_lock = threading.Lock()
+_building = {}  # result_id -> Lock, tránh dựng cùng 1 file Excel 2 lần song song
+_RESULT_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _store_dir():
+    return os.getenv("RECONCILE_RESULT_DIR", os.path.join("cache_data", "results"))
+
+def _ttl_seconds():
+    return cache_utils.env_int("RECONCILE_RESULT_TTL_SECONDS", 86400)
+
+def page_rows():
+    return max(1, int(os.getenv("RECONCILE_PAGE_ROWS", "2000")))
+
+def _path(result_id, ext):
+    return os.path.join(_store_dir(), f"{result_id}.{ext}")
+
+def _valid_id(result_id):
+    return bool(result_id) and bool(_RESULT_ID_RE.match(str(result_id)))
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _split_mixed_columns(df):
+    """Cột object vừa có số vừa có chữ → cột số (chữ = null) + cột '<tên>__text' (số = null). Trả về (df, các cột đã tách)."""
+    split = []
+    for col in list(df.columns):
+        if df[col].dtype != object:
+            continue
+        values = df[col]
+        is_number = values.map(_is_number).astype(bool)
+        is_text = values.map(lambda v: isinstance(v, str)).astype(bool)
+        if is_number.any() and is_text.any():
+            df[col + TEXT_SUFFIX] = values.where(is_text, None)
+            df[col] = pd.to_numeric(values.where(is_number, None), errors='coerce')
+            split.append(col)
+    return df, split
+
+def mismatch_order(results):
+    """Chỉ số các bản ghi theo thứ tự hiển thị: dòng lệch trước, dòng khớp sau (giữ thứ tự gốc trong từng nhóm)."""
+    return ([i for i, r in enumerate(results) if not r.get('is_match')] +
+            [i for i, r in enumerate(results) if r.get('is_match')])
+
+def sweep():
+    """Xoá các kết quả đã quá TTL (cả file Parquet, metadata và Excel đã dựng). Trả về số kết quả đã xoá."""
+    cutoff = time.time() - _ttl_seconds()
+    removed = 0
+    for meta_path in glob.glob(os.path.join(_store_dir(), "*.json")):
+        try:
+            if os.path.getmtime(meta_path) >= cutoff:
+                continue
+        except OSError:
+            continue
+        result_id = os.path.splitext(os.path.basename(meta_path))[0]
+        for ext in ("parquet", "xlsx", "json"):
+            try:
+                os.remove(_path(result_id, ext))
+            except OSError:
+                pass
+        removed += 1
+    return removed
+
+def save(results, reconcile_type, **meta):
+    """Lưu danh sách bản ghi kết quả, trả về result_id (None nếu không lưu được - đối soát vẫn trả kết quả như thường)."""
+    result_id = uuid.uuid4().hex
+    try:
+        os.makedirs(_store_dir(), exist_ok=True)
+        order = mismatch_order(results)
+        df = pd.DataFrame([results[i] for i in order])
+        columns = list(df.columns)
+        df, split = _split_mixed_columns(df)
+        df[ROW_COLUMN] = order
+        cache_utils.write_atomic(_path(result_id, "parquet"),
+                                 lambda p: df.to_parquet(p, index=False, compression=PARQUET_COMPRESSION, row_group_size=page_rows()))
+        metadata = {
+            'result_id': result_id,
+            'reconcile_type': reconcile_type,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'rows': len(df),
+            'mismatches': len(results) - sum(1 for r in results if r.get('is_match')),
+            'columns': columns,
+            'split_columns': split,
+            **meta,
+        }
+        def write_meta(p):
+            with open(p, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False, default=str)
+        cache_utils.write_atomic(_path(result_id, "json"), write_meta)
+    except Exception as e:
+        print(f"[Cảnh báo] Không lưu được kết quả đối soát: {e}")
+        return None
+    try:
+        sweep()
+    except Exception as e:
+        print(f"[Cảnh báo] Không dọn được kết quả đối soát cũ: {e}")
+    return result_id
+
+def load_meta(result_id):
+    """Metadata của kết quả, None nếu không có hoặc đã hết hạn."""
+    if not _valid_id(result_id):
+        return None
+    path = _path(result_id, "json")
+    try:
+        if time.time() - os.path.getmtime(path) >= _ttl_seconds():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def load_frame(result_id):
+    """(DataFrame kết quả đúng cột/thứ tự như lúc lưu, metadata) hoặc (None, None)."""
+    meta = load_meta(result_id)
+    if meta is None:
+        return None, None
+    try:
+        df = pd.read_parquet(_path(result_id, "parquet"))
+    except Exception as e:
+        print(f"[Cảnh báo] Không đọc được kết quả đối soát {result_id}: {e}")
+        return None, None
+    if ROW_COLUMN in df.columns:
+        df = df.sort_values(ROW_COLUMN, kind='stable').reset_index(drop=True)
+    return _restore_columns(df, meta), meta
+
+def _restore_columns(df, meta):
+    for col in meta.get('split_columns', []):
+        text = df.pop(col + TEXT_SUFFIX)
+        df[col] = text.astype(object).where(text.notna(), df[col].astype(object))
+    return df[meta['columns']]
+
+def _to_records(df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def load_records(result_id):
+    """(list bản ghi như lúc lưu - null là None, metadata) hoặc (None, None)."""
+    df, meta = load_frame(result_id)
+    if df is None:
+        return None, None
+    return _to_records(df), meta
+
+def load_page(result_id, cursor=0, limit=None):
+    """
+    1 trang kết quả theo thứ tự hiển thị (dòng lệch trước): (list bản ghi, cursor trang sau hoặc None nếu hết, metadata).
+    Chỉ đọc các row group chứa trang cần lấy. (None, None, None) nếu kết quả không tồn tại/hết hạn.
+    """
+    meta = load_meta(result_id)
+    if meta is None:
+        return None, None, None
+    cursor, limit = max(0, int(cursor)), max(1, int(limit or page_rows()))
+    try:
+        parquet = pq.ParquetFile(_path(result_id, "parquet"))
+        groups, offset, start = [], 0, None
+        for i in range(parquet.num_row_groups):
+            n = parquet.metadata.row_group(i).num_rows
+            if offset + n > cursor and offset < cursor + limit:
+                groups.append(i)
+                start = offset if start is None else start
+            offset += n
+        df = parquet.read_row_groups(groups).to_pandas() if groups else parquet.schema_arrow.empty_table().to_pandas()
+    except Exception as e:
+        print(f"[Cảnh báo] Không đọc được kết quả đối soát {result_id}: {e}")
+        return None, None, None
+    skip = cursor - start if start is not None else 0
+    df = _restore_columns(df.iloc[skip:skip + limit].reset_index(drop=True), meta)
+    next_cursor = cursor + len(df) if cursor + len(df) < meta['rows'] else None
+    return _to_records(df), next_cursor, meta
+
+def workbook_path(result_id, build):
+    """
+    Đường dẫn file Excel của kết quả; dựng bằng build(df, meta, path) ở lần gọi đầu rồi dùng lại.
+    None nếu kết quả không tồn tại/hết hạn.
+    """
+    meta = load_meta(result_id)
+    if meta is None:
+        return None
+    path = _path(result_id, "xlsx")
+    with _lock:
+        build_lock = _building.setdefault(result_id, threading.Lock())
+    try:
+        with build_lock:
+            if not os.path.exists(path):
+                df, meta = load_frame(result_id)
+                if df is None:
+                    return None
+                cache_utils.write_atomic(path, lambda p: build(df, meta, p))
+    finally:
+        with _lock:
+            _building.pop(result_id, None)
+    return path
+
+def stats():
+    """Số kết quả đang lưu, dung lượng và số file Excel đã dựng sẵn."""
+    files = glob.glob(os.path.join(_store_dir(), "*"))
+    return {
+        'ttl_seconds': _ttl_seconds(),
+        'results': sum(1 for p in files if p.endswith(".json")),
+        'workbooks': sum(1 for p in files if p.endswith(".xlsx")),
+        'disk_bytes': sum(os.path.getsize(p) for p in files),
+    }
@@ -0,0 +1,127 @@
+// Web Worker của bảng kết quả đối soát (templates/index.html).
+// Giữ kết quả dạng cột + chỉ mục lọc/sắp xếp ngoài luồng giao diện; trang chỉ xin đúng đoạn dòng đang hiện trên màn hình.
+//
+// Lệnh nhận:  {cmd: 'reset'} | {cmd: 'append', rows} | {cmd: 'query', sort: {col, dir} | null, filter: {text, mismatchOnly}}
+//             {cmd: 'slice', start, end, seq}
+// Gửi lại:    {event: 'count', total, visible, mismatches, version} - sau mỗi lần dữ liệu / điều kiện đổi
+//             {event: 'rows', start, rows, seq, version}           - các dòng [start, end) của khung nhìn hiện tại
+
+const COLUMNS = ['chxd_name', 'invoice_id', 'customer_code', 'customer_name', 'product_name',
+                 'pos_value', 'sse_value', 'is_match', 'status', 'match_confidence'];
+const collator = new Intl.Collator('vi', { numeric: true, sensitivity: 'base' });
+
+let store, search, total, mismatches, view, sortIndexes, query, version;
+
+function reset() {
+    store = Object.fromEntries(COLUMNS.map(c => [c, []]));
+    search = [];            // chuỗi tìm kiếm (chữ thường, bỏ dấu) của từng dòng, dựng 1 lần lúc nhận dòng
+    total = 0;
+    mismatches = 0;
+    view = new Int32Array(0);
+    sortIndexes = {};       // 'cột:chiều' -> thứ tự của mọi dòng (dựng khi cần, bỏ khi có dòng mới)
+    query = { sort: null, filter: { text: '', mismatchOnly: false } };
+    version = 0;
+}
+
+function fold(text) {
+    return String(text).normalize('NFD').replace(/[\u0300-\u036f]/g, '').replace(/đ/g, 'd').replace(/Đ/g, 'd').toLowerCase();
+}
+
+function compareValues(a, b, dir) {
+    // null/rỗng luôn xếp cuối (cả khi giảm dần); số so theo giá trị, còn lại so chữ theo tiếng Việt
+    const aEmpty = a === null || a === undefined || a === '';
+    const bEmpty = b === null || b === undefined || b === '';
+    if (aEmpty || bEmpty) return aEmpty === bEmpty ? 0 : (aEmpty ? 1 : -1);
+    if (typeof a === 'number' && typeof b === 'number') return dir * (a - b);
+    if (typeof a === 'number') return -dir;
+    if (typeof b === 'number') return dir;
+    return dir * collator.compare(String(a), String(b));
+}
+
+function sortIndex(col, dir) {
+    // Thứ tự của mọi dòng theo cột (ổn định: cùng giá trị giữ thứ tự nhận), dựng khi cần rồi dùng lại cho các lần lọc
+    const key = col + ':' + dir;
+    if (!sortIndexes[key]) {
+        const values = store[col];
+        const sign = dir === 'desc' ? -1 : 1;
+        const order = new Int32Array(total);
+        for (let i = 0; i < total; i++) order[i] = i;
+        order.sort((i, j) => compareValues(values[i], values[j], sign) || i - j);
+        sortIndexes[key] = order;
+    }
+    return sortIndexes[key];
+}
+
+function matches(i) {
+    const { text, mismatchOnly } = query.filter;
+    if (mismatchOnly && store.is_match[i]) return false;
+    return !text || search[i].includes(text);
+}
+
+function rebuildView() {
+    const out = new Int32Array(total);
+    let n = 0;
+    if (query.sort && query.sort.col in store) {
+        const order = sortIndex(query.sort.col, query.sort.dir);
+        for (let k = 0; k < total; k++) if (matches(order[k])) out[n++] = order[k];
+    } else {
+        for (let i = 0; i < total; i++) if (matches(i)) out[n++] = i;
+    }
+    view = out.subarray(0, n);
+    version++;
+}
+
+function appendRows(rows) {
+    const start = total;
+    for (const row of rows) {
+        for (const col of COLUMNS) store[col].push(row[col] === undefined ? null : row[col]);
+        search.push(fold([row.chxd_name, row.invoice_id, row.customer_code, row.customer_name, row.product_name, row.status]
+                         .filter(v => v !== null && v !== undefined).join(' ')));
+        if (!row.is_match) mismatches++;
+    }
+    total += rows.length;
+    sortIndexes = {};
+    if (query.sort) {
+        rebuildView();
+        return;
+    }
+    // Không sắp xếp: chỉ cần lọc nối tiếp các dòng mới vào cuối khung nhìn
+    const out = new Int32Array(view.length + rows.length);
+    out.set(view);
+    let n = view.length;
+    for (let i = start; i < total; i++) if (matches(i)) out[n++] = i;
+    view = out.subarray(0, n);
+    version++;
+}
+
+function rowAt(i) {
+    const row = {};
+    for (const col of COLUMNS) row[col] = store[col][i];
+    return row;
+}
+
+function postCount() {
+    postMessage({ event: 'count', total: total, visible: view.length, mismatches: mismatches, version: version });
+}
+
+reset();
+
+onmessage = (e) => {
+    const msg = e.data;
+    if (msg.cmd === 'reset') {
+        reset();
+        postCount();
+    } else if (msg.cmd === 'append') {
+        appendRows(msg.rows);
+        postCount();
+    } else if (msg.cmd === 'query') {
+        query = { sort: msg.sort || null, filter: { text: fold((msg.filter && msg.filter.text) || '').trim(), mismatchOnly: !!(msg.filter && msg.filter.mismatchOnly) } };
+        rebuildView();
+        postCount();
+    } else if (msg.cmd === 'slice') {
+        const start = Math.max(0, msg.start), end = Math.min(view.length, msg.end);
+        const rows = [];
+        for (let k = start; k < end; k++) rows.push(rowAt(view[k]));
+        postMessage({ event: 'rows', start: start, rows: rows, seq: msg.seq, version: version });
+    }
+};
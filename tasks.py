@@ -81,11 +81,12 @@ def download_report_generator(report_date: datetime, report_type="BH03", station
             if station_code_filter == 'ALL' or not station_code_filter:
                 success_count = 0
                 failed_stores = []
+                frames = {}  # {store_code: df_clean} - gom lại để nạp BigQuery 1 lần cho cả lượt chạy
                 stores_list = list(stores_to_process.items())
                 total_stores = len(stores_list)
 
                 for idx, (store_code, store_name) in enumerate(stores_list, 1):
-                    yield _sse(f"➤ [{idx}/{total_stores}] Đang tải & bơm dữ liệu: {store_name} lên BigQuery...")
+                    yield _sse(f"➤ [{idx}/{total_stores}] Đang tải dữ liệu: {store_name}...")
                     
                     is_success = False
                     for attempt in range(1, _safe_int(config.MAX_ATTEMPTS) + 1):
@@ -99,17 +100,12 @@ def download_report_generator(report_date: datetime, report_type="BH03", station
                             
                             if not df_clean.empty:
                                 if 'Ngày hóa đơn' in df_clean.columns: df_clean['Ngày hóa đơn'] = df_clean['Ngày hóa đơn'].astype(str).str.slice(0, 10)
-                                
-                                # 3. Xóa dữ liệu cũ (Dọn rác/Idempotent) & Bơm dữ liệu mới
-                                bq_handler.delete_old_data(store_code, report_month, report_year)
-                                bq_handler.upload_dataframe(df_clean, store_code, report_month, report_year)
-                                
-                                yield _sse(f"     ✔ Đã bơm thành công {len(df_clean)} dòng lên BigQuery.")
+                                yield _sse(f"     ✔ Đã chuẩn bị {len(df_clean)} dòng.")
                                 success_count += 1
                             else: 
-                                # Nếu file rỗng thì vẫn phải xóa data cũ (trường hợp tháng trước có, tháng này PVOIL xóa)
-                                bq_handler.delete_old_data(store_code, report_month, report_year)
+                                # File rỗng vẫn đưa vào lượt nạp để xóa data cũ (trường hợp tháng trước có, tháng này PVOIL xóa)
                                 yield _sse("     ❌ Không có dữ liệu.")
+                            frames[store_code] = df_clean
                             is_success = True
                             break 
                         except Exception as e:
@@ -118,6 +114,12 @@ def download_report_generator(report_date: datetime, report_type="BH03", station
                     
                     if not is_success: failed_stores.append(store_name)
 
+                # 3. Nạp 1 lần: 1 load job vào Staging + 1 MERGE thay thế nguyên tử (CHXD lỗi giữ nguyên dữ liệu cũ)
+                if frames:
+                    yield _sse(f"➤ Đang nạp {len(frames)} CHXD lên BigQuery (Staging + MERGE)...")
+                    stats = bq_handler.replace_month_data(frames, report_month, report_year)
+                    yield _sse(f"     ✔ BigQuery: ghi mới {stats['inserted']} dòng, thay thế {stats['deleted']} dòng cũ của {stats['stores']} CHXD ({stats['uploaded_bytes'] / 1024:,.0f} KB Parquet).")
+
                 msg = f"Hoàn tất! Đã bơm thành công {success_count}/{total_stores} CHXD lên BigQuery."
                 if failed_stores: msg += f" | Thất bại: {', '.join(failed_stores)}"
                 yield _sse(f"FINAL_MESSAGE:{json.dumps({'status': 'success', 'message': msg})}")
@@ -138,18 +140,16 @@ def download_report_generator(report_date: datetime, report_type="BH03", station
                         
                         # 2. Làm sạch
                         df_clean = processor_hd01.process_hd01(df_raw, store_name)
+                        if not df_clean.empty and 'Ngày hóa đơn' in df_clean.columns:
+                            df_clean['Ngày hóa đơn'] = df_clean['Ngày hóa đơn'].astype(str).str.slice(0, 10)
+                        
+                        # 3. Thay thế nguyên tử lát dữ liệu của CHXD (rỗng = chỉ xóa data cũ)
+                        stats = bq_handler.replace_month_data({store_code: df_clean}, report_month, report_year)
                         
                         if not df_clean.empty:
-                            if 'Ngày hóa đơn' in df_clean.columns: df_clean['Ngày hóa đơn'] = df_clean['Ngày hóa đơn'].astype(str).str.slice(0, 10)
-                            
-                            # 3. Xóa data cũ & Bơm lên BQ
-                            bq_handler.delete_old_data(store_code, report_month, report_year)
-                            bq_handler.upload_dataframe(df_clean, store_code, report_month, report_year)
-                            
-                            yield _sse(f"     ✔ Cập nhật thành công {len(df_clean)} dòng.")
+                            yield _sse(f"     ✔ Cập nhật thành công {stats['inserted']} dòng (thay thế {stats['deleted']} dòng cũ).")
                             is_success = True
                         else: 
-                            bq_handler.delete_old_data(store_code, report_month, report_year)
                             yield _sse("     ❌ Không có dữ liệu.")
                         break 
                     except Exception as e: